@@ -8,8 +8,2614 @@ import sys
 import re
 import concurrent.futures
 import random
+import asyncio
+import threading
+import hashlib
+import queue
+import contextlib
+import math
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import shutil
+import sqlite3
+import tempfile
+import tracemalloc
+import urllib.request
+import weakref
+import zipfile
+import zlib
+import http.server
+import email.parser
+import email.policy
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from collections import Counter, OrderedDict
+from fractions import Fraction
 from typing import Dict, List, Tuple
 
+try:
+    import numpy as np
+except ImportError:  # Only the 1/f analysis needs NumPy
+    np = None
+
+try:
+    import psutil
+except ImportError:  # Resident memory is read from /proc instead, where there is one
+    psutil = None
+
+try:
+    import httpx
+except ImportError:  # Shared clients then keep the OpenAI SDK's own pool settings and are not traced
+    httpx = None
+
+try:
+    import h2  # Lets httpx speak HTTP/2
+except ImportError:
+    h2 = None
+
+
+# Default per-model budgets (requests and tokens per minute). The limiter replaces these with the
+# real account limits as soon as the API reports them in x-ratelimit-limit-* response headers.
+DEFAULT_RATE_LIMITS = {
+    "gpt-4.1": {"requests_per_minute": 500, "tokens_per_minute": 30000},
+    "ft:gpt-4o-mini-2024-07-18:chia:test-1-500:BH9opiWg": {"requests_per_minute": 500, "tokens_per_minute": 200000},
+}
+DEFAULT_MODEL_RATE_LIMIT = {"requests_per_minute": 500, "tokens_per_minute": 30000}
+# Completion tokens a call reserves until the model has finished a call; later calls reserve the recent mean.
+# Reserving max_tokens instead would let a 30000 TPM budget admit only one 16384-token call at a time.
+INITIAL_COMPLETION_ESTIMATE = 2048
+
+
+def _parse_reset_duration(value):
+    """Parse rate limit durations such as "1s", "6m0s", "20ms" or "0.5" into seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    matches = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not matches:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in matches)
+
+
+class ModelRateLimiter:
+    """
+    Request and token budget for one model, shared by every agent in the process.
+    Each call reserves its request and estimated tokens up front; when the budget is exhausted the
+    balance goes negative and the caller is told how long to wait, so callers queue in arrival
+    order instead of failing and backing off blindly. The completion part of the estimate is the
+    recent mean completion size, capped by max_tokens, and is settled against the real size once the
+    call finishes.
+    """
+
+    def __init__(self, model_name: str, requests_per_minute: int, tokens_per_minute: int):
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._set_limits(requests_per_minute, tokens_per_minute)
+        self._requests = float(self.requests_per_minute)
+        self._tokens = float(self.tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._completion_mean = None
+
+    def _set_limits(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = max(1, int(requests_per_minute))
+        self.tokens_per_minute = max(1, int(tokens_per_minute))
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def reserve(self, tokens: int) -> float:
+        """Debit one request and the estimated tokens, returning the seconds to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            # A single call larger than the whole budget can only ever wait for a full bucket
+            tokens = min(tokens, self.tokens_per_minute)
+            self._requests -= 1
+            self._tokens -= tokens
+
+            wait = max(
+                0.0,
+                -self._requests * 60 / self.requests_per_minute,
+                -self._tokens * 60 / self.tokens_per_minute,
+                self._blocked_until - now
+            )
+            return wait
+
+    def completion_estimate(self, max_tokens: int = None) -> int:
+        """Completion tokens to reserve for a call: the recent mean of finished calls, capped by max_tokens."""
+        with self._lock:
+            estimate = self._completion_mean or INITIAL_COMPLETION_ESTIMATE
+        return int(min(estimate, max_tokens) if max_tokens else estimate)
+
+    def settle(self, reserved_completion: int, completion_tokens: int) -> None:
+        """Charge a finished call's real completion size in place of the estimate it reserved."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= completion_tokens - reserved_completion
+            self._completion_mean = (completion_tokens if self._completion_mean is None
+                                     else 0.8 * self._completion_mean + 0.2 * completion_tokens)
+
+    def _blocked_for(self):
+        with self._lock:
+            return max(0.0, self._blocked_until - time.monotonic())
+
+    def acquire(self, tokens: int) -> float:
+        """Block the calling thread until the call fits in the budget. Returns the time spent waiting."""
+        waited = 0.0
+        wait = self.reserve(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            # A 429 may have pushed the model's unblock time past our reservation
+            wait = self._blocked_for()
+        return waited
+
+    async def acquire_async(self, tokens: int) -> float:
+        """Wait on the event loop until the call fits in the budget. Returns the time spent waiting."""
+        waited = 0.0
+        wait = self.reserve(tokens)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+            wait = self._blocked_for()
+        return waited
+
+    def update_from_headers(self, headers) -> None:
+        """Synchronise the budget with the x-ratelimit-* headers returned by the API."""
+        if not headers:
+            return
+
+        def header_int(name):
+            value = headers.get(name)
+            try:
+                return int(float(value)) if value is not None else None
+            except ValueError:
+                return None
+
+        limit_requests = header_int("x-ratelimit-limit-requests")
+        limit_tokens = header_int("x-ratelimit-limit-tokens")
+        remaining_requests = header_int("x-ratelimit-remaining-requests")
+        remaining_tokens = header_int("x-ratelimit-remaining-tokens")
+
+        with self._lock:
+            self._refill(time.monotonic())
+            if limit_requests or limit_tokens:
+                self._set_limits(limit_requests or self.requests_per_minute,
+                                 limit_tokens or self.tokens_per_minute)
+            # The server also sees traffic from other processes on the same account
+            if remaining_requests is not None:
+                self._requests = min(self._requests, remaining_requests)
+            if remaining_tokens is not None:
+                self._tokens = min(self._tokens, remaining_tokens)
+
+    def penalize(self, retry_after: float) -> None:
+        """Hold every caller of this model until the server says it is safe to retry."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def handle_rate_limit_error(self, error) -> float:
+        """Apply the Retry-After or reset headers of a 429 response and return the delay in seconds."""
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        self.update_from_headers(headers)
+
+        retry_after = None
+        if headers.get("retry-after-ms") is not None:
+            retry_after = _parse_reset_duration(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000 if retry_after is not None else None
+        if retry_after is None:
+            retry_after = _parse_reset_duration(headers.get("retry-after"))
+        if retry_after is None:
+            resets = [_parse_reset_duration(headers.get("x-ratelimit-reset-requests")),
+                      _parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))]
+            resets = [reset for reset in resets if reset is not None]
+            retry_after = max(resets) if resets else None
+        if retry_after is None:
+            retry_after = 1.0
+
+        self.penalize(retry_after)
+        return retry_after
+
+
+class RateLimiterRegistry:
+    """Process-wide map of model name to ModelRateLimiter."""
+
+    def __init__(self, default_limits: Dict = None):
+        self._lock = threading.Lock()
+        self._limits = dict(default_limits or {})
+        self._limiters = {}
+
+    def configure(self, model_name: str, requests_per_minute: int, tokens_per_minute: int) -> None:
+        """Set the budget for a model, replacing any existing limiter for it."""
+        with self._lock:
+            self._limits[model_name] = {"requests_per_minute": requests_per_minute,
+                                        "tokens_per_minute": tokens_per_minute}
+            self._limiters.pop(model_name, None)
+
+    def get(self, model_name: str) -> ModelRateLimiter:
+        with self._lock:
+            limiter = self._limiters.get(model_name)
+            if limiter is None:
+                limits = self._limits.get(model_name, DEFAULT_MODEL_RATE_LIMIT)
+                limiter = ModelRateLimiter(model_name, limits["requests_per_minute"], limits["tokens_per_minute"])
+                self._limiters[model_name] = limiter
+            return limiter
+
+
+# Shared by every agent in the process so all threads and coroutines draw from the same budgets
+RATE_LIMITERS = RateLimiterRegistry(DEFAULT_RATE_LIMITS)
+
+
+class HttpClientPool:
+    """
+    Process-wide OpenAI clients, one per API key and base URL (and per event loop for async clients), so every
+    agent reuses the same warm keep-alive connections instead of opening a connection pool of its own per trial.
+    configure() sizes each base URL's pool to the calls a batch can have in flight; HTTP/2 is used when the h2
+    package is installed. Requests, the connections they opened and the time spent opening them are counted
+    from httpcore trace events. Clients do not retry on their own (max_retries=0) unless asked to: the agents'
+    _request_model retries every chat call itself, through the rate limiter and the concurrency limit.
+    """
+
+    def __init__(self, max_connections: int = 100, keepalive_expiry: float = 120.0, http2: bool = True):
+        self._lock = threading.Lock()
+        self.max_connections = max_connections  # Pool size of base URLs configure() has not sized
+        self.keepalive_expiry = keepalive_expiry  # Idle connections are kept this long, across stages
+        self.http2 = http2
+        self.connections = {}  # base URL -> pool size
+        self.metrics = None
+        self._clients = {}  # (api key, base URL, max retries) -> (pool settings, openai.OpenAI)
+        self._async_clients = weakref.WeakKeyDictionary()  # event loop -> {(api key, base URL): (settings, client)}
+        self.stats = Counter()
+
+    def configure(self, connections: Dict[str, int] = None, http2: bool = None,
+                  metrics: "MetricsRegistry" = None) -> None:
+        """
+        Set the pool size of each base URL and start a new statistics window. Clients created with other
+        settings are replaced on their next use and left to the agents still holding them.
+        """
+        with self._lock:
+            self.connections.update(connections or {})
+            if http2 is not None:
+                self.http2 = http2
+            self.metrics = metrics
+            self.stats = Counter()
+
+    def _settings(self, base_url):
+        return self.connections.get(base_url, self.max_connections), self.http2 and h2 is not None
+
+    def _shared(self, clients, key, base_url, create):
+        with self._lock:
+            settings = self._settings(base_url)
+            entry = clients.get(key)
+            if entry is None or entry[0] != settings:
+                entry = clients[key] = (settings, create(settings))
+            return entry[1]
+
+    def _http_client_kwargs(self, settings, http_client_class, on_request):
+        if httpx is None:
+            return {}
+        size, http2 = settings
+        limits = httpx.Limits(max_connections=size, max_keepalive_connections=size,
+                              keepalive_expiry=self.keepalive_expiry)
+        return {"http_client": http_client_class(limits=limits, http2=http2, event_hooks={"request": [on_request]})}
+
+    def client(self, api_key: str, base_url: str = None, max_retries: int = 0) -> openai.OpenAI:
+        key = (api_key, base_url, max_retries)
+        return self._shared(self._clients, key, base_url, lambda settings: openai.OpenAI(
+            api_key=api_key, base_url=base_url, max_retries=max_retries,
+            **self._http_client_kwargs(settings, getattr(openai, "DefaultHttpxClient", None), self._trace_request)))
+
+    def async_client(self, api_key: str, base_url: str = None) -> openai.AsyncOpenAI:
+        """Async client of the running event loop (async connections cannot move between loops)."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+        return self._shared(clients, (api_key, base_url), base_url, lambda settings: openai.AsyncOpenAI(
+            api_key=api_key, base_url=base_url, max_retries=0,
+            **self._http_client_kwargs(settings, getattr(openai, "DefaultAsyncHttpxClient", None),
+                                       self._trace_async_request)))
+
+    async def aclose(self) -> None:
+        """Close the async clients of the running event loop, e.g. before asyncio.run() closes it."""
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for _, client in clients.values():
+            await client.close()
+
+    def _trace_request(self, request):
+        request.extensions["trace"] = self._tracer()
+
+    async def _trace_async_request(self, request):
+        trace = self._tracer()
+
+        async def async_trace(event, info):
+            trace(event, info)
+        request.extensions["trace"] = async_trace
+
+    def _tracer(self):
+        """Trace callback of one request; a request that had to connect first counts as a new connection."""
+        connect_started = []
+
+        def trace(event, info):
+            if event == "connection.connect_tcp.started":
+                connect_started.append(time.monotonic())
+            elif event == "connection.start_tls.started":
+                self._count("tls_handshakes")
+            elif event.endswith(".send_request_headers.started"):
+                handshake = time.monotonic() - connect_started[0] if connect_started else None
+                self._record_request("HTTP/2" if event.startswith("http2") else "HTTP/1.1", handshake)
+                connect_started.clear()
+        return trace
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _record_request(self, version, handshake):
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats[version] += 1
+            if handshake is not None:
+                self.stats["connections"] += 1
+                self.stats["handshake_seconds"] += handshake
+            metrics = self.metrics
+        if metrics is not None:
+            metrics.inc("maestro_http_requests_total", http_version=version,
+                        connection="new" if handshake is not None else "reused")
+            if handshake is not None:
+                metrics.inc("maestro_http_handshake_seconds_total", handshake)
+
+    def format_stats(self) -> str:
+        if httpx is None:
+            return "[HTTP] Connection reuse is not traced without httpx"
+        with self._lock:
+            stats = dict(self.stats)
+        requests = stats.get("requests", 0)
+        connections = stats.get("connections", 0)
+        if not requests:
+            return "[HTTP] No requests sent"
+        return (f"[HTTP] {requests} requests on {connections} new connections "
+                f"({1 - connections / requests:.1%} reused, {stats.get('HTTP/2', 0) / requests:.0%} over HTTP/2, "
+                f"{stats.get('tls_handshakes', 0)} TLS handshakes); connecting took "
+                f"{stats.get('handshake_seconds', 0.0) / connections * 1000 if connections else 0:.1f} ms on average")
+
+
+# Shared by every agent in the process so trials reuse each other's connections
+HTTP_CLIENTS = HttpClientPool()
+
+
+class AgentEventLoop:
+    """
+    Event loop on a daemon thread that runs the coroutines of agents called from threads. The agents are
+    written once, as coroutines; a thread blocks on its own agent's coroutine while the loop interleaves the
+    calls of every thread, on the async clients of HTTP_CLIENTS. The loop starts on first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def _running_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="agent-event-loop", daemon=True).start()
+            return self._loop
+
+    def run(self, coroutine):
+        """Run a coroutine on the loop and block the calling thread until it returns or raises."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._running_loop()).result()
+
+
+# Shared by the agents of every threaded batch in the process
+AGENT_EVENT_LOOP = AgentEventLoop()
+
+
+class ConcurrencySlot:
+    """One in-flight call admitted by an AdaptiveConcurrencyLimit, with the outcome reported back to it."""
+
+    def __init__(self, in_flight: int):
+        self.started = time.monotonic()
+        self.in_flight = in_flight  # Calls in flight when this one was admitted, itself included
+        self.seconds = None
+        self.completion_tokens = 0
+
+    def record(self, seconds: float, completion_tokens: int = 0) -> None:
+        """Report a successful call's duration and output size."""
+        self.seconds = seconds
+        self.completion_tokens = completion_tokens or 0
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Additive-increase/multiplicative-decrease limit on the calls in flight to one model.
+    While calls use the whole window and finish with healthy latency, the limit grows by about one call per
+    window of successes. A 429 or a timeout cuts it by `backoff`, at most
+    once per window: calls that were already in flight when it was cut do not cut it again. Latency is
+    compared per output token against a slow moving average, so long A2 parts do not look like congestion.
+    A limit with min_limit == max_limit is a fixed semaphore. Threads and coroutines can share one limit.
+    """
+
+    def __init__(self, model_name: str, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64,
+                 backoff: float = 0.7, latency_tolerance: float = 2.0, metrics=None):
+        self.model_name = model_name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial_limit)))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.metrics = metrics
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._async_waiters = []  # (loop, future) of coroutines waiting for a slot
+        self._last_decrease = 0.0
+        self._baseline = None  # Moving average of seconds per output token
+        self._publish(None, int(self.limit), "initial")
+
+    @property
+    def adaptive(self) -> bool:
+        return self.min_limit < self.max_limit
+
+    def _try_admit(self):
+        """Take a slot if the limit allows one; returns the slot or None. Caller holds the condition."""
+        if self.in_flight >= int(self.limit):
+            return None
+        self.in_flight += 1
+        return ConcurrencySlot(self.in_flight)
+
+    def acquire(self) -> ConcurrencySlot:
+        """Block the calling thread until a slot is free."""
+        with self._condition:
+            slot = self._try_admit()
+            while slot is None:
+                self._condition.wait()
+                slot = self._try_admit()
+            return slot
+
+    async def acquire_async(self) -> ConcurrencySlot:
+        """Wait on the event loop until a slot is free."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                slot = self._try_admit()
+                if slot is not None:
+                    return slot
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def _wake_waiters(self) -> None:
+        """Let every waiting thread and coroutine re-check the limit. Caller holds the condition."""
+        self._condition.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+
+    @staticmethod
+    def overload_reason(error):
+        """Why an exception means the model is overloaded, or None for errors unrelated to load."""
+        if isinstance(error, openai.RateLimitError):
+            return "rate_limit"
+        if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError, TimeoutError)):
+            return "timeout"
+        return None
+
+    def release(self, slot: ConcurrencySlot, error: BaseException = None) -> None:
+        """Free a slot and adapt the limit to how its call went."""
+        reason = self.overload_reason(error) if error is not None else None
+        with self._condition:
+            self.in_flight -= 1
+            old_limit = int(self.limit)
+            if reason is not None:
+                if slot.started >= self._last_decrease:
+                    self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                    self._last_decrease = time.monotonic()
+            elif slot.seconds is not None:
+                per_token = slot.seconds / max(1, slot.completion_tokens)
+                healthy = self._baseline is None or per_token <= self._baseline * self.latency_tolerance
+                self._baseline = per_token if self._baseline is None else 0.95 * self._baseline + 0.05 * per_token
+                # Only grow while the current window is actually used
+                if healthy and slot.in_flight >= int(self.limit) - 1:
+                    self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            new_limit = int(self.limit)
+            self._wake_waiters()
+        if new_limit != old_limit:
+            self._publish(old_limit, new_limit, reason or "healthy")
+
+    def _publish(self, old_limit, new_limit, reason) -> None:
+        if self.metrics is not None:
+            self.metrics.add("maestro_concurrency_limit", new_limit - (old_limit or 0), model=self.model_name)
+            if old_limit is not None and new_limit < old_limit:
+                self.metrics.inc("maestro_concurrency_backoffs_total", reason=reason, model=self.model_name)
+        if old_limit is not None and self.adaptive:
+            print(f"[Concurrency] {self.model_name}: limit {old_limit} -> {new_limit} ({reason})")
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a slot for the body of a with block; the body reports success through slot.record()."""
+        slot = self.acquire()
+        try:
+            yield slot
+        except BaseException as e:
+            self.release(slot, e)
+            raise
+        self.release(slot)
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self):
+        """Async counterpart of slot()."""
+        slot = await self.acquire_async()
+        try:
+            yield slot
+        except BaseException as e:
+            self.release(slot, e)
+            raise
+        self.release(slot)
+
+
+class HedgePolicy:
+    """
+    Decides when a slow call is duplicated ("hedged") and keeps the numbers to report on it.
+    Once a stage has min_samples observed latencies, a call still running after the given percentile of them
+    gets a duplicate request; the first copy to finish wins and the other is cancelled. Hedges are refused once
+    they would exceed max_ratio of the stage's calls, which caps the extra spend. Callers skip hedging while the
+    model has no free concurrency slot, since a queued duplicate cannot beat the original.
+    """
+
+    def __init__(self, percentile: float = 95.0, min_samples: int = 20, max_ratio: float = 0.1,
+                 stages: Tuple = ("A2", "A2-cont"), window: int = 500):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.stages = stages
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = {}  # stage -> recent call latencies in seconds
+        self.calls = Counter()
+        self.hedges = Counter()
+        self.wins = Counter()  # Hedges whose duplicate finished first
+        self.refused = Counter()  # Hedges skipped because of max_ratio
+
+    # How often a running call re-checks the threshold while the stage has too few samples for one
+    POLL_SECONDS = 0.5
+
+    def begin(self, stage: str) -> None:
+        with self._lock:
+            self.calls[stage] += 1
+
+    def threshold(self, stage: str):
+        """Seconds after which a call of the stage is hedged, or None while there are too few samples."""
+        with self._lock:
+            latencies = self._latencies.get(stage, [])
+            if len(latencies) < self.min_samples:
+                return None
+            return _percentile(latencies, self.percentile)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            latencies = self._latencies.setdefault(stage, [])
+            latencies.append(seconds)
+            if len(latencies) > self.window:
+                del latencies[0]
+
+    def allow_hedge(self, stage: str) -> bool:
+        """Take a hedge from the spend cap if there is one left."""
+        with self._lock:
+            if self.hedges[stage] + 1 > self.max_ratio * self.calls[stage]:
+                self.refused[stage] += 1
+                return False
+            self.hedges[stage] += 1
+            return True
+
+    def record_winner(self, stage: str, hedge_won: bool) -> None:
+        if hedge_won:
+            with self._lock:
+                self.wins[stage] += 1
+
+    def format_summary(self) -> str:
+        with self._lock:
+            lines = [f"{'Hedged stage':<14} {'Calls':>7} {'Hedged':>8} {'Rate':>7} {'Won':>6} {'Win rate':>9} "
+                     f"{'Capped':>7}"]
+            for stage in sorted(self.calls):
+                calls, hedges, wins = self.calls[stage], self.hedges[stage], self.wins[stage]
+                lines.append(f"{stage:<14} {calls:>7} {hedges:>8} {hedges / calls if calls else 0:>7.1%} "
+                             f"{wins:>6} {wins / hedges if hedges else 0:>9.1%} {self.refused[stage]:>7}")
+        return "\n".join(lines)
+
+
+# Metric name -> (Prometheus type, help text)
+METRIC_DEFINITIONS = {
+    "maestro_call_seconds": ("histogram", "Duration of successful model calls, including streaming"),
+    "maestro_queue_wait_seconds": ("histogram", "Time a call waited for the rate limiter and a concurrency slot"),
+    "maestro_prompt_tokens_total": ("counter", "Prompt tokens reported by the API"),
+    "maestro_completion_tokens_total": ("counter", "Completion tokens reported by the API"),
+    "maestro_finish_reasons_total": ("counter", "Completed calls by finish_reason"),
+    "maestro_retries_total": ("counter", "Calls retried after a rate limit or an error"),
+    "maestro_call_failures_total": ("counter", "Calls given up after the last retry"),
+    "maestro_cache_hits_total": ("counter", "Calls answered from the response cache"),
+    "maestro_calls_queued": ("gauge", "Calls waiting for the rate limiter or a concurrency slot"),
+    "maestro_calls_in_flight": ("gauge", "Calls currently sent to the API"),
+    "maestro_concurrency_limit": ("gauge", "Adaptive limit on calls in flight per model"),
+    "maestro_concurrency_backoffs_total": ("counter", "Concurrency limit cuts after a 429 or a timeout"),
+    "maestro_playability_issues_total": ("counter", "Measures left with notes outside the instrument's range or polyphony"),
+    "maestro_hedged_calls_total": ("counter", "Slow calls sent a second time, by which copy finished first"),
+    "maestro_rss_bytes": ("gauge", "Resident memory of the batch process"),
+    "maestro_rss_mean_per_inflight_task_bytes": ("gauge", "Mean RSS per in-flight task: resident memory over the "
+                                                          "baseline divided by the tasks in flight"),
+    "maestro_memory_holds_total": ("counter", "New tasks held back because the mean RSS per in-flight task was at its cap"),
+    "maestro_cpu_tasks_total": ("counter", "Post-processing tasks run by the CPU worker pool, by how arguments were sent"),
+    "maestro_cpu_task_seconds": ("histogram", "Time CPU worker processes spent on a post-processing task"),
+    "maestro_http_requests_total": ("counter", "HTTP requests to the API, by protocol and whether they opened a connection"),
+    "maestro_http_handshake_seconds_total": ("counter", "Time spent opening connections (TCP, TLS and HTTP/2 setup)"),
+    "maestro_stage_queued": ("gauge", "Pipeline tasks waiting for a stage worker"),
+    "maestro_stage_active": ("gauge", "Pipeline tasks being processed by a stage worker"),
+    "maestro_task_seconds": ("histogram", "Start-to-finish duration of successful tasks"),
+    "maestro_tasks_total": ("counter", "Finished tasks by outcome"),
+}
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters, gauges and latency histograms, labelled by stage and model.
+    Every agent of a batch records its API calls here; render_prometheus() gives the Prometheus text format and
+    summary() a per-stage, per-model digest for the end-of-run JSON report.
+    """
+
+    def __init__(self, buckets: Tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # (name, sorted label items) -> counter or gauge value
+        self._histograms = {}  # (name, sorted label items) -> {"counts": [...], "sum": s, "count": n, "max": m}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def add(self, name: str, amount: float, **labels) -> None:
+        """Move a gauge up or down."""
+        self.inc(name, amount, **labels)
+
+    @contextlib.contextmanager
+    def track(self, name: str, **labels):
+        """Count the body of a with block in a gauge while it runs."""
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0, "max": 0.0}
+                self._histograms[key] = histogram
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            histogram["counts"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+            histogram["max"] = max(histogram["max"], value)
+
+    @staticmethod
+    def _format_labels(label_items, extra=()):
+        items = list(label_items) + list(extra)
+        if not items:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: dict(h, counts=list(h["counts"])) for key, h in self._histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            series = sorted(key for key in (histograms if metric_type == "histogram" else values) if key[0] == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key in series:
+                labels = key[1]
+                if metric_type != "histogram":
+                    lines.append(f"{name}{self._format_labels(labels)} {values[key]:g}")
+                    continue
+                histogram = histograms[key]
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram["counts"]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else f"{bound:g}"
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def _quantile(self, histogram, q):
+        """Upper bound of the bucket holding the q-quantile (the largest observation for the last bucket)."""
+        target = q * histogram["count"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, histogram["counts"]):
+            cumulative += count
+            if cumulative >= target:
+                return round(min(bound, histogram["max"]), 3)
+        return round(histogram["max"], 3)
+
+    def summary(self) -> Dict:
+        """Per-stage and per-model call statistics plus task totals, as plain JSON-friendly dicts."""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: dict(h, counts=list(h["counts"])) for key, h in self._histograms.items()}
+
+        stages = {}
+
+        def entry(label_items):
+            labels = dict(label_items)
+            return stages.setdefault(labels.get("stage", "other"), {}).setdefault(labels.get("model", "other"), {
+                "calls": 0, "call_seconds": 0.0, "mean_seconds": None, "p50_seconds": None, "p95_seconds": None,
+                "max_seconds": None, "queue_wait_seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0,
+                "retries": {}, "failures": 0, "cache_hits": 0, "finish_reasons": {}})
+
+        for (name, label_items), histogram in histograms.items():
+            if name == "maestro_call_seconds":
+                stats = entry(label_items)
+                stats.update(call_seconds=round(histogram["sum"], 3),
+                             mean_seconds=round(histogram["sum"] / histogram["count"], 3),
+                             p50_seconds=self._quantile(histogram, 0.5), p95_seconds=self._quantile(histogram, 0.95),
+                             max_seconds=round(histogram["max"], 3))
+            elif name == "maestro_queue_wait_seconds":
+                entry(label_items)["queue_wait_seconds"] = round(histogram["sum"], 3)
+
+        tasks = {}
+        for (name, label_items), value in values.items():
+            labels = dict(label_items)
+            if name == "maestro_prompt_tokens_total":
+                entry(label_items)["prompt_tokens"] = int(value)
+            elif name == "maestro_completion_tokens_total":
+                entry(label_items)["completion_tokens"] = int(value)
+            elif name == "maestro_retries_total":
+                entry(label_items)["retries"][labels.get("reason", "other")] = int(value)
+            elif name == "maestro_call_failures_total":
+                entry(label_items)["failures"] = int(value)
+            elif name == "maestro_cache_hits_total":
+                entry(label_items)["cache_hits"] = int(value)
+            elif name == "maestro_finish_reasons_total":
+                entry(label_items)["finish_reasons"][labels.get("finish_reason", "none")] = int(value)
+                entry(label_items)["calls"] += int(value)
+            elif name == "maestro_tasks_total":
+                tasks[labels.get("outcome", "other")] = int(value)
+
+        task_histogram = next((h for (name, _), h in histograms.items() if name == "maestro_task_seconds"), None)
+        if task_histogram:
+            tasks.update(mean_seconds=round(task_histogram["sum"] / task_histogram["count"], 3),
+                         p50_seconds=self._quantile(task_histogram, 0.5),
+                         p95_seconds=self._quantile(task_histogram, 0.95))
+        return {"stages": stages, "tasks": tasks}
+
+    @staticmethod
+    def format_summary(summary: Dict) -> str:
+        """One line per stage and model: calls, time spent and tokens, busiest stages first."""
+        rows = [(stage, model, stats) for stage, models in summary["stages"].items() for model, stats in models.items()]
+        rows.sort(key=lambda row: row[2]["call_seconds"], reverse=True)
+        lines = [f"{'Stage':<8} {'Calls':>6} {'Seconds':>9} {'p95':>7} {'Prompt tok':>11} {'Compl. tok':>11} "
+                 f"{'Retries':>8}  Model"]
+        for stage, model, stats in rows:
+            p95 = f"{stats['p95_seconds']:g}" if stats["p95_seconds"] is not None else "n/a"
+            lines.append(f"{stage:<8} {stats['calls']:>6} {stats['call_seconds']:>9.1f} {p95:>7} "
+                         f"{stats['prompt_tokens']:>11} {stats['completion_tokens']:>11} "
+                         f"{sum(stats['retries'].values()):>8}  {model}")
+        return "\n".join(lines)
+
+
+class MetricsServer:
+    """Serves a MetricsRegistry at /metrics in the Prometheus text format from a background thread."""
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9464):
+        self.registry = registry
+        self._server = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="metrics-server").start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+# Output tokens per measure assumed for each stage and instrument family until past runs provide statistics
+TOKEN_BUDGET_PRIORS = {
+    "A1": 80, "B1": 80, "B2": 120,
+    "A2:keyboard": 260, "A2:strings": 170, "A2:winds": 170, "A2:brass": 160, "A2:percussion": 130,
+    "A2:voice": 200, "A2:other": 220,
+}
+# Keywords of each instrument family; woodwinds come before brass so "English horn" is not read as a horn
+INSTRUMENT_FAMILIES = {
+    "keyboard": ("piano", "organ", "harpsichord", "celesta", "keyboard", "right hand", "left hand"),
+    "strings": ("violin", "viola", "cello", "double bass", "contrabass", "string", "harp", "guitar"),
+    "winds": ("flute", "piccolo", "oboe", "english horn", "clarinet", "bassoon", "saxophone", "recorder", "woodwind"),
+    "brass": ("trumpet", "horn", "trombone", "tuba", "euphonium", "cornet", "brass"),
+    "percussion": ("timpani", "drum", "percussion", "cymbal", "xylophone", "marimba", "glockenspiel", "vibraphone"),
+    "voice": ("soprano", "alto", "tenor", "baritone", "voice", "choir", "vocal"),
+}
+
+
+class TokenBudget:
+    """max_tokens chosen for one call, with what the budgeter needs to learn from the call's outcome."""
+
+    def __init__(self, key: str, measures, overhead: int, max_tokens: int, ceiling: int):
+        self.key = key
+        self.measures = measures
+        self.overhead = overhead
+        self.max_tokens = max_tokens
+        self.ceiling = ceiling  # The stage's flat max_tokens
+
+
+class TokenBudgeter:
+    """
+    Chooses max_tokens per call from the number of measures it has to write, instead of a flat limit per stage.
+    Output tokens per measure are tracked per stage and instrument family (running mean and variance, seeded
+    with priors and saved across runs). A call gets overhead + measures x (mean + one standard deviation) x a
+    safety margin, capped at the stage's max_tokens. The margin grows whenever a call is truncated and decays
+    slowly while calls finish, keeping truncations rare while the rate limiter reserves far fewer tokens per
+    call. Calls with no known measure count keep the stage's flat max_tokens.
+    """
+
+    PRIOR_WEIGHT = 3  # Pseudo-observations given to the prior
+    HEADER_TOKENS = 400  # XML header and part-list written with the first part
+    PART_OVERHEAD_TOKENS = 120  # <part> wrapper, first-measure attributes and closing tags
+    OUTLINE_OVERHEAD_TOKENS = 300
+
+    def __init__(self, stats_path: str = None, min_tokens: int = 1024, initial_margin: float = 1.3,
+                 min_margin: float = 1.15, max_margin: float = 3.0, save_every: int = 20):
+        self.stats_path = stats_path
+        self.min_tokens = min_tokens
+        self.initial_margin = initial_margin
+        self.min_margin = min_margin
+        self.max_margin = max_margin
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.stats = self._load()  # key -> {"count", "mean", "m2", "margin", "calls", "truncated"}
+
+    def _load(self) -> Dict:
+        if not self.stats_path or not os.path.exists(self.stats_path):
+            return {}
+        try:
+            with open(self.stats_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        if not self.stats_path:
+            return
+        with self._lock:
+            data = json.dumps(self.stats, indent=2)
+            self._unsaved = 0
+        temp_path = f"{self.stats_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, self.stats_path)
+
+    @staticmethod
+    def instrument_family(description: str) -> str:
+        """Instrument family named earliest in a part description, or "other"."""
+        text = (description or "")[:400].lower()
+        best, best_position = "other", len(text) + 1
+        for family, keywords in INSTRUMENT_FAMILIES.items():
+            for keyword in keywords:
+                position = text.find(keyword)
+                if 0 <= position < best_position:
+                    best, best_position = family, position
+        return best
+
+    def stats_key(self, stage: str, description: str = "") -> str:
+        base_stage = stage.split("-")[0]  # Continuations and repairs write the same XML as A2
+        if base_stage == "A2":
+            return f"A2:{self.instrument_family(description)}"
+        return base_stage
+
+    def _entry(self, key: str) -> Dict:
+        entry = self.stats.get(key)
+        if entry is None:
+            prior = TOKEN_BUDGET_PRIORS.get(key, TOKEN_BUDGET_PRIORS["A2:other"])
+            entry = {"count": self.PRIOR_WEIGHT, "mean": float(prior),
+                     "m2": (0.3 * prior) ** 2 * (self.PRIOR_WEIGHT - 1),
+                     "margin": self.initial_margin, "calls": 0, "truncated": 0}
+            self.stats[key] = entry
+        return entry
+
+    def plan(self, stage: str, measures=None, description: str = "", ceiling: int = 16384,
+             with_header: bool = False) -> TokenBudget:
+        """Budget for a call writing `measures` measures (None when unknown, which keeps the ceiling)."""
+        key = self.stats_key(stage, description)
+        if key.startswith("A2"):
+            overhead = self.PART_OVERHEAD_TOKENS + (self.HEADER_TOKENS if with_header else 0)
+        else:
+            overhead = self.OUTLINE_OVERHEAD_TOKENS
+        if not measures:
+            return TokenBudget(key, None, overhead, ceiling, ceiling)
+
+        with self._lock:
+            entry = self._entry(key)
+            deviation = math.sqrt(entry["m2"] / max(1, entry["count"] - 1))
+            per_measure = (entry["mean"] + deviation) * entry["margin"]
+        max_tokens = int(overhead + measures * per_measure)
+        max_tokens = max(min(self.min_tokens, ceiling), min(ceiling, max_tokens))
+        return TokenBudget(key, measures, overhead, max_tokens, ceiling)
+
+    def record(self, budget: TokenBudget, completion_tokens: int, finish_reason: str) -> None:
+        """Learn from a finished call: widen the margin on truncation, otherwise update tokens per measure."""
+        with self._lock:
+            entry = self._entry(budget.key)
+            entry["calls"] += 1
+            if finish_reason == "length":
+                entry["truncated"] += 1
+                # Only a call cut off below the ceiling was under-budgeted; at the ceiling it needs a continuation anyway
+                if budget.max_tokens < budget.ceiling:
+                    entry["margin"] = min(self.max_margin, entry["margin"] * 1.25)
+            elif budget.measures:
+                value = max(0, completion_tokens - budget.overhead) / budget.measures
+                entry["count"] += 1
+                delta = value - entry["mean"]
+                entry["mean"] += delta / entry["count"]
+                entry["m2"] += delta * (value - entry["mean"])
+                entry["margin"] = max(self.min_margin, entry["margin"] * 0.98)
+            self._unsaved += 1
+            save_now = self._unsaved >= self.save_every
+        if save_now:
+            self.save()
+
+    def format_summary(self) -> str:
+        with self._lock:
+            entries = sorted(self.stats.items())
+        lines = [f"{'Budget key':<14} {'Tok/measure':>12} {'Margin':>7} {'Truncated':>12}"]
+        for key, entry in entries:
+            deviation = math.sqrt(entry["m2"] / max(1, entry["count"] - 1))
+            lines.append(f"{key:<14} {entry['mean']:>6.0f} ±{deviation:<5.0f} {entry['margin']:>7.2f} "
+                         f"{entry['truncated']:>5}/{entry['calls']:<6}")
+        return "\n".join(lines)
+
+
+class ResponseCache:
+    """
+    Persistent content-addressed cache of model responses.
+    Each entry is a JSON file named by the SHA-256 of the request; least recently used entries are
+    evicted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+        self.hits = Counter()
+        self.misses = Counter()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Rebuild the LRU order from file modification times."""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, filename))
+            entries.append((stat.st_mtime, filename[:-5], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    @staticmethod
+    def make_key(model_name, system_prompt, messages, temperature, top_p, max_tokens, sample=None) -> str:
+        """Hash every request setting that affects the response."""
+        request = {
+            "model": model_name,
+            "system_prompt": system_prompt,
+            "messages": messages,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
+            "sample": sample
+        }
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key: str, stage: str = None):
+        """Return the cached response for a key, or None on a miss."""
+        with self._lock:
+            if key not in self._index:
+                self.misses[stage] += 1
+                return None
+            self._index.move_to_end(key)
+
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            # Entry was evicted or corrupted by another process
+            with self._lock:
+                self._total_bytes -= self._index.pop(key, 0)
+                self.misses[stage] += 1
+            return None
+
+        with self._lock:
+            self.hits[stage] += 1
+        return entry["content"]
+
+    def put(self, key: str, content: str, model_name: str = None, stage: str = None) -> None:
+        """Store a response and evict least recently used entries beyond the size limit."""
+        data = json.dumps({"model": model_name, "stage": stage, "content": content}, ensure_ascii=False)
+        temp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, self._path(key))
+        size = os.path.getsize(self._path(key))
+
+        with self._lock:
+            self._total_bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._index) > 1:
+                old_key, old_size = self._index.popitem(last=False)
+                self._total_bytes -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def format_stats(self) -> str:
+        """Summarise hit/miss counters per stage."""
+        with self._lock:
+            stages = sorted(set(self.hits) | set(self.misses), key=str)
+            lines = [f"[Cache] {len(self._index)} entries, {self._total_bytes / (1024 * 1024):.1f} MB in {self.cache_dir}"]
+            for stage in stages:
+                lines.append(f"[Cache] {stage}: {self.hits[stage]} hits, {self.misses[stage]} misses")
+        return "\n".join(lines)
+
+
+class CheckpointJournal:
+    """
+    Append-only JSONL journal of completed stages for every batch task.
+    Records are written by a writer thread as soon as a stage or A2 part finishes, so a run that is killed
+    can be restarted and pick up from the last completed stage of every task. Callers never wait for the
+    disk: records appended while a batch is being written are written and fsynced together as the next one.
+    With index_only, stage outputs and parts are not kept in memory: the journal remembers the file offset
+    of their record and reads it back when a resumed task asks for it.
+    """
+
+    def __init__(self, path: str, index_only: bool = False):
+        self.path = path
+        self.index_only = index_only
+        self._lock = threading.Lock()
+        self._written_changed = threading.Condition(self._lock)
+        self._tasks = {}
+        self._load()
+        self._file = open(self.path, 'ab')
+
+        # Terminate a line cut short by a killed run so the next record starts on its own line
+        if self._file.tell() > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write(b"\n")
+                    self._file.flush()
+
+        # Lines appended but not yet written; _end is the file offset after them, _written after the last batch
+        self._pending = []
+        self._end = self._written = self._file.tell()
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-writer")
+
+    def _task_state(self, task_key):
+        return self._tasks.setdefault(task_key, {"stages": {}, "parts": {}, "done": False})
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short if the process was killed while writing it
+                    record = None
+                if record is not None:
+                    self._apply(record, offset)
+                offset += len(line)
+
+    def _apply(self, record, offset):
+        state = self._task_state(record["task"])
+        if record["event"] == "stage":
+            state["stages"][record["stage"]] = offset if self.index_only else record["output"]
+        elif record["event"] == "part":
+            state["parts"][record["part"]["part_number"]] = offset if self.index_only else record["part"]
+        elif record["event"] == "done":
+            state["done"] = True
+
+    def _read_record(self, offset):
+        with self._lock:
+            self._written_changed.wait_for(lambda: self._written > offset)
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def _append(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            offset = self._end
+            self._end += len(line)
+            self._pending.append(line)
+            self._apply(record, offset)
+            if len(self._pending) == 1:
+                self._writer.submit(self._write_pending)
+
+    def _write_pending(self):
+        """Write and fsync every line appended since the last batch (runs on the writer thread)."""
+        with self._lock:
+            lines, self._pending = self._pending, []
+        if not lines:
+            return
+        data = b"".join(lines)
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            print(f"[Journal] Could not write {len(lines)} records to {self.path}: {e}")
+        with self._lock:
+            self._written += len(data)
+            self._written_changed.notify_all()
+
+    def flush(self) -> None:
+        """Block until every record appended so far is on disk."""
+        with self._lock:
+            end = self._end
+            self._written_changed.wait_for(lambda: self._written >= end)
+
+    def record_stage(self, task_key: str, stage: str, output: str) -> None:
+        self._append({"task": task_key, "event": "stage", "stage": stage, "output": output})
+
+    def record_part(self, task_key: str, part_result: Dict) -> None:
+        """Record a part as its responses, each with the assembler segment it was parsed as (None: the part text)."""
+        part = {key: part_result[key] for key in ("part_name", "part_content", "part_number")}
+        part["segments"] = [[segment, str(text)] for segment, text in part_result["segments"]]
+        part["finish_reason"] = part_result.get("finish_reason")
+        self._append({"task": task_key, "event": "part", "part": part})
+
+    def record_done(self, task_key: str, aborted_reason: str = None) -> None:
+        """Mark a task finished; aborted trials are recorded with the reason and not retried either."""
+        record = {"task": task_key, "event": "done"}
+        if aborted_reason:
+            record["aborted"] = aborted_reason
+        self._append(record)
+
+    def stage_output(self, task_key: str, stage: str):
+        with self._lock:
+            output = self._tasks.get(task_key, {}).get("stages", {}).get(stage)
+        if self.index_only and output is not None:
+            output = self._read_record(output)["output"]
+        return output
+
+    def part_result(self, task_key: str, part_number: int):
+        with self._lock:
+            part = self._tasks.get(task_key, {}).get("parts", {}).get(part_number)
+        if self.index_only and part is not None:
+            part = self._read_record(part)["part"]
+        return dict(part) if part else None
+
+    def is_done(self, task_key: str) -> bool:
+        with self._lock:
+            return self._tasks.get(task_key, {}).get("done", False)
+
+    def close(self) -> None:
+        self._writer.shutdown()
+        with self._lock:
+            self._file.close()
+
+
+class ConversationStore:
+    """
+    SQLite store of every conversation message, indexed by category, prompt, trial, stage, model and
+    sampling settings. Agents hand each message over as soon as it is recorded and a writer thread stores
+    it, committing everything handed over meanwhile in one transaction; content is zlib-compressed.
+    query() streams matching rows from its own read connection, so pulling e.g. every B2 output of one
+    category never loads the rest of the corpus, and writers are not blocked while it runs (WAL mode).
+    A trial is rewritten from its first message when it is rerun or resumed.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            category_id INTEGER NOT NULL,
+            prompt_id INTEGER NOT NULL,
+            trial INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            model TEXT,
+            temperature REAL,
+            top_p REAL,
+            chars INTEGER NOT NULL,
+            content BLOB NOT NULL,
+            written REAL NOT NULL,
+            PRIMARY KEY (category_id, prompt_id, trial, seq)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_by_stage ON messages (stage, category_id, temperature);
+        CREATE INDEX IF NOT EXISTS messages_by_model ON messages (model, stage, temperature, top_p);
+    """
+    COLUMNS = ("category_id", "prompt_id", "trial", "seq", "role", "stage", "model", "temperature", "top_p",
+               "chars", "content", "written")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+        # Writes waiting for the writer thread, as (method, args)
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="store-writer")
+
+    def _submit(self, write, *args):
+        with self._pending_lock:
+            self._pending.append((write, args))
+            if len(self._pending) == 1:
+                self._writer.submit(self._write_pending)
+
+    def _write_pending(self):
+        """Run every write handed over since the last batch in one transaction (runs on the writer thread)."""
+        with self._pending_lock:
+            writes, self._pending = self._pending, []
+        if not writes:
+            return
+        with self._lock:
+            try:
+                with self._connection:
+                    for write, args in writes:
+                        write(*args)
+            except sqlite3.Error as e:
+                print(f"[Store] Could not write {len(writes)} changes to {self.path}: {e}")
+
+    def flush(self) -> None:
+        """Block until every write handed over so far is committed."""
+        self._writer.submit(self._write_pending).result()
+
+    @staticmethod
+    def message_stage(role: str) -> str:
+        """Stage of a conversation role: "Model B2" is B2, "Model A2 (Cont. - Violin P2)" is A2-cont."""
+        match = re.match(r"Model (\w+)(?: \((\w+)\.? -)?", role)
+        if not match:
+            return role
+        return f"{match.group(1)}-{match.group(2).lower()}" if match.group(2) else match.group(1)
+
+    def write_messages(self, category_id, prompt_id, trial: int, first_seq: int, messages: List[Dict]) -> None:
+        """
+        Store conversation messages from position first_seq on. Each message has role and content and
+        optionally model, temperature and top_p.
+        """
+        self._submit(self._insert_messages, int(category_id), int(prompt_id), trial, first_seq, list(messages))
+
+    def _insert_messages(self, category_id, prompt_id, trial, first_seq, messages):
+        rows = [(category_id, prompt_id, trial, first_seq + offset, message["role"],
+                 self.message_stage(message["role"]), message.get("model"), message.get("temperature"),
+                 message.get("top_p"), len(message["content"]), zlib.compress(message["content"].encode("utf-8")),
+                 time.time())
+                for offset, message in enumerate(messages)]
+        self._connection.executemany(
+            f"INSERT OR REPLACE INTO messages VALUES ({', '.join('?' * len(self.COLUMNS))})", rows)
+
+    def clear_trial(self, category_id, prompt_id, trial: int) -> None:
+        self._submit(self._delete_trial, int(category_id), int(prompt_id), trial)
+
+    def _delete_trial(self, category_id, prompt_id, trial):
+        self._connection.execute("DELETE FROM messages WHERE category_id = ? AND prompt_id = ? AND trial = ?",
+                                 (category_id, prompt_id, trial))
+
+    def copy_trial(self, source: Tuple, target: Tuple, trial: int) -> None:
+        """Store a trial's messages again under another (category_id, prompt_id)."""
+        self._submit(self._copy_trial, int(source[0]), int(source[1]), int(target[0]), int(target[1]), trial)
+
+    def _copy_trial(self, source_category_id, source_prompt_id, category_id, prompt_id, trial):
+        columns = ", ".join(self.COLUMNS[3:])
+        self._delete_trial(category_id, prompt_id, trial)
+        self._connection.execute(
+            f"INSERT INTO messages SELECT ?, ?, trial, {columns} FROM messages "
+            f"WHERE category_id = ? AND prompt_id = ? AND trial = ?",
+            (category_id, prompt_id, source_category_id, source_prompt_id, trial))
+
+    def query(self, stage: str = None, category_id=None, prompt_id=None, trial: int = None, model: str = None,
+              temperature: float = None, top_p: float = None, role: str = None, with_content: bool = True):
+        """
+        Yield the matching messages as dicts, in (category, prompt, trial, position) order.
+        For example query(stage="B2", category_id=5, temperature=0.9) gives every B2 output of category 5
+        sampled at temperature 0.9. Without with_content only the index columns and sizes are read.
+        """
+        self.flush()
+        conditions, values = [], []
+        for column, value in (("stage", stage), ("category_id", category_id), ("prompt_id", prompt_id),
+                              ("trial", trial), ("model", model), ("role", role)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        for column, value in (("temperature", temperature), ("top_p", top_p)):
+            if value is not None:
+                conditions.append(f"abs({column} - ?) < 1e-9")
+                values.append(value)
+        columns = self.COLUMNS if with_content else tuple(c for c in self.COLUMNS if c != "content")
+        sql = (f"SELECT {', '.join(columns)} FROM messages"
+               f"{' WHERE ' + ' AND '.join(conditions) if conditions else ''} "
+               f"ORDER BY category_id, prompt_id, trial, seq")
+
+        connection = sqlite3.connect(self.path)
+        try:
+            for row in connection.execute(sql, values):
+                message = dict(zip(columns, row))
+                if with_content:
+                    message["content"] = zlib.decompress(message["content"]).decode("utf-8")
+                yield message
+        finally:
+            connection.close()
+
+    def conversation(self, category_id, prompt_id, trial: int) -> List[Dict]:
+        """One trial's conversation in the same form as the per-trial JSON files."""
+        return [{"role": message["role"], "content": message["content"]}
+                for message in self.query(category_id=category_id, prompt_id=prompt_id, trial=trial)]
+
+    def format_stats(self) -> str:
+        self.flush()
+        with self._lock:
+            messages, trials, chars, stored = self._connection.execute(
+                "SELECT count(*), count(DISTINCT category_id || '_' || prompt_id || '_' || trial), "
+                "coalesce(sum(chars), 0), coalesce(sum(length(content)), 0) FROM messages").fetchone()
+        return (f"[Store] {messages} messages from {trials} trials in {self.path} "
+                f"({chars / 2 ** 20:.1f} MiB of text stored as {stored / 2 ** 20:.1f} MiB)")
+
+    def close(self) -> None:
+        self._writer.shutdown()
+        with self._lock:
+            self._connection.close()
+
+
+class SpillBuffer:
+    """
+    Disk-backed, append-only text store for bounded-memory runs.
+    Texts are written to an anonymous temporary file as they arrive and callers keep SpilledText handles,
+    which hold only (offset, length) references and read the text back when it is needed. The file is
+    removed once the last handle is gone.
+    """
+
+    def __init__(self, directory: str = None):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._lock = threading.Lock()
+        self.size = 0
+
+    def write(self, text: str) -> "SpilledText":
+        data = text.encode("utf-8")
+        with self._lock:
+            offset = self.size
+            self._file.seek(offset)
+            self._file.write(data)
+            self.size += len(data)
+        return SpilledText(self, ((offset, len(data)),), len(text))
+
+    def read(self, offset: int, length: int) -> str:
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length).decode("utf-8")
+
+    def join(self, separator: str, texts) -> "SpilledText":
+        """Join spilled (or plain) texts without reading them back."""
+        joined = None
+        for text in texts:
+            joined = self.spill(text) if joined is None else joined + separator + text
+        return joined if joined is not None else self.write("")
+
+    def spill(self, text):
+        """A SpilledText of text, which is written only if it is not in this buffer already."""
+        if isinstance(text, SpilledText) and text.buffer is self:
+            return text
+        return self.write(str(text))
+
+
+class SpilledText:
+    """
+    Text held in a SpillBuffer as a list of (offset, length) segments.
+    Concatenation only combines segment lists, so a part that grows with every continuation is never copied;
+    str() reads the text back. Supports the few string operations the agents use on stage outputs.
+    """
+
+    __slots__ = ("buffer", "segments", "chars")
+
+    def __init__(self, buffer: SpillBuffer, segments: Tuple, chars: int):
+        self.buffer = buffer
+        self.segments = segments
+        self.chars = chars
+
+    def __str__(self) -> str:
+        return "".join(self.buffer.read(offset, length) for offset, length in self.segments)
+
+    def __len__(self) -> int:
+        return self.chars
+
+    def __add__(self, other) -> "SpilledText":
+        other = self.buffer.spill(other)
+        return SpilledText(self.buffer, self.segments + other.segments, self.chars + other.chars)
+
+    def __contains__(self, needle: str) -> bool:
+        # Segments are read one at a time, keeping the end of the previous one to find matches across the seam
+        carry = ""
+        for offset, length in self.segments:
+            chunk = carry + self.buffer.read(offset, length)
+            if needle in chunk:
+                return True
+            carry = chunk[len(chunk) - len(needle) + 1:] if len(needle) > 1 else ""
+        return False
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None where it cannot be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class MemoryMonitor:
+    """
+    Samples the resident memory of the batch process while tasks are in flight.
+    The growth over the baseline taken at start is divided by the tasks in flight at each sample: the mean
+    RSS per in-flight task. It is an even share, not what any one task allocated; each task is reported with
+    the highest mean seen while it was in flight. With max_task_bytes, new tasks wait while the mean RSS per
+    in-flight task is at that cap, so resident memory stays near the baseline plus max_task_bytes per task
+    (a task always starts when nothing else is in flight).
+    """
+
+    def __init__(self, in_flight, max_task_bytes: float = None, interval: float = 0.25,
+                 metrics: MetricsRegistry = None):
+        self.in_flight = in_flight  # Callable returning the ids of the tasks in flight
+        self.max_task_bytes = max_task_bytes
+        self.interval = interval
+        self.metrics = metrics or MetricsRegistry()
+        self.baseline = None
+        self.peak_rss = 0
+        self.task_peaks = {}  # task id -> peak mean RSS per in-flight task while it was in flight
+        self.holds = 0
+        self._gauges = {"maestro_rss_bytes": 0, "maestro_rss_mean_per_inflight_task_bytes": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self.baseline = current_rss()
+        if self.baseline is None:
+            print("[Memory] Resident memory cannot be read on this platform (install psutil); not monitoring it")
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="memory-monitor")
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def _set_gauge(self, name, value):
+        self.metrics.add(name, value - self._gauges[name])
+        self._gauges[name] = value
+
+    def sample(self) -> int:
+        """Record the current RSS against the tasks in flight; returns the RSS in bytes."""
+        rss = current_rss()
+        tasks = list(self.in_flight())
+        share = max(0, rss - self.baseline) / len(tasks) if tasks else 0
+        with self._lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            for task in tasks:
+                self.task_peaks[task] = max(self.task_peaks.get(task, 0), share)
+            self._set_gauge("maestro_rss_bytes", rss)
+            self._set_gauge("maestro_rss_mean_per_inflight_task_bytes", share)
+        return rss
+
+    def has_headroom(self) -> bool:
+        """True if another task may start under max_task_bytes."""
+        if self.max_task_bytes is None or self.baseline is None:
+            return True
+        tasks = len(self.in_flight())
+        return tasks == 0 or self.sample() - self.baseline < self.max_task_bytes * tasks
+
+    def _record_hold(self):
+        with self._lock:
+            self.holds += 1
+            if self.holds == 1:
+                print(f"[Memory] Mean RSS per in-flight task is at the {self.max_task_bytes / 2 ** 20:.0f} MiB cap; "
+                      f"holding new tasks until memory is freed")
+        self.metrics.inc("maestro_memory_holds_total")
+
+    def wait_for_headroom(self) -> None:
+        """Block a task from starting until has_headroom()."""
+        if self.has_headroom():
+            return
+        self._record_hold()
+        while not self.has_headroom():
+            time.sleep(self.interval)
+
+    async def wait_for_headroom_async(self) -> None:
+        if self.has_headroom():
+            return
+        self._record_hold()
+        while not self.has_headroom():
+            await asyncio.sleep(self.interval)
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def format_summary(self) -> str:
+        if self.baseline is None:
+            return "[Memory] Resident memory was not monitored"
+        with self._lock:
+            peaks = sorted(self.task_peaks.values())
+            holds = self.holds
+        mib = 2 ** 20
+        line = (f"[Memory] Peak RSS {self.peak_rss / mib:.1f} MiB "
+                f"({max(0, self.peak_rss - self.baseline) / mib:.1f} MiB over the {self.baseline / mib:.1f} MiB "
+                f"baseline)")
+        if peaks:
+            line += (f"; peak mean RSS per in-flight task: median {peaks[len(peaks) // 2] / mib:.1f} MiB, "
+                     f"max {peaks[-1] / mib:.1f} MiB over {len(peaks)} tasks")
+        if self.max_task_bytes is not None:
+            line += (f"; cap {self.max_task_bytes / mib:.0f} MiB mean RSS per in-flight task, "
+                     f"new tasks held {holds} times")
+        return line
+
+
+class SharedText:
+    """Handle to a string placed in shared memory, sent to a CPU worker instead of the string itself."""
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+    def read(self) -> str:
+        segment = shared_memory.SharedMemory(name=self.name)
+        try:
+            return bytes(segment.buf[:self.size]).decode("utf-8")
+        finally:
+            segment.close()
+
+
+def _run_cpu_work(fn, args):
+    """CPU pool worker: run fn on the arguments, reading shared-memory ones back; returns (result, seconds)."""
+    started = time.perf_counter()
+    args = [arg.read() if isinstance(arg, SharedText) else arg for arg in args]
+    return fn(*args), time.perf_counter() - started
+
+
+def _cpu_worker_ready():
+    return os.getpid()
+
+
+class CpuWorkerPool:
+    """
+    Worker processes for the CPU-bound post-processing of A2 parts (measure validation, playability and
+    note-variety checks, score serialization checks and writes), so that it runs outside the GIL of the
+    threads and event loop waiting on the API. Network concurrency is set by the per-model limits and CPU
+    work by max_workers, independently. Arguments travel pickled in the task message, except strings of at
+    least shared_memory_bytes (whole scores), which are copied once into a shared memory segment that the
+    worker reads and the pool unlinks when the task is done.
+    """
+
+    def __init__(self, max_workers: int = None, shared_memory_bytes: int = 256 * 1024,
+                 metrics: MetricsRegistry = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.shared_memory_bytes = shared_memory_bytes
+        self.metrics = metrics or MetricsRegistry()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = Counter()
+
+    def start(self) -> concurrent.futures.ProcessPoolExecutor:
+        """
+        Start every worker process now and return the executor. Call before a batch starts its threads:
+        forking a process while other threads hold locks can deadlock the child.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return self._executor
+            # Workers must share this process's resource tracker; one started by a worker would unlink the
+            # shared memory segments it attached to when the worker exits. Windows has no resource tracker.
+            if os.name == "posix":
+                resource_tracker.ensure_running()
+            executor = self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        concurrent.futures.wait([executor.submit(_cpu_worker_ready) for _ in range(self.max_workers)])
+        return executor
+
+    def _share(self, args, segments):
+        message_args = []
+        for arg in args:
+            if isinstance(arg, str) and len(arg) >= self.shared_memory_bytes:
+                data = arg.encode("utf-8")
+                segment = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+                segment.buf[:len(data)] = data
+                segments.append(segment)
+                arg = SharedText(segment.name, len(data))
+            message_args.append(arg)
+        return message_args
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        """
+        Run fn(*args) on a worker process; returns a future of its result. fn must be a module-level
+        function (or a static method) so that it can be pickled.
+        """
+        result = concurrent.futures.Future()
+        self._send(fn, args, result)
+        return result
+
+    def _reset(self, executor) -> None:
+        """Drop a broken executor; the next task starts a fresh one."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _send(self, fn, args, result):
+        task = getattr(fn, "__qualname__", str(fn))
+        segments = []
+
+        def finish(done, transport):
+            while segments:
+                segment = segments.pop()
+                segment.close()
+                segment.unlink()
+            try:
+                value, seconds = done.result() if done is not None else _run_cpu_work(fn, args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died (e.g. killed for memory): do this task here and restart the pool for the next
+                print(f"[CPU] Worker pool broke during {task}; running it in the batch process")
+                self._reset(executor)
+                finish(None, "inline")
+                return
+            except Exception as exc:
+                result.set_exception(exc)
+                return
+            with self._lock:
+                self._stats["tasks"] += 1
+                self._stats[transport] += 1
+                self._stats["cpu_seconds"] += seconds
+                self._stats["wait_seconds"] += max(0.0, time.monotonic() - submitted - seconds)
+            self.metrics.inc("maestro_cpu_tasks_total", task=task, transport=transport)
+            self.metrics.observe("maestro_cpu_task_seconds", seconds, task=task)
+            result.set_result(value)
+
+        executor = self.start()
+        submitted = time.monotonic()
+        try:
+            message_args = self._share(args, segments)
+            future = executor.submit(_run_cpu_work, fn, message_args)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._reset(executor)
+            finish(None, "inline")
+            return
+        except Exception as exc:
+            while segments:
+                segment = segments.pop()
+                segment.close()
+                segment.unlink()
+            result.set_exception(exc)
+            return
+        transport = "shared_memory" if segments else "message"
+        future.add_done_callback(lambda done: finish(done, transport))
+
+    def run(self, fn, *args):
+        """Run fn(*args) on a worker process and wait for its result."""
+        return self.submit(fn, *args).result()
+
+    def format_stats(self) -> str:
+        with self._lock:
+            stats = dict(self._stats)
+        tasks = stats.get("tasks", 0)
+        return (f"[CPU] {tasks} tasks on {self.max_workers} worker processes "
+                f"({stats.get('shared_memory', 0)} with shared memory, {stats.get('inline', 0)} run inline), "
+                f"{stats.get('cpu_seconds', 0.0):.1f}s of work, "
+                f"{stats.get('wait_seconds', 0.0) / max(tasks, 1) * 1000:.1f} ms mean queueing and transfer")
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+MUSICXML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n'
+    '<score-partwise version="4.0">\n'
+)
+
+# Code fences, XML declarations, doctypes and score-partwise tags that A2 wraps around each part
+_WRAPPER_PATTERN = re.compile(
+    r"```(?:xml)?|'''|<\?xml[^>]*\?>|<!DOCTYPE[^>]*>|<score-partwise[^>]*>|</score-partwise>"
+)
+# Trailing text that may be the start of a wrapper split across two streamed chunks
+_PARTIAL_WRAPPER_PATTERN = re.compile(r"(?:`{1,3}(?:x|xm)?|'{1,2})$")
+
+
+class PartStream:
+    """
+    Incremental parser for the A2 text of one part.
+    Text is parsed once as it arrives; each closed <measure> is serialized and kept by measure number
+    (in the spill buffer when one is given).
+    """
+
+    def __init__(self, part_number: int, spill: SpillBuffer = None):
+        self.part_number = part_number
+        self.spill = spill
+        self.part_id = None  # Taken from the first <part id="..."> seen
+        self.measures = {}  # measure number -> serialized <measure> element
+        self.part_names = {}  # part id -> name, from any <part-list> in this part's text
+        self.part_list_closed = False  # True once a complete <part-list> has been read
+        self._pending = ""  # Text held back until it can be cleaned without splitting a wrapper tag
+        self._raw = ""  # Cleaned text since the last closed measure; scanned for measures once the parser fails
+        self._broken = False
+        self._stack = []
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._parser.feed("<a2-fragment>")
+
+    @staticmethod
+    def _measure_key(number):
+        return (0, int(number), "") if str(number).isdigit() else (1, 0, str(number))
+
+    def _clean(self, text, final=False):
+        """Strip wrappers from new text, holding back anything that could be half of a wrapper."""
+        text = self._pending + text
+        self._pending = ""
+        if not final:
+            cut = len(text)
+            last_open = text.rfind("<")
+            if last_open > text.rfind(">"):
+                cut = last_open
+            partial = _PARTIAL_WRAPPER_PATTERN.search(text[:cut])
+            if partial:
+                cut = partial.start()
+            text, self._pending = text[:cut], text[cut:]
+        return _WRAPPER_PATTERN.sub("", text)
+
+    def feed(self, text: str, final: bool = False) -> int:
+        """Parse newly arrived text and return the number of measures it completed."""
+        cleaned = self._clean(text, final)
+        if not cleaned:
+            return 0
+        if self._broken:
+            return self._feed_raw(cleaned)
+
+        self._raw += cleaned
+        try:
+            self._parser.feed(cleaned)
+            stored = self._read_events()
+        except ET.ParseError:
+            # Malformed model output: fall back to extracting complete measures from the raw text, which still
+            # holds the measure the parser was reading
+            self._broken = True
+            return self._feed_raw("")
+        # Everything up to the last closed measure has been parsed
+        end = self._raw.rfind("</measure>")
+        if end >= 0:
+            self._raw = self._raw[end + len("</measure>"):]
+        return stored
+
+    def _store_measure(self, number, xml):
+        self.measures[number or str(len(self.measures) + 1)] = self.spill.write(xml) if self.spill else xml
+
+    def _read_events(self):
+        stored = 0
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                if elem.tag == "part" and self.part_id is None:
+                    self.part_id = elem.get("id")
+                self._stack.append(elem)
+                continue
+
+            self._stack.pop()
+            # Measures never nest, so one inside another means the outer measure was cut off by the
+            # token limit and the continuation restarted it; the inner one is the complete copy
+            if elem.tag == "measure":
+                elem.tail = None
+                self._store_measure(elem.get("number"), ET.tostring(elem, encoding="unicode"))
+                stored += 1
+                # Drop the parsed element so memory stays bounded by the serialized measures
+                if self._stack:
+                    self._stack[-1].remove(elem)
+            elif elem.tag == "score-part" and elem.get("id"):
+                self.part_names[elem.get("id")] = (elem.findtext("part-name") or "").strip()
+            elif elem.tag == "part-list":
+                self.part_list_closed = True
+        return stored
+
+    def _feed_raw(self, cleaned):
+        self._raw += cleaned
+        if self.part_id is None:
+            part_match = re.search(r'<part id="([^"]+)"', self._raw)
+            if part_match:
+                self.part_id = part_match.group(1)
+        for score_part in re.finditer(r'<score-part id="([^"]+)">\s*<part-name>([^<]*)</part-name>', self._raw):
+            self.part_names[score_part.group(1)] = score_part.group(2).strip()
+        if "</part-list>" in self._raw:
+            self.part_list_closed = True
+
+        stored = 0
+        consumed = 0
+        # A measure cut off by the token limit and restarted by the continuation is skipped up to the restart
+        for match in re.finditer(r'<measure\b[^>]*>(?:(?!<measure\b).)*?</measure>', self._raw, re.S):
+            number = re.search(r'number="([^"]*)"', match.group(0))
+            self._store_measure(number.group(1) if number else None, match.group(0))
+            stored += 1
+            consumed = match.end()
+        # Only the unfinished tail needs to be kept for the next chunk
+        self._raw = self._raw[consumed:]
+        return stored
+
+    def merge_measures(self, measures: Dict[str, str]) -> None:
+        """Replace or add measures by number (used when splicing regenerated measures)."""
+        self.measures.update(measures)
+
+    def merge_header(self, other: "PartStream") -> None:
+        """Take the part id and part-list of a fragment if this part has not declared its own yet."""
+        self.part_id = self.part_id or other.part_id
+        for part_id, name in other.part_names.items():
+            self.part_names.setdefault(part_id, name)
+        self.part_list_closed = self.part_list_closed or other.part_list_closed
+
+    def to_xml(self) -> str:
+        part_id = self.part_id or f"P{self.part_number}"
+        ordered = sorted(self.measures.items(), key=lambda item: self._measure_key(item[0]))
+        return f'<part id="{part_id}">\n' + "\n".join(str(xml) for _, xml in ordered) + '\n</part>'
+
+
+class ScoreAssembler:
+    """
+    Builds the output MusicXML score from per-part A2 text.
+    Each chunk is parsed once into its part's measure map, and only parts that changed are re-serialized,
+    so the cost of a continuation is proportional to the new content rather than the whole score.
+    With a spill buffer, measures are kept on disk and parts are re-serialized on every write instead of cached.
+    """
+
+    def __init__(self, min_write_interval: float = 0.0, spill: SpillBuffer = None):
+        self._lock = threading.Lock()
+        self.spill = spill
+        self._parts = {}  # part number -> PartStream
+        self._segments = {}  # (part number, segment) -> PartStream of a standalone fragment for that part
+        self._part_xml = {}  # part number -> cached serialized <part>
+        self._outline_names = {}  # part number -> instrument named in the B2 outline, for parts A2 left unnamed
+        self.min_write_interval = min_write_interval
+        self._last_write = 0.0
+
+    def _stream(self, part_number):
+        if part_number not in self._parts:
+            self._parts[part_number] = PartStream(part_number, self.spill)
+        return self._parts[part_number]
+
+    def feed(self, part_number: int, text: str, final: bool = False, segment=None) -> int:
+        """
+        Parse new text for a part; returns the number of measures it completed or replaced.
+        Text for a segment is a standalone fragment (such as a tail-only continuation) that is parsed on
+        its own and spliced into the part by measure number.
+        """
+        with self._lock:
+            stream = self._stream(part_number)
+            if segment is None:
+                stored = stream.feed(text, final)
+            else:
+                segment_stream = self._segments.get((part_number, segment))
+                if segment_stream is None:
+                    segment_stream = self._segments[(part_number, segment)] = PartStream(part_number, self.spill)
+                stored = segment_stream.feed(text, final)
+                if stored:
+                    stream.merge_measures(segment_stream.measures)
+                    # A shard that opens the part carries its id and, for the first part, the part-list
+                    stream.merge_header(segment_stream)
+            if stored:
+                self._part_xml.pop(part_number, None)
+            return stored
+
+    def reset_part(self, part_number: int, text: str = "", segment=None) -> None:
+        """Discard a part or segment (e.g. after a failed streamed attempt) and re-parse it from the given text."""
+        with self._lock:
+            if segment is None:
+                self._parts.pop(part_number, None)
+            else:
+                self._segments.pop((part_number, segment), None)
+            self._part_xml.pop(part_number, None)
+        if text:
+            self.feed(part_number, text, segment=segment)
+
+    def last_measures(self, part_number: int, count: int) -> List[str]:
+        """The highest-numbered complete measures of a part, in order."""
+        with self._lock:
+            stream = self._parts.get(part_number)
+            if not stream:
+                return []
+            ordered = sorted(stream.measures.items(), key=lambda item: PartStream._measure_key(item[0]))
+            return [str(xml) for _, xml in ordered[-count:]] if count > 0 else []
+
+    def next_measure_number(self, part_number: int) -> int:
+        """One past the highest numeric measure written for a part."""
+        with self._lock:
+            stream = self._parts.get(part_number)
+            numbers = [int(number) for number in (stream.measures if stream else {}) if str(number).isdigit()]
+            return max(numbers) + 1 if numbers else 1
+
+    def merge_measures(self, part_number: int, measures: Dict[str, str]) -> None:
+        with self._lock:
+            self._stream(part_number).merge_measures(measures)
+            self._part_xml.pop(part_number, None)
+
+    def part_numbers(self) -> List[int]:
+        with self._lock:
+            return sorted(self._parts)
+
+    def measures(self, part_number: int) -> Dict[str, str]:
+        with self._lock:
+            stream = self._parts.get(part_number)
+            return {number: str(xml) for number, xml in stream.measures.items()} if stream else {}
+
+    def part_names(self) -> Dict[str, str]:
+        """Part names declared in any part-list, keyed by part id."""
+        with self._lock:
+            names = {}
+            for number in sorted(self._parts):
+                names.update(self._parts[number].part_names)
+            return names
+
+    def set_part_name(self, part_number: int, name: str) -> None:
+        """Name used for a part when no part-list A2 wrote declares one."""
+        with self._lock:
+            self._outline_names[part_number] = name
+
+    def part_name(self, part_number: int) -> str:
+        """Declared name of a part, else its outline name, else "Part N"."""
+        names = self.part_names()
+        with self._lock:
+            stream = self._parts.get(part_number)
+            part_id = (stream.part_id if stream else None) or f"P{part_number}"
+            return names.get(part_id) or self._outline_names.get(part_number) or f"Part {part_id.replace('P', '')}"
+
+    def declared_part_count(self):
+        """Number of parts in the first completed <part-list>, or None while none has been closed."""
+        with self._lock:
+            for number in sorted(self._parts):
+                if self._parts[number].part_list_closed:
+                    return len(self._parts[number].part_names)
+            return None
+
+    def to_xml(self) -> str:
+        names = self.part_names()
+        with self._lock:
+            numbers = [number for number in sorted(self._parts) if self._parts[number].measures]
+            part_list = ['<part-list>']
+            for number in numbers:
+                part_id = self._parts[number].part_id or f"P{number}"
+                name = names.get(part_id) or self._outline_names.get(number) or f"Part {part_id.replace('P', '')}"
+                part_list.append(f'<score-part id="{part_id}">\n<part-name>{escape(name)}</part-name>\n</score-part>')
+                if number not in self._part_xml:
+                    self._part_xml[number] = self._parts[number].to_xml()
+            part_list.append('</part-list>')
+            body = [self._part_xml[number] for number in numbers]
+            if self.spill is not None:
+                self._part_xml.clear()
+        return MUSICXML_HEADER + "\n".join(part_list) + "\n" + "\n".join(body) + "\n</score-partwise>\n"
+
+    def render(self, force: bool = True):
+        """The score to write now, or None when an unforced write comes within min_write_interval of the last."""
+        now = time.monotonic()
+        if not force and now - self._last_write < self.min_write_interval:
+            return None
+        self._last_write = now
+        return self.to_xml()
+
+    def write(self, path: str, force: bool = True) -> bool:
+        """Atomically write the score; unless forced, skip writes closer together than min_write_interval."""
+        content = self.render(force)
+        if content is None:
+            return False
+        write_score_file(path, content)
+        return True
+
+
+def write_score_file(path: str, content: str, check: bool = False):
+    """
+    Atomically write a score. With check, the score is parsed first and the reason it is not well-formed
+    XML is returned (it is written either way); otherwise returns None.
+    """
+    error = None
+    if check:
+        try:
+            ET.fromstring(content.encode("utf-8"))
+        except ET.ParseError as e:
+            error = str(e)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+    return error
+
+
+# Writes the scores of agents without a CPU pool, so saves never block an agent's event loop on the disk
+SCORE_WRITER = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="score-writer")
+
+
+def requested_measure_count(prompt_text: str):
+    """Measure count asked for in a prompt (e.g. "24 measures"), or None."""
+    match = re.search(r'(\d+)\s*(?:measures|bars)\b', prompt_text, re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+class TrialAbortedError(Exception):
+    """Raised when a trial's output is structurally hopeless and generating more of it would waste tokens."""
+
+
+# Length in quarter notes of each MusicXML note <type>
+NOTE_TYPE_QUARTERS = {
+    "maxima": Fraction(32), "long": Fraction(16), "breve": Fraction(8), "whole": Fraction(4), "half": Fraction(2),
+    "quarter": Fraction(1), "eighth": Fraction(1, 2), "16th": Fraction(1, 4), "32nd": Fraction(1, 8),
+    "64th": Fraction(1, 16), "128th": Fraction(1, 32), "256th": Fraction(1, 64)
+}
+# The system prompts ask for at least this many distinct note lengths per composition
+MIN_NOTE_LENGTHS = 6
+
+
+class MeasureValidator:
+    """
+    Checks that every voice of every measure adds up to the time signature in effect.
+    Note lengths come from <type>, <dot/> and tuplet <time-modification> (what the system prompts ask A2 to
+    write), falling back to <duration> for notes without a type. Pickup measures (implicit="yes") and
+    whole-measure rests (measure="yes", or a voice's only note being a rest without a type) are accepted
+    as they are; other rests without a type are measured by their <duration>.
+    """
+
+    @staticmethod
+    def parse_number(text):
+        """A number written by the model as a Fraction, or None if it is missing or malformed."""
+        try:
+            return Fraction(text.strip())
+        except (AttributeError, ValueError, TypeError, ZeroDivisionError):
+            return None
+
+    @staticmethod
+    def duration_quarters(duration, divisions):
+        """A <duration> in quarter notes, or None if it or divisions cannot be read."""
+        duration = MeasureValidator.parse_number(duration)
+        if duration is None or not divisions:
+            return None
+        return duration / divisions
+
+    @staticmethod
+    def note_length(note, divisions):
+        """Length of a <note> in quarter notes, or None if it cannot be determined."""
+        note_type = (note.findtext("type") or "").strip()
+        if note_type in NOTE_TYPE_QUARTERS:
+            dots = len(note.findall("dot"))
+            length = NOTE_TYPE_QUARTERS[note_type] * (2 - Fraction(1, 2 ** dots))
+            modification = note.find("time-modification")
+            if modification is not None:
+                actual = MeasureValidator.parse_number(modification.findtext("actual-notes") or "1")
+                normal = MeasureValidator.parse_number(modification.findtext("normal-notes") or "1")
+                if not actual or normal is None:
+                    return None
+                length = length * normal / actual
+            return length
+        duration = note.findtext("duration")
+        if duration and divisions:
+            return MeasureValidator.duration_quarters(duration, divisions)
+        return None
+
+    @staticmethod
+    def parse_time(attributes):
+        """
+        Quarter notes per measure of a <time> element inside <attributes>, or None if there is none or it
+        cannot be read.
+        """
+        time_element = attributes.find("time")
+        if time_element is None or time_element.find("beats") is None:
+            return None
+        try:
+            # Composite signatures such as 3+2/8 add up their beat groups
+            beats = sum(int(group) for group in time_element.findtext("beats").split("+"))
+            beat_type = int(time_element.findtext("beat-type"))
+            return Fraction(beats * 4, beat_type)
+        except (ValueError, TypeError, ZeroDivisionError):
+            return None
+
+    def validate_part(self, measures: Dict[str, str], default_measure_length=None) -> List[Dict]:
+        """
+        Check a part's measures in order; returns one issue per measure whose voices do not fill it.
+        default_measure_length (quarter notes) is used until the part sets its own time signature.
+        """
+        issues = []
+        measure_length = default_measure_length
+        divisions = None
+        for number, measure_xml in sorted(measures.items(), key=lambda item: PartStream._measure_key(item[0])):
+            try:
+                measure = ET.fromstring(measure_xml)
+            except ET.ParseError:
+                continue
+
+            totals = {}
+            lengths_known = True
+            whole_measure_rest = set()
+            voice = "1"
+            for element in measure:
+                if element.tag == "attributes":
+                    if element.findtext("divisions"):
+                        divisions = self.parse_number(element.findtext("divisions"))
+                    measure_length = self.parse_time(element) or measure_length
+                elif element.tag == "note":
+                    voice = (element.findtext("voice") or "1").strip()
+                    if element.find("chord") is not None or element.find("grace") is not None:
+                        continue
+                    rest = element.find("rest")
+                    if rest is not None and (rest.get("measure") == "yes" or (
+                            not element.findtext("type") and self._is_lone_whole_rest(measure, voice))):
+                        whole_measure_rest.add(voice)
+                        continue
+                    length = self.note_length(element, divisions)
+                    if length is None:
+                        lengths_known = False
+                        continue
+                    totals[voice] = totals.get(voice, Fraction(0)) + length
+                elif element.tag == "forward" and element.findtext("duration") and divisions:
+                    length = self.duration_quarters(element.findtext("duration"), divisions)
+                    if length is None:
+                        lengths_known = False
+                        continue
+                    forward_voice = (element.findtext("voice") or voice).strip()
+                    totals[forward_voice] = totals.get(forward_voice, Fraction(0)) + length
+
+            if measure_length is None or not lengths_known or measure.get("implicit") == "yes":
+                continue
+            for voice_name, total in sorted(totals.items()):
+                # A lone whole rest is the conventional full-measure rest in any meter
+                if voice_name in whole_measure_rest or total == measure_length:
+                    continue
+                if total == 4 and self._is_lone_whole_rest(measure, voice_name):
+                    continue
+                issues.append({"measure": number, "voice": voice_name, "expected": measure_length, "actual": total})
+        return issues
+
+    @staticmethod
+    def _is_lone_whole_rest(measure, voice_name):
+        notes = [note for note in measure.iter("note") if (note.findtext("voice") or "1").strip() == voice_name]
+        return len(notes) == 1 and notes[0].find("rest") is not None
+
+    @staticmethod
+    def note_lengths(measures: Dict[str, str]) -> set:
+        """Distinct (type, dots, tuplet) note lengths used in a set of measures."""
+        lengths = set()
+        for measure_xml in measures.values():
+            try:
+                measure = ET.fromstring(measure_xml)
+            except ET.ParseError:
+                continue
+            for note in measure.iter("note"):
+                if note.findtext("type"):
+                    modification = note.find("time-modification")
+                    tuplet = modification.findtext("actual-notes") if modification is not None else None
+                    lengths.add((note.findtext("type").strip(), len(note.findall("dot")), tuplet))
+        return lengths
+
+    @staticmethod
+    def issue_ranges(issues: List[Dict]) -> List[Tuple[int, int, List[Dict]]]:
+        """Group failing numeric measures into contiguous (first, last, issues) ranges."""
+        ranges = []
+        for issue in sorted((issue for issue in issues if str(issue["measure"]).isdigit()),
+                            key=lambda issue: int(issue["measure"])):
+            number = int(issue["measure"])
+            if ranges and number <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], number, ranges[-1][2] + [issue])
+            else:
+                ranges.append((number, number, [issue]))
+        return ranges
+
+
+# Practical ranges of orchestral instruments and voices: (lowest, highest) written pitch as MIDI numbers,
+# the transposition from written to sounding pitch in semitones, and the most notes sounding at once
+INSTRUMENT_RANGES = {
+    "Piccolo": (62, 96, 12, 1),
+    "Flute": (60, 96, 0, 1),
+    "Alto Flute": (60, 91, -5, 1),
+    "Oboe": (58, 91, 0, 1),
+    "English Horn": (59, 91, -7, 1),
+    "Clarinet in E♭": (52, 91, 3, 1),
+    "Clarinet in B♭": (52, 94, -2, 1),
+    "Clarinet in A": (52, 94, -3, 1),
+    "Bass Clarinet": (52, 89, -14, 1),
+    "Bassoon": (34, 75, 0, 1),
+    "Contrabassoon": (34, 65, -12, 1),
+    "Soprano Saxophone": (58, 89, -2, 1),
+    "Alto Saxophone": (58, 89, -9, 1),
+    "Tenor Saxophone": (58, 89, -14, 1),
+    "Baritone Saxophone": (58, 89, -21, 1),
+    "Horn in F": (42, 84, -7, 1),
+    "Trumpet in C": (54, 84, 0, 1),
+    "Trumpet in B♭": (54, 84, -2, 1),
+    "Flugelhorn": (54, 82, -2, 1),
+    "Trombone": (40, 72, 0, 1),
+    "Bass Trombone": (34, 67, 0, 1),
+    "Euphonium": (34, 70, 0, 1),
+    "Tuba": (26, 65, 0, 1),
+    "Timpani": (38, 57, 0, 2),
+    "Xylophone": (53, 96, 12, 2),
+    "Glockenspiel": (55, 84, 24, 2),
+    "Vibraphone": (53, 89, 0, 4),
+    "Marimba": (36, 96, 0, 4),
+    "Celesta": (48, 96, 12, 10),
+    "Harp": (23, 104, 0, 8),
+    "Harpsichord": (29, 89, 0, 10),
+    "Organ": (36, 96, 0, 10),
+    "Piano": (21, 108, 0, 10),
+    "Piano (one hand)": (21, 108, 0, 5),
+    "Guitar": (52, 88, -12, 6),
+    "Violin": (55, 100, 0, 4),
+    "Viola": (48, 88, 0, 4),
+    "Cello": (36, 81, 0, 4),
+    "Double Bass": (40, 79, -12, 2),
+    "Soprano": (60, 84, 0, 1),
+    "Mezzo-soprano": (57, 81, 0, 1),
+    "Alto": (53, 77, 0, 1),
+    "Tenor": (48, 72, 0, 1),
+    "Baritone": (45, 69, 0, 1),
+    "Bass": (40, 64, 0, 1),
+}
+# Part-name patterns (matched against the lower-cased name with flats spelled "b") mapped to a range table entry;
+# more specific names come first
+INSTRUMENT_PATTERNS = tuple((re.compile(pattern), instrument) for pattern, instrument in (
+    (r"piccolo", "Piccolo"),
+    (r"alto flute", "Alto Flute"),
+    (r"flute", "Flute"),
+    (r"english horn|cor anglais", "English Horn"),
+    (r"oboe", "Oboe"),
+    (r"bass clarinet", "Bass Clarinet"),
+    (r"clarinet in eb|eb clarinet", "Clarinet in E♭"),
+    (r"clarinet in a\b|a clarinet", "Clarinet in A"),
+    (r"clarinet", "Clarinet in B♭"),
+    (r"contra ?bassoon", "Contrabassoon"),
+    (r"bassoon", "Bassoon"),
+    (r"soprano sax", "Soprano Saxophone"),
+    (r"alto sax", "Alto Saxophone"),
+    (r"tenor sax", "Tenor Saxophone"),
+    (r"bari(?:tone)? sax", "Baritone Saxophone"),
+    (r"flugel", "Flugelhorn"),
+    (r"euphonium|baritone horn", "Euphonium"),
+    (r"horn", "Horn in F"),
+    (r"trumpet in c\b|c trumpet", "Trumpet in C"),
+    (r"trumpet|cornet", "Trumpet in B♭"),
+    (r"bass trombone", "Bass Trombone"),
+    (r"trombone", "Trombone"),
+    (r"tuba", "Tuba"),
+    (r"timpani", "Timpani"),
+    (r"xylophone", "Xylophone"),
+    (r"glockenspiel|orchestra bells", "Glockenspiel"),
+    (r"vibraphone", "Vibraphone"),
+    (r"marimba", "Marimba"),
+    (r"celesta", "Celesta"),
+    (r"harpsichord", "Harpsichord"),
+    (r"harp", "Harp"),
+    (r"organ", "Organ"),
+    (r"(?:piano|keyboard).*(?:hand|\b[lr]\.?h\b|\(?\b[lr]\b\)?|treble|bass)", "Piano (one hand)"),
+    (r"piano|keyboard", "Piano"),
+    (r"guitar", "Guitar"),
+    (r"violin", "Violin"),
+    (r"viola", "Viola"),
+    (r"cello", "Cello"),
+    (r"double bass|contrabass|string bass|upright bass", "Double Bass"),
+    (r"mezzo", "Mezzo-soprano"),
+    (r"soprano", "Soprano"),
+    (r"alto|contralto", "Alto"),
+    (r"tenor", "Tenor"),
+    (r"baritone", "Baritone"),
+    (r"bass (?:voice|solo)|basso|\bbass\b.*(?:choir|voice)", "Bass"),
+    (r"\bbass\b", "Double Bass"),
+))
+_PITCH_NAMES = ("C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B")
+
+
+def _pitch_name(midi: float) -> str:
+    """Note name of a MIDI number, with middle C as C4."""
+    midi = int(round(midi))
+    return f"{_PITCH_NAMES[midi % 12]}{midi // 12 - 1}"
+
+
+def _outside_bounds(values: List[List[float]], lows: List[float], highs: List[float]) -> List[List[int]]:
+    """
+    Indices of the values of each group that fall outside that group's [low, high] bounds.
+    All groups are compared in one vectorized pass when NumPy is installed.
+    """
+    if np is None:
+        return [[index for index, value in enumerate(group) if value < low or value > high]
+                for group, low, high in zip(values, lows, highs)]
+    counts = np.asarray([len(group) for group in values], dtype=int)
+    flat = np.fromiter((value for group in values for value in group), dtype=float, count=int(counts.sum()))
+    outside = np.flatnonzero((flat < np.repeat(np.asarray(lows, dtype=float), counts))
+                             | (flat > np.repeat(np.asarray(highs, dtype=float), counts)))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    groups = np.searchsorted(starts, outside, side="right") - 1
+    result = [[] for _ in values]
+    for group, index in zip(groups.tolist(), outside.tolist()):
+        result[group].append(index - int(starts[group]))
+    return result
+
+
+class PlayabilityChecker:
+    """
+    Checks that every note of a part lies in its instrument's range and that no chord has more notes than the
+    instrument can sound at once. The instrument comes from the part name via INSTRUMENT_PATTERNS; parts with
+    unrecognized names are not checked. Pitches are compared as written when the part declares a <transpose>,
+    and as sounding pitch otherwise. Many parts (a whole archive) can be checked in one vectorized pass.
+    """
+
+    def __init__(self):
+        self._instruments = {}  # part name -> instrument, or None when no pattern matches
+
+    def instrument(self, part_name: str):
+        """Range table entry for a part name (e.g. "Clarinet in B♭ 2" or "Piano RH"), or None."""
+        if part_name not in self._instruments:
+            normalized = re.sub(r"[-\s]*(?:♭|flat)\b", "b", (part_name or "").lower())
+            normalized = re.sub(r"[-\s]*(?:♯|sharp)\b", "#", normalized)
+            self._instruments[part_name] = next(
+                (instrument for pattern, instrument in INSTRUMENT_PATTERNS if pattern.search(normalized)), None)
+        return self._instruments[part_name]
+
+    @staticmethod
+    def part_notes(measures) -> Dict:
+        """
+        Pitches (MIDI numbers) and chord sizes of a part's <measure> elements, with the measure of each,
+        and the written-to-sounding transposition the part declares (None when it declares none).
+        """
+        notes = {"pitches": [], "pitch_measures": [], "chords": [], "chord_measures": [], "transposition": None}
+        for measure in measures:
+            number = measure.get("number")
+            for element in measure.iter():
+                if element.tag == "transpose" and element.findtext("chromatic"):
+                    try:
+                        notes["transposition"] = (int(element.findtext("chromatic"))
+                                                  + 12 * int(element.findtext("octave-change") or 0))
+                    except ValueError:
+                        pass  # an unreadable <transpose> is ignored, the part is checked at sounding pitch
+                elif element.tag == "note" and element.find("grace") is None:
+                    if element.find("chord") is not None and notes["chords"]:
+                        notes["chords"][-1] += 1
+                    elif element.find("rest") is None:
+                        notes["chords"].append(1)
+                        notes["chord_measures"].append(number)
+                    midi = _midi_pitch(element.find("pitch"))
+                    if midi is not None:
+                        notes["pitches"].append(midi)
+                        notes["pitch_measures"].append(number)
+        return notes
+
+    def check(self, parts: List[Tuple[str, Dict]]) -> List[List[Dict]]:
+        """Issues of each (part name, part_notes) pair: one per measure with out-of-range notes or chords."""
+        bounds = []
+        for part_name, notes in parts:
+            instrument = self.instrument(part_name)
+            if instrument is None:
+                bounds.append((instrument, -math.inf, math.inf, math.inf))
+                continue
+            low, high, transposition, polyphony = INSTRUMENT_RANGES[instrument]
+            if notes["transposition"] is None:
+                low, high = low + transposition, high + transposition
+            bounds.append((instrument, low, high, polyphony))
+
+        out_of_range = _outside_bounds([notes["pitches"] for _, notes in parts],
+                                       [low for _, low, _, _ in bounds], [high for _, _, high, _ in bounds])
+        too_many = _outside_bounds([notes["chords"] for _, notes in parts],
+                                   [1] * len(parts), [polyphony for _, _, _, polyphony in bounds])
+
+        all_issues = []
+        for (_, notes), (instrument, low, high, polyphony), range_indices, chord_indices in zip(
+                parts, bounds, out_of_range, too_many):
+            by_measure = {}
+            for index in range_indices:
+                by_measure.setdefault(notes["pitch_measures"][index], []).append(notes["pitches"][index])
+            pitch_space = "written" if notes["transposition"] is not None else "sounding"
+            issues = [{"measure": measure, "kind": "range", "instrument": instrument,
+                       "problem": f"{', '.join(_pitch_name(pitch) for pitch in pitches)} outside the {instrument} "
+                                  f"range of {_pitch_name(low)}-{_pitch_name(high)} ({pitch_space})"}
+                      for measure, pitches in by_measure.items()]
+            chords = {}
+            for index in chord_indices:
+                measure = notes["chord_measures"][index]
+                chords[measure] = max(chords.get(measure, 0), notes["chords"][index])
+            issues.extend({"measure": measure, "kind": "polyphony", "instrument": instrument,
+                           "problem": f"{size} simultaneous notes, the {instrument} plays at most {polyphony}"}
+                          for measure, size in chords.items())
+            all_issues.append(issues)
+        return all_issues
+
+    def check_part(self, part_name: str, measures: Dict[str, str]) -> List[Dict]:
+        """Issues of one part given as {measure number: measure XML}, as A2 parts are assembled."""
+        elements = []
+        for measure_xml in measures.values():
+            try:
+                elements.append(ET.fromstring(measure_xml))
+            except ET.ParseError:
+                continue
+        return self.check([(part_name, self.part_notes(elements))])[0]
+
+    def check_scores(self, paths: List[str], max_workers: int = None) -> Dict[str, Dict]:
+        """
+        Check every score under the given paths. Scores are parsed on a process pool, then all of their parts
+        are checked in one pass; returns {file path: {"parts": [...]} or {"error": reason}}.
+        """
+        score_paths = SpectralAnalyzer.find_scores(paths)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            extracted = list(executor.map(_playability_notes_file, score_paths, chunksize=16))
+
+        results = {}
+        parts = []
+        for path, (score_parts, error) in zip(score_paths, extracted):
+            if error is not None:
+                results[path] = {"error": error}
+                continue
+            results[path] = {"parts": []}
+            for part_id, part_name, notes in score_parts:
+                results[path]["parts"].append({"id": part_id, "name": part_name,
+                                               "instrument": self.instrument(part_name),
+                                               "notes": len(notes["pitches"])})
+                parts.append((part_name, notes))
+
+        issues = iter(self.check(parts))
+        for result in results.values():
+            for part in result.get("parts", []):
+                part["issues"] = next(issues)
+        return results
+
+    @staticmethod
+    def format_summary(results: Dict[str, Dict]) -> str:
+        """Parts, notes and issues per instrument over a set of check_scores results."""
+        rows = {}
+        errors = 0
+        for result in results.values():
+            if "error" in result:
+                errors += 1
+                continue
+            for part in result["parts"]:
+                row = rows.setdefault(part["instrument"] or "(unrecognized)", Counter())
+                row["parts"] += 1
+                row["notes"] += part["notes"]
+                row["clean"] += not part["issues"]
+                for issue in part["issues"]:
+                    row[issue["kind"]] += 1
+
+        lines = [f"{'Instrument':<22} {'Parts':>6} {'Notes':>8} {'Playable':>9} {'Range':>6} {'Chords':>7}"]
+        for instrument, row in sorted(rows.items()):
+            lines.append(f"{instrument:<22} {row['parts']:>6} {row['notes']:>8} "
+                         f"{row['clean'] / row['parts']:>9.0%} {row['range']:>6} {row['polyphony']:>7}")
+        lines.append(f"{len(results)} scores ({errors} unreadable); Range and Chords count measures with notes "
+                     f"outside the instrument's range or more simultaneous notes than it can play")
+        return "\n".join(lines)
+
+
+def _playability_notes_file(path: str):
+    """Process pool worker: (part id, part name, part_notes) of every part of a score, or the reason it failed."""
+    try:
+        root = ET.fromstring(_read_score_bytes(path))
+        names = {score_part.get("id"): (score_part.findtext("part-name") or "").strip()
+                 for score_part in root.iter("score-part")}
+        return [(part.get("id"), names.get(part.get("id"), ""),
+                 PlayabilityChecker.part_notes(part.iter("measure"))) for part in root.iter("part")], None
+    except (OSError, zipfile.BadZipFile, IndexError, ET.ParseError, ValueError, KeyError, TypeError,
+            AttributeError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def validate_part_measures(measures: Dict[str, str], default_measure_length=None, part_name: str = None):
+    """
+    Validation issues of one part's {measure number: measure XML}: voices that do not add up to the time
+    signature and, when the part name is given, notes its instrument cannot play. Runs on the CPU pool.
+    """
+    issues = MeasureValidator().validate_part(measures, default_measure_length)
+    if part_name is not None:
+        issues += PlayabilityChecker().check_part(part_name, measures)
+    return issues
+
+
+class StreamingPartBuffer:
+    """
+    Accumulates streamed A2 tokens for one part.
+    Every delta is handed to on_delta as it arrives; on_reset is called when a failed attempt's tokens are dropped.
+    """
+
+    def __init__(self, part_number: int, base_text: str = "", on_delta=None, on_reset=None, segment=None):
+        self.part_number = part_number
+        self.segment = segment  # Assembler segment for standalone fragments such as tail-only continuations
+        self.base_text = base_text  # Text from earlier calls that this stream continues
+        self._deltas = []  # Deltas of the current call, joined only when the response is complete
+        self.finish_reason = None  # finish_reason of the last streamed choice
+        self.usage = None  # Token usage from the final stream chunk
+        self.on_delta = on_delta
+        self.on_reset = on_reset
+
+    def start_attempt(self) -> None:
+        """Drop any tokens from a failed attempt before the call is retried."""
+        self.finish_reason = None
+        self.usage = None
+        if self._deltas:
+            self._deltas = []
+            if self.on_reset:
+                self.on_reset(self)
+
+    @property
+    def response_text(self) -> str:
+        """Text streamed by the current call only."""
+        return "".join(self._deltas)
+
+    def append(self, delta: str) -> None:
+        self._deltas.append(delta)
+        if self.on_delta:
+            self.on_delta(self, delta)
+
 
 class LLMConversationAgent:
     def __init__(
@@ -208,11 +2814,36 @@ Upon receiving an outline you are to write out the complete and proper XML. Give
             final_output_dir: str = "",
             max_workers: int = 20,  # Increased to 20 for parallel A2 calls
             prompt_id: str = "",  # Added prompt ID for identification
-            trial_num: int = 1  # Added trial number for multiple runs
+            trial_num: int = 1,  # Added trial number for multiple runs
+            rate_limiters: RateLimiterRegistry = None,  # Per-model request/token budgets shared across agents
+            stream_a2: bool = False,  # Stream A2 responses and flush completed measures as they arrive
+            continuation_mode: str = "full",  # "full": resend the whole part; "tail": plan + last measures only
+            tail_measures: int = 2,  # Completed measures sent as context in tail continuation mode
+            validate_measures: bool = False,  # Check measure durations after each A2 part and re-request failing ones
+            repair_rounds: int = 1,  # Validate-and-re-request rounds per part
+            max_repair_ranges: int = 8,  # Most failing measure ranges re-requested per part and round
+            check_playability: bool = False,  # Validation also flags notes outside the instrument's range or polyphony
+            shard_measures: int = 0,  # Write parts longer than this as parallel measure ranges (0: one call per part)
+            response_cache: ResponseCache = None,  # Optional on-disk cache of model responses
+            cache_stages: Tuple = ("A1", "B1", "B2"),  # Stages allowed to use the cache (A2 is sampled fresh)
+            concurrency_limits: Dict = None,  # Optional {model_name: AdaptiveConcurrencyLimit} shared by the batch
+            journal: CheckpointJournal = None,  # Optional journal used to resume interrupted runs
+            conversation_store: ConversationStore = None,  # Optional indexed store every message is written to
+            conversation_json: bool = True,  # Also save each conversation as its own JSON file
+            cpu_pool: CpuWorkerPool = None,  # Worker processes for validation and score writes; in-process if omitted
+            bounded_memory: bool = False,  # Keep stage outputs and measures in a spill file instead of RAM
+            spill_dir: str = None,  # Directory of the spill file (the system temp dir if omitted)
+            base_url: str = None,  # Optional OpenAI-compatible endpoint (e.g. the benchmark mock server)
+            model_base_urls: Dict[str, str] = None,  # Optional {model_name: endpoint} for models served elsewhere
+            http_clients: HttpClientPool = None,  # Shared API clients and connections; the process-wide pool if omitted
+            metrics: MetricsRegistry = None,  # Call metrics shared across a batch; private to the agent if omitted
+            token_budgeter: TokenBudgeter = None  # Size max_tokens per call from measure counts instead of flat limits
     ):
-        # Set up API client
+        # API clients come from the shared pool, so the connections outlive the trial
         self.api_key = api_key
-        self.client = openai.OpenAI(api_key=api_key)
+        self.base_url = base_url
+        self.model_base_urls = dict(model_base_urls or {})
+        self.http_clients = http_clients or HTTP_CLIENTS
 
         # Set up Model A (Original)
         self.model_a_name = model_a_name
@@ -260,43 +2891,384 @@ Upon receiving an outline you are to write out the complete and proper XML. Give
         # Incremental saving settings
         self.current_xml_filename = None
 
+        # Streaming settings
+        self.stream_a2 = stream_a2
+
+        # Continuation settings
+        self.continuation_mode = continuation_mode
+        self.tail_measures = tail_measures
+        self._continuation_count = 0
+
+        # Long parts split into measure ranges that are written in parallel and stitched by measure number
+        self.shard_measures = shard_measures
+
+        # Measure validation and targeted regeneration
+        self.validate_measures = validate_measures
+        self.repair_rounds = repair_rounds
+        self.max_repair_ranges = max_repair_ranges
+        self.check_playability = check_playability
+        self.abort_reason = None
+
+        # In bounded-memory mode stage outputs, part texts and measures are written to a disk-backed spill
+        # buffer as they arrive; RAM holds only references into it and the part/measure indexes
+        self.bounded_memory = bounded_memory
+        self.spill_dir = spill_dir
+        self.spill = SpillBuffer(spill_dir) if bounded_memory else None
+
+        # Incremental MusicXML assembly of the A2 parts
+        self.score_assembler = ScoreAssembler(min_write_interval=0.5, spill=self.spill)
+
+        # CPU-bound checks and score writes run on the batch's worker processes. One write of this score is in
+        # flight at a time; a save requested meanwhile is done when it lands, from the score as it is then.
+        self.cpu_pool = cpu_pool
+        self._score_lock = threading.RLock()
+        self._score_write = None
+        self._score_pending = None  # None, or whether the save requested during the write in flight was forced
+        self._score_idle = threading.Event()
+        self._score_idle.set()
+
         # Ctrl+C handling
         self.stop_requested = False
 
         # Parallel processing settings
         self.max_workers = max_workers
 
+        # Response cache settings
+        self.response_cache = response_cache
+        self.cache_stages = set(cache_stages or ())
+
+        # Per-model concurrency limits shared with the other agents of a batch; AsyncLLMConversationAgent
+        # also limits the batch's calls in flight and may hedge slow ones
+        self.concurrency_limits = concurrency_limits or {}
+        self.call_semaphore = None
+        self.hedge_policy = None
+
+        # Rate limiting is process-wide unless a separate registry is supplied
+        self.rate_limiters = rate_limiters or RATE_LIMITERS
+        self.max_rate_limit_waits = 50  # Give up on a single call after this many 429s
+
         # Add a unique ID for this agent instance
         self.agent_id = f"{self.prompt_id}_trial{self.trial_num}_{random.randint(1000, 9999)}"
 
-    def _call_model(self, model_name, system_prompt, messages, temperature, top_p, max_tokens):
-        """Call the OpenAI API for either model."""
+        # Checkpoint journal for resuming interrupted runs
+        self.journal = journal
+
+        # Messages are streamed to the conversation store as they are recorded
+        self.conversation_store = conversation_store
+        self.conversation_json = conversation_json
+        self._stored_messages = 0
+
+        # Per-stage call latency, token and retry metrics
+        self.metrics = metrics or MetricsRegistry()
+
+        # Per-call max_tokens from the requested and planned measure counts
+        self.token_budgeter = token_budgeter
+        self.requested_measures = None
+
+        # Prompt ids of identical prompts in other categories; they get copies of this trial's output files
+        self.output_aliases = []
+
+    def _shared_client(self, base_url):
+        """The pool's async OpenAI client for an endpoint on the running event loop."""
+        return self.http_clients.async_client(self.api_key, base_url)
+
+    def _client_for(self, model_name):
+        """Client for the endpoint serving a model."""
+        return self._shared_client(self.model_base_urls.get(model_name, self.base_url))
+
+    @property
+    def client(self):
+        """Synchronous client for the default endpoint."""
+        return self.http_clients.client(self.api_key, self.base_url)
+
+    def _format_messages(self, system_prompt, messages):
+        """Prepend the system prompt to the conversation messages."""
         formatted_messages = [{"role": "system", "content": system_prompt}]
         for msg in messages:
             formatted_messages.append(msg)
+        return formatted_messages
+
+    def _estimate_tokens(self, formatted_messages, completion_tokens):
+        """Estimate the tokens a call counts against the rate limit (prompt plus the completion reserved)."""
+        prompt_chars = sum(len(msg["content"]) for msg in formatted_messages)
+        return prompt_chars // 4 + completion_tokens
+
+    def _cache_lookup(self, stage, model_name, system_prompt, messages, temperature, top_p, max_tokens,
+                      stream_buffer=None):
+        """Return (cache key, cached response) for a call; the key is None when the stage is not cached."""
+        if self.response_cache is None or stage not in self.cache_stages:
+            return None, None
+
+        # The trial number is part of the key so repeated trials of one prompt stay distinct samples
+        cache_key = ResponseCache.make_key(model_name, system_prompt, messages, temperature, top_p, max_tokens,
+                                           sample=self.trial_num)
+        cached = self.response_cache.get(cache_key, stage)
+        if cached is not None:
+            print(f"[Agent {self.agent_id}] Cache hit for {stage} ({len(cached)} chars)")
+            self.metrics.inc("maestro_cache_hits_total", stage=stage, model=model_name)
+            if stream_buffer is not None:
+                # Replay the cached text so streamed measures are still flushed to the score
+                stream_buffer.start_attempt()
+                stream_buffer.append(cached)
+        return cache_key, cached
+
+    def _cache_store(self, cache_key, response_text, model_name, stage):
+        if cache_key is not None and response_text is not None:
+            self.response_cache.put(cache_key, response_text, model_name, stage)
+
+    def _build_request_kwargs(self, model_name, formatted_messages, temperature, top_p, max_tokens, stream_buffer):
+        """Build the chat completion arguments, switching to streaming when a buffer is given."""
+        request_kwargs = {
+            "model": model_name,
+            "messages": formatted_messages,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens
+        }
+        if stream_buffer is not None:
+            stream_buffer.start_attempt()
+            request_kwargs["stream"] = True
+            request_kwargs["stream_options"] = {"include_usage": True}
+        return request_kwargs
+
+    async def _consume_stream(self, stream, stream_buffer):
+        """Append streamed tokens to the part buffer and return the text of this call."""
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].finish_reason:
+                stream_buffer.finish_reason = chunk.choices[0].finish_reason
+            if chunk.choices and chunk.choices[0].delta.content:
+                stream_buffer.append(chunk.choices[0].delta.content)
+            if getattr(chunk, "usage", None):
+                stream_buffer.usage = chunk.usage
+        return stream_buffer.response_text
+
+    def _open_stream_buffer(self, part_number, base_text="", segment=None):
+        """Create a streaming buffer for an A2 part, or return None when streaming is off."""
+        if not self.stream_a2:
+            return None
+        return StreamingPartBuffer(part_number, base_text, on_delta=self._on_stream_delta,
+                                   on_reset=self._on_stream_reset, segment=segment)
+
+    def _on_stream_delta(self, stream_buffer, delta):
+        """Parse streamed tokens as they arrive and write the score whenever a measure closes."""
+        if self.score_assembler.feed(stream_buffer.part_number, delta, segment=stream_buffer.segment):
+            self.save_incremental_output(force=False)
+
+    def _on_stream_reset(self, stream_buffer):
+        """Rebuild a part from the text before a failed streamed attempt."""
+        if stream_buffer.segment is None:
+            self.score_assembler.reset_part(stream_buffer.part_number, str(stream_buffer.base_text))
+        else:
+            self.score_assembler.reset_part(stream_buffer.part_number, segment=stream_buffer.segment)
+
+    def _model_slot(self, model_name):
+        """
+        Async context manager holding one of the model's concurrency slots (no limit if none configured).
+        It yields the ConcurrencySlot, or None without a limit.
+        """
+        limit = self.concurrency_limits.get(model_name)
+        return limit.slot_async() if limit is not None else contextlib.nullcontext()
 
-        # Add exponential backoff for API rate limits
+    def _should_retry_rate_limit(self, error, rate_limit_waits):
+        """Rate limit errors are queued and retried unless the account is out of quota."""
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False
+        return rate_limit_waits < self.max_rate_limit_waits
+
+    async def _call_model(self, model_name, system_prompt, messages, temperature, top_p, max_tokens,
+                          stream_buffer=None, stage=None, return_finish_reason=False, budget=None):
+        """
+        Call the OpenAI API for either model.
+        If a StreamingPartBuffer is given the response is streamed into it token by token.
+        With return_finish_reason a (text, finish_reason) tuple is returned; cached responses have no finish reason.
+        A TokenBudget replaces max_tokens in the request (the cache key keeps the stage's flat max_tokens).
+        With a hedge policy, slow calls of its stages are duplicated.
+        """
+        cache_key, cached = self._cache_lookup(stage, model_name, system_prompt, messages, temperature, top_p,
+                                               max_tokens, stream_buffer)
+        if cached is not None:
+            return (cached, None) if return_finish_reason else cached
+
+        if budget is not None:
+            max_tokens = budget.max_tokens
+        if self.hedge_policy is not None and stage in self.hedge_policy.stages:
+            response_text, finish_reason = await self._hedged_request(model_name, system_prompt, messages,
+                                                                      temperature, top_p, max_tokens, stream_buffer,
+                                                                      stage, budget)
+        else:
+            response_text, finish_reason = await self._request_model(model_name, system_prompt, messages,
+                                                                     temperature, top_p, max_tokens, stream_buffer,
+                                                                     stage, budget)
+        self._cache_store(cache_key, response_text, model_name, stage)
+        return (response_text, finish_reason) if return_finish_reason else response_text
+
+    def _has_spare_slot(self, model_name):
+        """True if a hedge would not have to queue behind the model's concurrency limit."""
+        limit = self.concurrency_limits.get(model_name)
+        return limit is None or limit.in_flight < int(limit.limit)
+
+    async def _hedged_request(self, model_name, system_prompt, messages, temperature, top_p, max_tokens,
+                              stream_buffer, stage, budget):
+        """
+        Send a request and, if it is still running past the hedge policy's latency percentile, a duplicate.
+        The first copy to succeed is returned and the other is cancelled. The duplicate is not streamed; if it
+        wins, its text replaces whatever the original had streamed into the part.
+        """
+        started = time.monotonic()
+        self.hedge_policy.begin(stage)
+        primary = asyncio.ensure_future(self._request_model(model_name, system_prompt, messages, temperature,
+                                                            top_p, max_tokens, stream_buffer, stage, budget))
+        pending = {primary}
+        try:
+            # Calls started before the stage had enough samples pick up the threshold once it exists
+            threshold = None
+            while not primary.done():
+                threshold = self.hedge_policy.threshold(stage)
+                remaining = threshold - (time.monotonic() - started) if threshold is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                await asyncio.wait(pending, timeout=remaining or self.hedge_policy.POLL_SECONDS)
+            if primary.done() or not self._has_spare_slot(model_name) or not self.hedge_policy.allow_hedge(stage):
+                response_text, finish_reason = await primary
+                self.hedge_policy.observe(stage, time.monotonic() - started)
+                return response_text, finish_reason
+
+            print(f"[Agent {self.agent_id}] {stage} call still running after {threshold:.1f}s, sending a hedge")
+            # The token budget learns from the original only, so its usage is not counted twice
+            hedge = asyncio.ensure_future(self._request_model(model_name, system_prompt, messages, temperature,
+                                                              top_p, max_tokens, None, stage))
+            pending.add(hedge)
+            winner = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if winner is None:
+            # Both copies failed; report the original's error
+            return primary.result()
+        hedge_won = winner is hedge
+        self.hedge_policy.record_winner(stage, hedge_won)
+        self.metrics.inc("maestro_hedged_calls_total", winner="hedge" if hedge_won else "original", stage=stage,
+                         model=model_name)
+        response_text, finish_reason = winner.result()
+        if hedge_won and stream_buffer is not None:
+            stream_buffer.start_attempt()
+            stream_buffer.append(response_text)
+            stream_buffer.finish_reason = finish_reason
+        self.hedge_policy.observe(stage, time.monotonic() - started)
+        return response_text, finish_reason
+
+    async def _request_model(self, model_name, system_prompt, messages, temperature, top_p, max_tokens,
+                             stream_buffer, stage=None, budget=None):
+        """
+        Send a chat completion request, queueing on the rate limiter and retrying failures.
+        Returns the response text and its finish_reason.
+        """
+        formatted_messages = self._format_messages(system_prompt, messages)
+        limiter = self.rate_limiters.get(model_name)
+        reserved_completion = limiter.completion_estimate(max_tokens)
+        estimated_tokens = self._estimate_tokens(formatted_messages, reserved_completion)
+        labels = {"stage": stage or "other", "model": model_name}
+        call_limit = self.call_semaphore or contextlib.nullcontext()
+
+        # Rate limits are handled by the shared limiter; other errors get exponential backoff
         max_retries = 5
         retry_delay = 1  # Initial delay in seconds
+        errors = 0
+        rate_limit_waits = 0
 
-        for attempt in range(max_retries):
+        while True:
+            queued_at = time.monotonic()
+            queued = True
+            self.metrics.add("maestro_calls_queued", 1, **labels)
             try:
-                response = self.client.chat.completions.create(
-                    model=model_name,
-                    messages=formatted_messages,
-                    temperature=temperature,
-                    top_p=top_p,
-                    max_tokens=max_tokens
-                )
-                return response.choices[0].message.content
+                # Queue on the rate limiter before taking a concurrency slot
+                await limiter.acquire_async(estimated_tokens)
+                # Only hold concurrency slots while the request is actually in flight
+                async with self._model_slot(model_name) as slot, call_limit:
+                    queued = self._leave_call_queue(labels, queued_at)
+                    with self.metrics.track("maestro_calls_in_flight", **labels):
+                        request_kwargs = self._build_request_kwargs(model_name, formatted_messages, temperature,
+                                                                    top_p, max_tokens, stream_buffer)
+                        started = time.monotonic()
+                        raw_response = await self._client_for(model_name).chat.completions.with_raw_response.create(
+                            **request_kwargs)
+                        limiter.update_from_headers(raw_response.headers)
+                        # with_raw_response parses synchronously on the async client too
+                        response = raw_response.parse()
+                        if stream_buffer is not None:
+                            response_text = await self._consume_stream(response, stream_buffer)
+                            usage, finish_reason = stream_buffer.usage, stream_buffer.finish_reason
+                        else:
+                            response_text = response.choices[0].message.content
+                            usage, finish_reason = response.usage, response.choices[0].finish_reason
+                    self._report_slot(slot, started, usage)
+                self._record_call_metrics(labels, started, usage, finish_reason)
+                limiter.settle(reserved_completion, self._completion_tokens(usage, response_text))
+                self._record_token_budget(budget, usage, response_text, finish_reason)
+                return response_text, finish_reason
+            except openai.RateLimitError as e:
+                if not self._should_retry_rate_limit(e, rate_limit_waits):
+                    print(f"[Agent {self.agent_id}] Rate limit error on {model_name}: {e}")
+                    self.metrics.inc("maestro_call_failures_total", **labels)
+                    raise
+                rate_limit_waits += 1
+                self.metrics.inc("maestro_retries_total", reason="rate_limit", **labels)
+                retry_after = limiter.handle_rate_limit_error(e)
+                print(f"[Agent {self.agent_id}] Rate limited on {model_name}. Queued for {retry_after:.2f} seconds...")
             except Exception as e:
-                if attempt < max_retries - 1:
-                    sleep_time = retry_delay * (2 ** attempt) + random.uniform(0, 1)
+                errors += 1
+                if errors < max_retries:
+                    self.metrics.inc("maestro_retries_total", reason="error", **labels)
+                    sleep_time = retry_delay * (2 ** (errors - 1)) + random.uniform(0, 1)
                     print(f"[Agent {self.agent_id}] API error: {e}. Retrying in {sleep_time:.2f} seconds...")
-                    time.sleep(sleep_time)
+                    await asyncio.sleep(sleep_time)
                 else:
+                    self.metrics.inc("maestro_call_failures_total", **labels)
                     print(f"[Agent {self.agent_id}] API error after {max_retries} attempts: {e}")
                     raise
+            finally:
+                if queued:
+                    self._leave_call_queue(labels, queued_at)
+
+    def _leave_call_queue(self, labels, queued_at):
+        """Record the time a call spent waiting for the rate limiter and a slot; returns False (no longer queued)."""
+        self.metrics.add("maestro_calls_queued", -1, **labels)
+        self.metrics.observe("maestro_queue_wait_seconds", time.monotonic() - queued_at, **labels)
+        return False
+
+    def _record_token_budget(self, budget, usage, response_text, finish_reason):
+        """Report a budgeted call's output size (estimated from its text if the API gave no usage)."""
+        if budget is None or self.token_budgeter is None:
+            return
+        self.token_budgeter.record(budget, self._completion_tokens(usage, response_text), finish_reason)
+
+    @staticmethod
+    def _completion_tokens(usage, response_text):
+        """Completion tokens of a call, estimated from its text if the API gave no usage."""
+        completion_tokens = getattr(usage, "completion_tokens", None) if usage is not None else None
+        if completion_tokens is None:
+            completion_tokens = len(response_text or "") // 4
+        return completion_tokens
+
+    @staticmethod
+    def _report_slot(slot, started, usage):
+        """Tell the model's concurrency limit how a successful call went."""
+        if slot is not None:
+            slot.record(time.monotonic() - started, getattr(usage, "completion_tokens", 0) if usage else 0)
+
+    def _record_call_metrics(self, labels, started, usage, finish_reason):
+        """Record the latency, token usage and finish reason of a successful call."""
+        self.metrics.observe("maestro_call_seconds", time.monotonic() - started, **labels)
+        self.metrics.inc("maestro_finish_reasons_total", finish_reason=finish_reason or "none", **labels)
+        if usage is not None:
+            self.metrics.inc("maestro_prompt_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, **labels)
+            self.metrics.inc("maestro_completion_tokens_total", getattr(usage, "completion_tokens", 0) or 0, **labels)
 
     def _parse_parts_from_b2_output(self, b2_output):
         """
@@ -343,253 +3315,938 @@ Upon receiving an outline you are to write out the complete and proper XML. Give
 
         return parts
 
-    def _process_part_with_a2(self, part_name, part_content, user_prompt, part_number):
+    async def _process_part_with_a2(self, part_name, part_content, user_prompt, part_number):
         """Process a single part with Model A2 and return the response."""
+        # Only parts that were not finished by an interrupted run are sent to the API
+        resumed = self._resume_part(part_number)
+        if resumed is not None:
+            return resumed
+
         print(f"[Agent {self.agent_id}] Processing part: {part_name} (Part {part_number})")
 
         # Create context for this specific part
-        part_context = f"Part: {part_name} (ID: P{part_number}) ---\n\n{part_content}\n\nPlease implement this part in proper MusicXML format using part ID P{part_number}."
+        part_context = self._build_part_prompt(part_name, part_content, part_number)
 
         # Call Model A2 for this part
         model_a2_messages = [{"role": "user", "content": part_context}]
-        model_a2_response = self._call_model(
+        model_a2_response, finish_reason = await self._call_model(
             self.model_a2_name,
             self.model_a2_system_prompt,
             model_a2_messages,
             self.model_a2_temperature,
             self.model_a2_top_p,
-            self.model_a2_max_tokens
+            self.model_a2_max_tokens,
+            stream_buffer=self._open_stream_buffer(part_number),
+            stage="A2",
+            return_finish_reason=True,
+            budget=self._plan_tokens("A2", self._part_measure_count(part_content), part_content,
+                                     with_header=part_number == 1)
+        )
+
+        return self._accept_part_response(part_name, part_content, part_number, model_a2_response, finish_reason)
+
+    def _accept_part_response(self, part_name, part_content, part_number, response, finish_reason):
+        """Add a part's first A2 response to the score and the journal, and return its part result."""
+        # Streamed responses were already parsed token by token
+        if not self.stream_a2:
+            self.score_assembler.feed(part_number, response)
+
+        response = self._spill(response)
+        part_result = {
+            "part_name": part_name,
+            "part_content": part_content,
+            "part_number": part_number,
+            "a2_response": response,
+            "finish_reason": finish_reason,
+            "segments": [(None, response)]
+        }
+        self._journal_part(part_result)
+
+        return part_result
+
+    def _spill(self, text):
+        """Move a response into the spill buffer in bounded-memory mode; otherwise return it unchanged."""
+        if self.spill is None or not isinstance(text, str):
+            return text
+        return self.spill.write(text)
+
+    @property
+    def task_key(self) -> str:
+        """Identifier of this agent's (category, prompt, trial) task in the checkpoint journal."""
+        category_id, prompt_id = self.prompt_id.split('_')[:2]
+        return f"Cat{category_id}_Prompt{prompt_id}_Trial{self.trial_num}"
+
+    def _resume_stage(self, stage):
+        """Return a stage output saved by an interrupted run, adding it to the history as if just received."""
+        if self.journal is None:
+            return None
+        output = self.journal.stage_output(self.task_key, stage)
+        if output is not None:
+            self.conversation_history.append({"role": f"Model {stage}", "content": self._spill(output)})
+            print(f"[Agent {self.agent_id}] Model {stage} resumed from checkpoint ({len(output)} chars)")
+            self._store_new_messages()
+        return output
+
+    def _journal_stage(self, stage, output):
+        if self.journal is not None:
+            self.journal.record_stage(self.task_key, stage, output)
+
+    def _record_stage(self, stage, output):
+        """Add a stage output to the conversation history and the checkpoint journal."""
+        self.conversation_history.append({"role": f"Model {stage}", "content": self._spill(output)})
+        print(f"[Agent {self.agent_id}] Model {stage} response received ({len(output)} chars)")
+        self._journal_stage(stage, output)
+        self._store_new_messages()
+
+    def _store_new_messages(self):
+        """Write the history entries added since the last call to the conversation store."""
+        if self.conversation_store is None or self._stored_messages >= len(self.conversation_history):
+            return
+        messages = []
+        for message in self.conversation_history[self._stored_messages:]:
+            stage = ConversationStore.message_stage(message["role"])
+            message = dict(message, content=str(message["content"]))
+            if stage[:2] in ("A1", "B1", "B2", "A2"):
+                model_name, _, temperature, top_p, _ = self._stage_settings(stage[:2])
+                message.update(model=model_name, temperature=temperature, top_p=top_p)
+            messages.append(message)
+        category_id, prompt_id = self.prompt_id.split('_')[:2]
+        self.conversation_store.write_messages(category_id, prompt_id, self.trial_num, self._stored_messages, messages)
+        self._stored_messages = len(self.conversation_history)
+
+    def _stage_settings(self, stage):
+        """Model name, system prompt, temperature, top_p and max_tokens used for a stage."""
+        if stage == "A1":
+            return (self.model_a_name, self.model_a_system_prompt, self.model_a_temperature, self.model_a_top_p,
+                    self.model_a_max_tokens)
+        if stage == "B1":
+            return (self.model_b_name, self.model_b_system_prompt, self.model_b_temperature, self.model_b_top_p,
+                    self.model_b_max_tokens)
+        if stage == "B2":
+            return (self.model_b2_name, self.model_b2_system_prompt, self.model_b2_temperature, self.model_b2_top_p,
+                    self.model_b2_max_tokens)
+        return (self.model_a2_name, self.model_a2_system_prompt, self.model_a2_temperature, self.model_a2_top_p,
+                self.model_a2_max_tokens)
+
+    def _resume_part(self, part_number):
+        """
+        Return an A2 part result saved by an interrupted run, if any. Its responses are parsed again exactly as
+        the run parsed them: continuations of the part text after a blank line, and tail continuations, shards
+        and repairs as their own segments, so a response cut off mid-tag cannot swallow the one after it.
+        """
+        if self.journal is None:
+            return None
+        part_result = self.journal.part_result(self.task_key, part_number)
+        if part_result is None:
+            return None
+        print(f"[Agent {self.agent_id}] Part {part_number} resumed from checkpoint")
+        # Journals written before segments were recorded hold the whole part text
+        segments = part_result.pop("segments", None) or [(None, part_result["a2_response"])]
+        part_result["segments"] = []
+        for index, (segment, text) in enumerate(segments):
+            if segment is None:
+                self.score_assembler.feed(part_number, "\n\n" + text if index else text)
+            else:
+                self.score_assembler.feed(part_number, text, segment=segment)
+                # Later segments of this run must not reuse a replayed segment's name
+                self._continuation_count = max(self._continuation_count, int(segment.rsplit("-", 1)[1]))
+            part_result["segments"].append((segment, self._spill(text)))
+        texts = [text for _, text in part_result["segments"]]
+        part_result["a2_response"] = self.spill.join("\n\n", texts) if self.spill is not None else "\n\n".join(texts)
+        return part_result
+
+    def _journal_part(self, part_result):
+        if self.journal is not None:
+            self.journal.record_part(self.task_key, part_result)
+
+    def _build_part_prompt(self, part_name, part_content, part_number):
+        """Build the initial A2 prompt for a single part."""
+        return f"Part: {part_name} (ID: P{part_number}) ---\n\n{part_content}\n\nPlease implement this part in proper MusicXML format using part ID P{part_number}."
+
+    @staticmethod
+    def _outline_part_name(part_content):
+        """
+        Instrument a part's outline names on the line after its tag (e.g. "Violin I: melody"), or None.
+        Used as the part name and for the playability check when A2 does not declare one.
+        """
+        lines = [line for line in part_content.splitlines()[1:] if line.strip()]
+        if not lines:
+            return None
+        name = re.sub(r'[*_#`>]', '', lines[0])
+        name = re.split(r':| - | – | — ', name, maxsplit=1)[0].strip(" ()[]")
+        if not name or len(name) > 40 or re.match(r'(?:[Mm]easures?|[Mm]m?\.)\s*\d', name):
+            return None
+        return name
+
+    def _planned_measure_count(self, part_content):
+        """Highest measure number mentioned in a part's outline, or None if it gives no measure numbers."""
+        numbers = []
+        for start, end in re.findall(r'\b(?:[Mm]easures?|[Mm]m?\.)\s*(\d+)(?:\s*(?:-|–|—|to)\s*(\d+))?', part_content):
+            numbers.append(int(end or start))
+        return max(numbers) if numbers else None
+
+    def _requested_measure_count(self, user_prompt):
+        """Measure count asked for in the user prompt (e.g. "24 measures"), or None."""
+        return requested_measure_count(user_prompt)
+
+    def _part_measure_count(self, part_content):
+        """Measures planned for a part: from its outline, else the count asked for in the prompt."""
+        return self._planned_measure_count(part_content) or self.requested_measures
+
+    def _plan_tokens(self, stage, measures=None, description="", with_header=False):
+        """Token budget for a call, or None to send the stage's flat max_tokens."""
+        if self.token_budgeter is None:
+            return None
+        return self.token_budgeter.plan(stage, measures, description, ceiling=self._stage_settings(stage)[4],
+                                        with_header=with_header)
+
+    def _plan_continuation_tokens(self, part_result):
+        """Token budget for the measures a part still has to write."""
+        planned = self._part_measure_count(part_result["part_content"])
+        remaining = None
+        if planned:
+            remaining = max(1, planned - self.score_assembler.next_measure_number(part_result["part_number"]) + 1)
+        return self._plan_tokens("A2-cont", remaining, part_result["part_content"])
+
+    def _build_continuation_prompt(self, part_result):
+        """Build the A2 continuation prompt for a part that has not been completed yet."""
+        part_name = part_result["part_name"]
+        part_content = part_result["part_content"]
+        part_number = part_result["part_number"]
+        previous_response = part_result["a2_response"]
+
+        if self.continuation_mode == "tail":
+            return self._build_tail_continuation_prompt(part_result)
+
+        return f"Part: {part_name} (ID: P{part_number}) ---\n\n{part_content}\n\n--- Previous Implementation ---\n\n{previous_response}\n\nContinue the existing composition for this part, maintaining part ID P{part_number}."
+
+    def _build_tail_continuation_prompt(self, part_result):
+        """
+        Build a continuation prompt from the part plan and only the last few completed measures,
+        so input tokens stay constant instead of growing with every continuation.
+        """
+        part_name = part_result["part_name"]
+        part_number = part_result["part_number"]
+        next_measure = self.score_assembler.next_measure_number(part_number)
+        planned = self._planned_measure_count(part_result["part_content"])
+        last_measures = "\n".join(self.score_assembler.last_measures(part_number, self.tail_measures))
+
+        closing = "</part>"
+        if "Last Part" in part_name or "Complete Composition" in part_name or "Only Part" in part_name:
+            closing = "</part> and then </score-partwise>"
+        length_note = f" of {planned}" if planned else ""
+
+        return (f"Part: {part_name} (ID: P{part_number}) ---\n\n{part_result['part_content']}\n\n"
+                f"--- Last Completed Measures ---\n\n{last_measures or '(none)'}\n\n"
+                f"Continue this part starting at measure {next_measure}{length_note}. Write only the <measure> elements "
+                f"from measure {next_measure} onward, then close with {closing}. "
+                f"Do not repeat earlier measures, the part-list or any XML header.")
+
+    def _continuation_segment(self):
+        """Assembler segment for a tail-only continuation, or None when continuations extend the raw part text."""
+        if self.continuation_mode != "tail":
+            return None
+        self._continuation_count += 1
+        return f"continuation-{self._continuation_count}"
+
+    def _part_reached_plan(self, part_result):
+        """True if the assembled part already has every measure its outline plans for."""
+        planned = self._planned_measure_count(part_result["part_content"])
+        return planned is not None and self.score_assembler.next_measure_number(part_result["part_number"]) > planned
+
+    async def _continue_part_with_a2(self, part_result):
+        """Ask Model A2 to continue an incomplete part; returns the new text, its finish reason and segment."""
+        # Full continuations pick up from the last token and are parsed as more text of the same part;
+        # tail-only continuations are parsed on their own and spliced in by measure number
+        segment = self._continuation_segment()
+        base_text = part_result["a2_response"] + "\n\n" if segment is None else ""
+        continuation_response, finish_reason = await self._call_model(
+            self.model_a2_name,
+            self.model_a2_system_prompt,
+            [{"role": "user", "content": self._build_continuation_prompt(part_result)}],
+            self.model_a2_temperature,
+            self.model_a2_top_p,
+            self.model_a2_max_tokens,
+            stream_buffer=self._open_stream_buffer(part_result["part_number"], base_text, segment),
+            stage="A2-cont",
+            return_finish_reason=True,
+            budget=self._plan_continuation_tokens(part_result)
         )
 
+        if not self.stream_a2:
+            self.score_assembler.feed(part_result["part_number"], "\n\n" + continuation_response, segment=segment)
+
+        return continuation_response, finish_reason, segment
+
+    def _part_needs_continuation(self, part_result):
+        """True if the last A2 call for a part was cut off by the token limit."""
+        finish_reason = part_result.get("finish_reason")
+        if finish_reason is not None:
+            return finish_reason == "length"
+
+        # Cached and older checkpointed responses carry no finish reason; fall back to whether the part was closed
+        if self.continuation_mode == "tail" and self._part_reached_plan(part_result):
+            return False
+        return "</part>" not in part_result["a2_response"]
+
+    def _apply_continuation(self, part_result, continuation_response, finish_reason, segment=None):
+        """Append a continuation to its part and return its record for the conversation history."""
+        continuation_response = self._spill(continuation_response)
+        part_result["a2_response"] = part_result["a2_response"] + "\n\n" + continuation_response
+        part_result["segments"].append((segment, continuation_response))
+        part_result["finish_reason"] = finish_reason
+        self._journal_part(part_result)
+
         return {
+            "part_name": part_result["part_name"],
+            "part_number": part_result["part_number"],
+            "continuation": continuation_response
+        }
+
+    async def _continue_part_until_done(self, part_result, max_iterations):
+        """
+        Keep continuing one part until the model stops on its own or the part has used max_iterations calls.
+        Returns the continuation records for the conversation history.
+        """
+        part_name = part_result["part_name"]
+        part_number = part_result["part_number"]
+        continuations = []
+        calls = 1
+        while self._part_needs_continuation(part_result) and not self.stop_requested and not self.abort_reason:
+            if calls >= max_iterations:
+                print(f"[Agent {self.agent_id}] Part {part_name} (Part {part_number}) still truncated after {calls} calls")
+                break
+            calls += 1
+            print(f"[Agent {self.agent_id}] Continuing part: {part_name} (Part {part_number}), call {calls}")
+            try:
+                continuation_response, finish_reason, segment = await self._continue_part_with_a2(part_result)
+            except Exception as exc:
+                print(
+                    f"[Agent {self.agent_id}] Continuation for part {part_name} (Part {part_number}) generated an exception: {exc}")
+                break
+            continuations.append(self._apply_continuation(part_result, continuation_response, finish_reason, segment))
+        return continuations
+
+    def _measure_shards(self, part_content):
+        """
+        Measure ranges a part is split into when sharding is on, e.g. [(1, 10), (11, 20), ...].
+        Empty when sharding is off, the part's length is unknown or it fits in one shard.
+        """
+        planned = self._part_measure_count(part_content)
+        if not self.shard_measures or not planned or planned <= self.shard_measures:
+            return []
+        return self._split_range(1, planned)
+
+    def _split_range(self, first, last):
+        """Split first..last into near-equal ranges of at most shard_measures measures."""
+        count = -(-(last - first + 1) // self.shard_measures)
+        size, extra = divmod(last - first + 1, count)
+        ranges = []
+        for index in range(count):
+            end = first + size + (1 if index < extra else 0) - 1
+            ranges.append((first, end))
+            first = end + 1
+        return ranges
+
+    def _missing_measure_ranges(self, part_number, planned):
+        """Shard-sized ranges of the planned measures 1..planned that no shard has written yet."""
+        written = self.score_assembler.measures(part_number)
+        gaps = []
+        for number in range(1, planned + 1):
+            if str(number) in written:
+                continue
+            if gaps and gaps[-1][1] == number - 1:
+                gaps[-1] = (gaps[-1][0], number)
+            else:
+                gaps.append((number, number))
+        return [shard for first, last in gaps for shard in self._split_range(first, last)]
+
+    def _plan_excerpt(self, part_content, measure):
+        """Lines of a part's outline that cover the given measure."""
+        lines = []
+        for line in part_content.splitlines():
+            for start, end in re.findall(r'\b(?:[Mm]easures?|[Mm]m?\.)\s*(\d+)(?:\s*(?:-|–|—|to)\s*(\d+))?', line):
+                if int(start) <= measure <= int(end or start):
+                    lines.append(line.strip())
+                    break
+        return "\n".join(lines)
+
+    def _build_shard_prompt(self, part_name, part_content, part_number, first, last, planned):
+        """
+        Ask A2 for measures first..last of a part. The first shard opens the part as usual; later shards get
+        the measures before them if already written, else the plan for the measure before them.
+        """
+        if first == 1:
+            return (f"{self._build_part_prompt(part_name, part_content, part_number)}\n\n"
+                    f"Write only measures 1 to {last} of the {planned} planned for this part, then close the part. "
+                    f"The remaining measures are written separately.")
+
+        preceding = [measure for number, measure in sorted(self.score_assembler.measures(part_number).items(),
+                                                           key=lambda item: PartStream._measure_key(item[0]))
+                     if str(number).isdigit() and int(number) < first][-self.tail_measures:]
+        if preceding:
+            context = "--- Preceding Measures ---\n\n" + "\n".join(preceding)
+        else:
+            plan = self._plan_excerpt(part_content, first - 1)
+            context = (f"--- Plan For Measure {first - 1} ---\n\n{plan or '(see the outline above)'}\n\n"
+                       f"Measures before {first} are being written at the same time; follow on from this plan.")
+
+        return (f"Part: {part_name} (ID: P{part_number}) ---\n\n{part_content}\n\n{context}\n\n"
+                f"Write measures {first} to {last} of the {planned} planned for this part. Begin measure {first} with "
+                f"an <attributes> element restating the divisions, and keep the part's key, meter and style. Write "
+                f"only the <measure> elements numbered {first} to {last}, with no part, part-list or XML header.")
+
+    def _shard_segment(self, first):
+        self._continuation_count += 1
+        return f"shard-{first}-{self._continuation_count}"
+
+    async def _write_shard(self, part_name, part_content, part_number, first, last, planned, stage="A2"):
+        """Write one measure range of a part as an assembler segment; returns the text, finish reason and segment."""
+        segment = self._shard_segment(first)
+        response, finish_reason = await self._call_model(
+            self.model_a2_name,
+            self.model_a2_system_prompt,
+            [{"role": "user", "content": self._build_shard_prompt(part_name, part_content, part_number, first, last,
+                                                                  planned)}],
+            self.model_a2_temperature,
+            self.model_a2_top_p,
+            self.model_a2_max_tokens,
+            stream_buffer=self._open_stream_buffer(part_number, "", segment),
+            stage=stage,
+            return_finish_reason=True,
+            budget=self._plan_tokens(stage, last - first + 1, part_content, with_header=part_number == 1 and first == 1)
+        )
+        if not self.stream_a2:
+            self.score_assembler.feed(part_number, response, segment=segment)
+        return response, finish_reason, segment
+
+    def _accept_shard_responses(self, part_name, part_content, part_number, shards, responses):
+        """Combine the first round of shards into a part result (in measure order) and journal it."""
+        segments = []
+        for (first, last), response in zip(shards, responses):
+            if isinstance(response, Exception):
+                print(f"[Agent {self.agent_id}] Part {part_number} measures {first}-{last} generated an exception: "
+                      f"{response}")
+            else:
+                segments.append((response[2], self._spill(response[0])))
+        texts = [text for _, text in segments]
+        planned = shards[-1][1]
+        part_result = {
             "part_name": part_name,
             "part_content": part_content,
             "part_number": part_number,
-            "a2_response": model_a2_response
+            "a2_response": self.spill.join("\n\n", texts) if self.spill is not None else "\n\n".join(texts),
+            "finish_reason": "length" if self._missing_measure_ranges(part_number, planned) else "stop",
+            "segments": segments
+        }
+        self._journal_part(part_result)
+        return part_result
+
+    def _apply_shard(self, part_result, response, segment):
+        """Keep a re-requested shard in the part text (spliced by measure number) and journal it."""
+        response = self._spill(response)
+        part_result["a2_response"] = part_result["a2_response"] + "\n\n" + response
+        part_result["segments"].append((segment, response))
+        self._journal_part(part_result)
+        return {
+            "part_name": part_result["part_name"],
+            "part_number": part_result["part_number"],
+            "continuation": response,
+            "label": "Shard"
         }
 
-    def _is_xml_complete(self, xml_content):
-        """Check if the XML content is complete with proper closing tags."""
-        return "</score-partwise>" in xml_content
+    def _finish_sharded_part(self, part_result, planned, calls):
+        """Record whether a sharded part still has missing measures."""
+        missing = self._missing_measure_ranges(part_result["part_number"], planned)
+        part_result["finish_reason"] = "length" if missing else "stop"
+        self._journal_part(part_result)
+        if missing:
+            print(f"[Agent {self.agent_id}] Part {part_result['part_number']} still misses measures "
+                  f"{', '.join(f'{first}-{last}' for first, last in missing)} after {calls} calls")
+
+    async def _process_part_in_shards(self, part_name, part_content, part_number, shards):
+        """Write every measure range of a part concurrently and stitch them together by measure number."""
+        resumed = self._resume_part(part_number)
+        if resumed is not None:
+            return resumed
+
+        print(f"[Agent {self.agent_id}] Processing part: {part_name} (Part {part_number}) in {len(shards)} shards "
+              f"of measures {', '.join(f'{first}-{last}' for first, last in shards)}")
+        planned = shards[-1][1]
+        responses = await asyncio.gather(
+            *[self._write_shard(part_name, part_content, part_number, first, last, planned)
+              for first, last in shards],
+            return_exceptions=True
+        )
+        return self._accept_shard_responses(part_name, part_content, part_number, shards, responses)
 
-    def generate_conversation(self, user_prompt: str, max_iterations: int = 3, skip_initial_model_a: bool = False):
-        """Generate a conversation between models A, B, B2, and A2"""
+    async def _fill_missing_measures(self, part_result, max_iterations):
+        """
+        Re-request the measure ranges that truncated or failed shards left out, with the measures before them as
+        context, until none are missing or the part has used max_iterations rounds. Returns the shard records.
+        """
+        part_number = part_result["part_number"]
+        planned = self._part_measure_count(part_result["part_content"])
+        records = []
+        calls = 1
+        while not self.stop_requested and not self.abort_reason:
+            missing = self._missing_measure_ranges(part_number, planned)
+            if not missing or calls >= max_iterations:
+                break
+            calls += 1
+            print(f"[Agent {self.agent_id}] Part {part_number}: re-requesting measures "
+                  f"{', '.join(f'{first}-{last}' for first, last in missing)}")
+            responses = await asyncio.gather(
+                *[self._write_shard(part_result["part_name"], part_result["part_content"], part_number, first, last,
+                                    planned, "A2-cont")
+                  for first, last in missing],
+                return_exceptions=True
+            )
+            for (first, last), response in zip(missing, responses):
+                if isinstance(response, Exception):
+                    print(f"[Agent {self.agent_id}] Part {part_number} measures {first}-{last} generated an "
+                          f"exception: {response}")
+                    continue
+                records.append(self._apply_shard(part_result, response[0], response[2]))
+        self._finish_sharded_part(part_result, planned, calls)
+        return records
+
+    def _abort_trial(self, reason):
+        """Stop every part of this trial: no further A2 calls are made for it."""
+        if not self.abort_reason:
+            self.abort_reason = reason
+            print(f"[Agent {self.agent_id}] Aborting trial: {reason}")
+        raise TrialAbortedError(self.abort_reason)
+
+    def _check_part_structure(self, part_result, part_count):
+        """Abort the trial if A2's parts cannot add up to the score B2 planned."""
+        if part_count <= 1:
+            # A single "Only Part" response legitimately contains the whole score
+            return
+        declared_parts = self.score_assembler.declared_part_count()
+        if declared_parts and declared_parts != part_count:
+            self._abort_trial(f"A2 declared {declared_parts} parts in its part-list but B2 planned {part_count}")
+        # Shards of one part may each wrap their measures in the same <part>; only distinct ids are a problem
+        written_parts = len(set(re.findall(r'<part\s+id="([^"]*)"', str(part_result["a2_response"]))))
+        if written_parts > 1:
+            self._abort_trial(f"A2 wrote {written_parts} <part> elements for part {part_result['part_number']}")
+
+    def _default_measure_length(self):
+        """Measure length (quarter notes) from the first time signature written in any part, if any."""
+        for part_number in self.score_assembler.part_numbers():
+            for measure_xml in self.score_assembler.measures(part_number).values():
+                if "<time" not in measure_xml:
+                    continue
+                try:
+                    measure = ET.fromstring(measure_xml)
+                except ET.ParseError:
+                    continue
+                for attributes in measure.iter("attributes"):
+                    measure_length = MeasureValidator.parse_time(attributes)
+                    if measure_length:
+                        return measure_length
+        return None
+
+    def _run_cpu(self, fn, *args):
+        """Run CPU-bound post-processing on the batch's worker processes, or on this thread without a pool."""
+        if self.cpu_pool is None:
+            return fn(*args)
+        return self.cpu_pool.run(fn, *args)
+
+    async def _run_cpu_async(self, fn, *args):
+        """Run CPU-bound post-processing on the batch's worker processes without blocking the event loop."""
+        if self.cpu_pool is None:
+            return fn(*args)
+        return await asyncio.wrap_future(self.cpu_pool.submit(fn, *args))
+
+    def _validation_args(self, part_result):
+        part_number = part_result["part_number"]
+        return (self.score_assembler.measures(part_number), self._default_measure_length(),
+                self.score_assembler.part_name(part_number) if self.check_playability else None)
+
+    def _validate_part(self, part_result):
+        """
+        Measures of a part whose voices do not add up to the time signature and, with check_playability,
+        measures with notes the instrument cannot play.
+        """
+        return self._run_cpu(validate_part_measures, *self._validation_args(part_result))
+
+    async def _validate_part_async(self, part_result):
+        return await self._run_cpu_async(validate_part_measures, *self._validation_args(part_result))
+
+    @staticmethod
+    def _describe_issue(issue):
+        if "problem" in issue:
+            return f"- Measure {issue['measure']}: {issue['problem']}"
+        return (f"- Measure {issue['measure']}, voice {issue['voice']}: {float(issue['actual']):g} quarter notes, "
+                f"the time signature requires {float(issue['expected']):g}")
+
+    def _build_repair_prompt(self, part_result, first, last, issues):
+        """Ask A2 to rewrite only the measures in first..last, showing what is wrong with them."""
+        part_number = part_result["part_number"]
+        measures = self.score_assembler.measures(part_number)
+        current = "\n".join(measures[str(number)] for number in range(first, last + 1) if str(number) in measures)
+        problems = "\n".join(self._describe_issue(issue) for issue in issues)
+        span = f"measure {first}" if first == last else f"measures {first} to {last}"
+        if all("problem" in issue for issue in issues):
+            heading, goal = "These measures are not playable:", "every note is playable on the instrument"
+        elif any("problem" in issue for issue in issues):
+            heading = "These measures do not add up to the time signature or are not playable:"
+            goal = ("every voice fills each measure exactly, counting dots and triplets, and every note is playable "
+                    "on the instrument")
+        else:
+            heading = "These measures do not add up to the time signature:"
+            goal = "every voice fills each measure exactly, counting dots and triplets"
+
+        return (f"Part: {part_result['part_name']} (ID: P{part_number}) ---\n\n{part_result['part_content']}\n\n"
+                f"--- Measures To Fix ---\n\n{current}\n\n"
+                f"{heading}\n{problems}\n\n"
+                f"Rewrite {span} so {goal}. Keep the "
+                f"same measure numbers and as much of the music as possible. Write only the <measure> elements, "
+                f"with no part, part-list or XML header.")
+
+    def _repair_segment(self):
+        self._continuation_count += 1
+        return f"repair-{self._continuation_count}"
+
+    def _apply_repair(self, part_result, repair_response, segment):
+        """Keep a repair in the part text (later measures replace earlier ones by number) and journal it."""
+        repair_response = self._spill(repair_response)
+        part_result["a2_response"] = part_result["a2_response"] + "\n\n" + repair_response
+        part_result["segments"].append((segment, repair_response))
+        self._journal_part(part_result)
+        return {
+            "part_name": part_result["part_name"],
+            "part_number": part_result["part_number"],
+            "continuation": repair_response,
+            "label": "Fix"
+        }
+
+    def _report_validation(self, part_result, issues):
+        part_result["invalid_measures"] = sorted({str(issue["measure"]) for issue in issues},
+                                                 key=PartStream._measure_key)
+        if issues:
+            print(f"[Agent {self.agent_id}] Part {part_result['part_number']} still has measures that fail "
+                  f"validation: {', '.join(part_result['invalid_measures'])}")
+        for issue in issues:
+            if "kind" in issue:
+                self.metrics.inc("maestro_playability_issues_total", kind=issue["kind"], instrument=issue["instrument"])
+
+    async def _repair_part(self, part_result):
+        """Re-request only the measure ranges that fail validation; returns the repair records."""
+        repairs = []
+        issues = await self._validate_part_async(part_result)
+        for _ in range(self.repair_rounds):
+            if not issues or self.stop_requested or self.abort_reason:
+                break
+            ranges = MeasureValidator.issue_ranges(issues)[:self.max_repair_ranges]
+            print(f"[Agent {self.agent_id}] Part {part_result['part_number']}: re-requesting {len(ranges)} "
+                  f"measure ranges that fail validation")
+            responses = await asyncio.gather(
+                *[self._call_model(
+                    self.model_a2_name,
+                    self.model_a2_system_prompt,
+                    [{"role": "user", "content": self._build_repair_prompt(part_result, first, last, range_issues)}],
+                    self.model_a2_temperature,
+                    self.model_a2_top_p,
+                    self.model_a2_max_tokens,
+                    stage="A2-fix",
+                    budget=self._plan_tokens("A2-fix", last - first + 1, part_result["part_content"])
+                ) for first, last, range_issues in ranges],
+                return_exceptions=True
+            )
+            for (first, last, _), repair_response in zip(ranges, responses):
+                if isinstance(repair_response, Exception):
+                    print(f"[Agent {self.agent_id}] Repair of part {part_result['part_number']} measures "
+                          f"{first}-{last} generated an exception: {repair_response}")
+                    continue
+                segment = self._repair_segment()
+                self.score_assembler.feed(part_result["part_number"], repair_response, segment=segment)
+                repairs.append(self._apply_repair(part_result, repair_response, segment))
+            issues = await self._validate_part_async(part_result)
+        self._report_validation(part_result, issues)
+        return repairs
+
+    def _score_measures(self):
+        """Every measure of the score, keyed by (part number, measure number)."""
+        return {(part_number, number): measure_xml for part_number in self.score_assembler.part_numbers()
+                for number, measure_xml in self.score_assembler.measures(part_number).items()}
+
+    def _report_note_variety(self):
+        """Warn when the score uses fewer distinct note lengths than the system prompts require."""
+        return self._warn_note_variety(self._run_cpu(MeasureValidator.note_lengths, self._score_measures()))
+
+    async def _report_note_variety_async(self):
+        return self._warn_note_variety(
+            await self._run_cpu_async(MeasureValidator.note_lengths, self._score_measures()))
+
+    def _warn_note_variety(self, lengths):
+        if lengths and len(lengths) < MIN_NOTE_LENGTHS:
+            print(f"[Agent {self.agent_id}] Score uses only {len(lengths)} distinct note lengths "
+                  f"(at least {MIN_NOTE_LENGTHS} required)")
+        return len(lengths)
+
+    def _finish_aborted_trial(self, a2_results):
+        """Save what an aborted trial produced, mark it done in the journal and raise TrialAbortedError."""
+        self._record_a2_history(a2_results)
+        self.conversation_history.append({"role": "Validator", "content": f"Trial aborted: {self.abort_reason}"})
+        self.save_incremental_output()
+        self._wait_for_score_write()
+        self.save_conversation()
+        if self.journal is not None:
+            self.journal.record_done(self.task_key, aborted_reason=self.abort_reason)
+        self._copy_outputs_to_aliases()
+        raise TrialAbortedError(self.abort_reason)
+
+    async def _run_part_a2(self, part_name, part_content, user_prompt, part_number, max_iterations, part_count=1):
+        """
+        Write one part with Model A2 (as parallel measure-range shards if it is long enough), continue it
+        independently of the other parts, re-request any measures that fail validation and save it once done.
+        """
+        if self.abort_reason:
+            raise TrialAbortedError(self.abort_reason)
+        self.score_assembler.set_part_name(part_number, self._outline_part_name(part_content))
+        shards = self._measure_shards(part_content)
+        if shards:
+            part_result = await self._process_part_in_shards(part_name, part_content, part_number, shards)
+        else:
+            part_result = await self._process_part_with_a2(part_name, part_content, user_prompt, part_number)
+        self._check_part_structure(part_result, part_count)
+        initial_response = part_result["a2_response"]
+        if shards:
+            continuations = await self._fill_missing_measures(part_result, max_iterations)
+        else:
+            continuations = await self._continue_part_until_done(part_result, max_iterations)
+        if self.validate_measures:
+            continuations += await self._repair_part(part_result)
+        print(f"[Agent {self.agent_id}] Completed processing part: {part_name} (Part {part_number})")
+        self.save_incremental_output()
+        return part_result, initial_response, continuations
+
+    def _record_a2_history(self, a2_results):
+        """Add the A2 parts, then their continuations, to the conversation history in part order."""
+        a2_results.sort(key=lambda result: result[0]["part_number"])
+        initial_responses = [initial_response for _, initial_response, _ in a2_results]
+        if self.spill is not None:
+            combined_a2_response = self.spill.join("\n\n", initial_responses)
+        else:
+            combined_a2_response = "\n\n".join(initial_responses)
+        self.conversation_history.append({"role": "Model A2", "content": combined_a2_response})
+        print(f"[Agent {self.agent_id}] Combined Model A2 responses ({len(combined_a2_response)} chars)")
+
+        for _, _, continuations in a2_results:
+            for cont in continuations:
+                self.conversation_history.append(
+                    {"role": f"Model A2 ({cont.get('label', 'Cont.')} - {cont['part_name']} P{cont['part_number']})",
+                     "content": cont["continuation"]}
+                )
+        self._store_new_messages()
+
+    def start_conversation(self, user_prompt: str):
+        """Reset the conversation and composition state for a new prompt."""
         # Reset conversation history
         self.conversation_history = []
 
         # Reset composition state
-        composition_complete = False
         self.current_xml_filename = None
+        self.spill = SpillBuffer(self.spill_dir) if self.bounded_memory else None
+        self.score_assembler = ScoreAssembler(min_write_interval=0.5, spill=self.spill)
+        self.abort_reason = None
+        self.requested_measures = self._requested_measure_count(user_prompt)
 
-        # Record the user prompt at the beginning
+        # Record the user prompt at the beginning; a rerun of the trial replaces what the store holds for it
         self.conversation_history.append({"role": "User", "content": user_prompt})
+        self._stored_messages = 0
+        if self.conversation_store is not None:
+            category_id, prompt_id = self.prompt_id.split('_')[:2]
+            self.conversation_store.clear_trial(category_id, prompt_id, self.trial_num)
+            self._store_new_messages()
         print(f"[Agent {self.agent_id}] Starting generation for prompt: {user_prompt[:100]}...")
 
+    async def run_stage_a1_async(self, user_prompt: str, skip_initial_model_a: bool = False):
+        """Stage A1: initial plan from Model A, or the raw prompt when A1 is skipped."""
         # Call Model A or skip if requested
         if not skip_initial_model_a:
+            # Reuse the output of an interrupted run if it was journaled
+            resumed = self._resume_stage("A1")
+            if resumed is not None:
+                return resumed
+
             model_a_initial_messages = [{"role": "user", "content": user_prompt}]
-            model_a_response = self._call_model(
+            model_a_response = await self._call_model(
                 self.model_a_name,
                 self.model_a_system_prompt,
                 model_a_initial_messages,
                 self.model_a_temperature,
                 self.model_a_top_p,
-                self.model_a_max_tokens
+                self.model_a_max_tokens,
+                stage="A1",
+                budget=self._plan_tokens("A1", self.requested_measures)
             )
-            self.conversation_history.append({"role": "Model A1", "content": model_a_response})
-            print(f"[Agent {self.agent_id}] Model A1 response received ({len(model_a_response)} chars)")
+            self._record_stage("A1", model_a_response)
         else:
             self.conversation_history.append({"role": "Model A1", "content": "[Initial Model A response skipped]"})
             model_a_response = user_prompt
             print(f"[Agent {self.agent_id}] Model A1 response skipped")
 
+        return model_a_response
+
+    async def run_stage_b1_async(self, model_a_response):
+        """Stage B1: first refinement of the plan by Model B."""
+        # Reuse the output of an interrupted run if it was journaled
+        resumed = self._resume_stage("B1")
+        if resumed is not None:
+            return resumed
+
         # Call Model B (B1) - First refinement step
-        model_b_messages = [{"role": "user", "content": model_a_response}]
-        model_b_response = self._call_model(
+        model_b_response = await self._call_model(
             self.model_b_name,
             self.model_b_system_prompt,
-            model_b_messages,
+            [{"role": "user", "content": model_a_response}],
             self.model_b_temperature,
             self.model_b_top_p,
-            self.model_b_max_tokens
+            self.model_b_max_tokens,
+            stage="B1",
+            budget=self._plan_tokens("B1", self.requested_measures)
         )
-        self.conversation_history.append({"role": "Model B1", "content": model_b_response})
-        print(f"[Agent {self.agent_id}] Model B1 response received ({len(model_b_response)} chars)")
+        self._record_stage("B1", model_b_response)
+
+        return model_b_response
+
+    async def run_stage_b2_async(self, model_b_response):
+        """Stage B2: organize the refined outline into tagged instrument parts."""
+        # Reuse the output of an interrupted run if it was journaled
+        resumed = self._resume_stage("B2")
+        if resumed is not None:
+            return resumed
 
         # Call Model B2 (Second refinement step) - B2 receives B1's output
-        model_b2_messages = [{"role": "user", "content": model_b_response}]
-        model_b2_response = self._call_model(
+        model_b2_response = await self._call_model(
             self.model_b2_name,
             self.model_b2_system_prompt,
-            model_b2_messages,
+            [{"role": "user", "content": model_b_response}],
             self.model_b2_temperature,
             self.model_b2_top_p,
-            self.model_b2_max_tokens
+            self.model_b2_max_tokens,
+            stage="B2",
+            budget=self._plan_tokens("B2", self.requested_measures)
         )
-        self.conversation_history.append({"role": "Model B2", "content": model_b2_response})
-        print(f"[Agent {self.agent_id}] Model B2 response received ({len(model_b2_response)} chars)")
+        self._record_stage("B2", model_b2_response)
+
+        return model_b2_response
 
+    async def run_stage_a2_async(self, model_b2_response, user_prompt: str, max_iterations: int = 3):
+        """
+        Stage A2: write each part as MusicXML. Every part runs its own continuation loop (up to max_iterations calls),
+        and is written to the score as soon as it finishes. Returns True if no part was left truncated.
+        """
         # Parse B2's output into separate parts
         parts = self._parse_parts_from_b2_output(model_b2_response)
         print(f"[Agent {self.agent_id}] Parsed {len(parts)} parts from Model B2 output")
 
-        # Process parts in parallel using Model A2
-        all_a2_responses = []
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(parts))) as executor:
-            # Submit all parts for processing
-            future_to_part = {
-                executor.submit(
-                    self._process_part_with_a2,
-                    part_name,
-                    part_content,
-                    user_prompt,
-                    part_number  # Pass the part number
-                ): (part_name, part_content, part_number)
-                for part_name, part_content, part_number in parts
-            }
-
-            # Process results as they complete
-            for future in concurrent.futures.as_completed(future_to_part):
-                part_name, _, part_number = future_to_part[future]
-                try:
-                    result = future.result()
-                    all_a2_responses.append(result)
-                    print(f"[Agent {self.agent_id}] Completed processing part: {part_name} (Part {part_number})")
-                except Exception as exc:
-                    print(
-                        f"[Agent {self.agent_id}] Part {part_name} (Part {part_number}) generated an exception: {exc}")
+        # Process all parts concurrently using Model A2
+        results = await asyncio.gather(
+            *[self._run_part_a2(part_name, part_content, user_prompt, part_number, max_iterations, len(parts))
+              for part_name, part_content, part_number in parts],
+            return_exceptions=True
+        )
 
-        # Sort responses by their original order
-        all_a2_responses.sort(key=lambda x: x["part_number"])
+        a2_results = []
+        for (part_name, _, part_number), result in zip(parts, results):
+            if isinstance(result, TrialAbortedError):
+                continue
+            if isinstance(result, Exception):
+                print(f"[Agent {self.agent_id}] Part {part_name} (Part {part_number}) generated an exception: {result}")
+            else:
+                a2_results.append(result)
 
-        # Combine all A2 responses
-        combined_a2_response = "\n\n".join([resp["a2_response"] for resp in all_a2_responses])
+        if self.abort_reason:
+            await asyncio.to_thread(self._finish_aborted_trial, a2_results)
 
-        # Add to conversation history
-        self.conversation_history.append({"role": "Model A2", "content": combined_a2_response})
-        print(f"[Agent {self.agent_id}] Combined Model A2 responses ({len(combined_a2_response)} chars)")
+        self._record_a2_history(a2_results)
+        await self._report_note_variety_async()
+        self.save_incremental_output()
+        await self._wait_for_score_write_async()
 
-        # Save the combined output
-        accumulated_context = combined_a2_response
-        self.save_incremental_output(accumulated_context)
-
-        # Check if composition is complete
-        composition_complete = "</score-partwise>" in accumulated_context
-
-        # If composition is not complete, continue with any remaining parts
-        iteration = 1
-        while iteration < max_iterations and not composition_complete and not self.stop_requested:
-            iteration += 1
-            print(f"[Agent {self.agent_id}] Continuing with iteration {iteration}...")
-
-            # For continuations, we process parts that weren't completed
-            incomplete_parts = []
-            for part_result in all_a2_responses:
-                if "</part>" not in part_result["a2_response"]:
-                    incomplete_parts.append(part_result)
-
-            # If all parts are complete, but we're still missing closing tags
-            if not incomplete_parts and not composition_complete:
-                # Look for the last part and try to complete it
-                last_part = all_a2_responses[-1]
-                incomplete_parts.append(last_part)
-                print(
-                    f"[Agent {self.agent_id}] All parts have </part> tags but missing </score-partwise>. Continuing with last part.")
+        return len(a2_results) == len(parts) and not any(
+            self._part_needs_continuation(part_result) for part_result, _, _ in a2_results)
 
-            # If all parts are truly complete, we're done
-            if not incomplete_parts:
-                print(f"[Agent {self.agent_id}] All parts appear to be complete.")
-                break
+    def finish_conversation(self):
+        """Save the conversation once every stage has run."""
+        self._wait_for_score_write()
+        # Save conversation
+        self.save_conversation()
 
-            # Process incomplete parts in parallel
-            continuation_responses = []
-
-            with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=min(self.max_workers, len(incomplete_parts))) as executor:
-                # Submit all incomplete parts for further processing
-                future_to_part = {}
-
-                for part_result in incomplete_parts:
-                    part_name = part_result["part_name"]
-                    part_content = part_result["part_content"]
-                    part_number = part_result["part_number"]
-                    previous_response = part_result["a2_response"]
-
-                    continuation_prompt = f"Part: {part_name} (ID: P{part_number}) ---\n\n{part_content}\n\n--- Previous Implementation ---\n\n{previous_response}\n\nContinue the existing composition for this part, maintaining part ID P{part_number}."
-
-                    future = executor.submit(
-                        self._call_model,
-                        self.model_a2_name,
-                        self.model_a2_system_prompt,
-                        [{"role": "user", "content": continuation_prompt}],
-                        self.model_a2_temperature,
-                        self.model_a2_top_p,
-                        self.model_a2_max_tokens
-                    )
-
-                    future_to_part[future] = part_result
-
-                # Process results as they complete
-                for future in concurrent.futures.as_completed(future_to_part):
-                    part_result = future_to_part[future]
-                    part_name = part_result["part_name"]
-                    part_number = part_result["part_number"]
-                    try:
-                        continuation_response = future.result()
-
-                        # Update the response in all_a2_responses
-                        updated_response = part_result["a2_response"] + "\n\n" + continuation_response
-
-                        # Find and update the matching part in all_a2_responses
-                        for response in all_a2_responses:
-                            if response["part_name"] == part_name and response["part_number"] == part_number:
-                                response["a2_response"] = updated_response
-                                break
-
-                        continuation_responses.append({
-                            "part_name": part_name,
-                            "part_number": part_number,
-                            "continuation": continuation_response
-                        })
-
-                        print(
-                            f"[Agent {self.agent_id}] Completed continuation for part: {part_name} (Part {part_number})")
-                    except Exception as exc:
-                        print(
-                            f"[Agent {self.agent_id}] Continuation for part {part_name} (Part {part_number}) generated an exception: {exc}")
-
-            # Add continuations to conversation history
-            for cont in continuation_responses:
-                self.conversation_history.append(
-                    {"role": f"Model A2 (Cont. - {cont['part_name']} P{cont['part_number']})",
-                     "content": cont["continuation"]}
-                )
+        # Later runs skip this task entirely
+        if self.journal is not None and not self.stop_requested:
+            self.journal.record_done(self.task_key)
+        if not self.stop_requested:
+            self._copy_outputs_to_aliases()
 
-            # Combine all updated A2 responses
-            updated_combined_response = "\n\n".join([resp["a2_response"] for resp in all_a2_responses])
+        return self.conversation_history
 
-            # Save the updated combined output
-            accumulated_context = updated_combined_response
-            self.save_incremental_output(accumulated_context)
+    def adopt_shared_stages(self, source, stage_outputs: Dict[str, str]) -> None:
+        """
+        Continue from stages another agent ran once for several trials: copy its conversation so far and
+        journal the shared outputs as this trial's own, so an interrupted run resumes this trial on its own.
+        """
+        self.conversation_history = [dict(message) for message in source.conversation_history]
+        self.requested_measures = source.requested_measures
+        self._stored_messages = 0
+        self._store_new_messages()
+        for stage, output in stage_outputs.items():
+            self._journal_stage(stage, output)
+        print(f"[Agent {self.agent_id}] Sharing {', '.join(stage_outputs)} with {source.agent_id}")
+
+    def _copy_outputs_to_aliases(self):
+        """Write this trial's conversation and score under each alias prompt id and mark those tasks done."""
+        for alias in self.output_aliases:
+            for source, target in ((self.conversation_filename(), self.conversation_filename(alias)),
+                                   (self.current_xml_filename, self.score_filename(alias))):
+                if source and os.path.exists(source):
+                    shutil.copyfile(source, target)
+            if self.conversation_store is not None:
+                self.conversation_store.copy_trial(self.prompt_id.split('_')[:2], alias.split('_')[:2],
+                                                   self.trial_num)
+            if self.journal is not None:
+                category_id, prompt_id = alias.split('_')[:2]
+                self.journal.record_done(f"Cat{category_id}_Prompt{prompt_id}_Trial{self.trial_num}",
+                                         aborted_reason=self.abort_reason)
+            print(f"[Agent {self.agent_id}] Copied outputs to duplicate prompt {alias}")
+
+    async def generate_conversation_async(self, user_prompt: str, max_iterations: int = 3,
+                                          skip_initial_model_a: bool = False):
+        """Generate a conversation between models A, B, B2, and A2"""
+        self.start_conversation(user_prompt)
+        model_a_response = await self.run_stage_a1_async(user_prompt, skip_initial_model_a)
+        model_b_response = await self.run_stage_b1_async(model_a_response)
+        model_b2_response = await self.run_stage_b2_async(model_b_response)
+        await self.run_stage_a2_async(model_b2_response, user_prompt, max_iterations)
+        return await asyncio.to_thread(self.finish_conversation)
 
-            # Check if composition is now complete
-            composition_complete = "</score-partwise>" in accumulated_context
+    def _run_sync(self, coroutine):
+        """Run one of the agent's coroutines from a thread, blocking it until the coroutine returns."""
+        return AGENT_EVENT_LOOP.run(coroutine)
 
-            if composition_complete:
-                print(f"[Agent {self.agent_id}] Complete score received after {iteration} iterations with Model A2.")
-                break
+    def run_stage_a1(self, user_prompt: str, skip_initial_model_a: bool = False):
+        """Blocking run_stage_a1_async."""
+        return self._run_sync(self.run_stage_a1_async(user_prompt, skip_initial_model_a))
 
-            if self.check_for_stop():
-                print(f"[Agent {self.agent_id}] Stopping early due to stop request.")
-                break
+    def run_stage_b1(self, model_a_response):
+        """Blocking run_stage_b1_async."""
+        return self._run_sync(self.run_stage_b1_async(model_a_response))
 
-            time.sleep(0.5)  # Slight delay to reduce API pressure
+    def run_stage_b2(self, model_b_response):
+        """Blocking run_stage_b2_async."""
+        return self._run_sync(self.run_stage_b2_async(model_b_response))
 
-        # Save conversation
-        self.save_conversation()
+    def run_stage_a2(self, model_b2_response, user_prompt: str, max_iterations: int = 3):
+        """Blocking run_stage_a2_async."""
+        return self._run_sync(self.run_stage_a2_async(model_b2_response, user_prompt, max_iterations))
 
-        return self.conversation_history
+    def generate_conversation(self, user_prompt: str, max_iterations: int = 3, skip_initial_model_a: bool = False):
+        """Blocking generate_conversation_async."""
+        return self._run_sync(self.generate_conversation_async(user_prompt, max_iterations, skip_initial_model_a))
 
     def format_conversation(self) -> str:
         """Format the conversation for display."""
@@ -602,130 +4259,197 @@ Upon receiving an outline you are to write out the complete and proper XML. Give
 
         return formatted_conversation
 
+    def conversation_filename(self, prompt_id: str = None) -> str:
+        """Conversation JSON path of this trial, named by category, prompt ID and trial number."""
+        category_id, prompt_number = (prompt_id or self.prompt_id).split('_')[:2]
+        return f"{self.conversation_dir}/conversation_Cat{category_id}_Prompt{prompt_number}_Trial{self.trial_num}.json"
+
+    def score_filename(self, prompt_id: str = None) -> str:
+        """MusicXML path of this trial, named by category, prompt ID and trial number."""
+        category_id, prompt_number = (prompt_id or self.prompt_id).split('_')[:2]
+        return f"{self.final_output_dir}/Category{category_id}_Prompt{prompt_number}_Trial{self.trial_num}.xml"
+
     def save_conversation(self) -> None:
-        """Save the full conversation to a JSON file."""
-        # Create a filename with category, prompt ID, and trial number
-        filename = f"{self.conversation_dir}/conversation_Cat{self.prompt_id.split('_')[0]}_Prompt{self.prompt_id.split('_')[1]}_Trial{self.trial_num}.json"
+        """Save the full conversation to the conversation store and/or a JSON file."""
+        self._store_new_messages()
+        if not self.conversation_json:
+            return
+        filename = self.conversation_filename()
 
         with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(self.conversation_history, f, indent=2, ensure_ascii=False)
+            if self.spill is None:
+                json.dump(self.conversation_history, f, indent=2, ensure_ascii=False)
+            else:
+                # Read spilled messages back one at a time; the file matches json.dump's layout
+                f.write("[")
+                for index, message in enumerate(self.conversation_history):
+                    entry = json.dumps(dict(message, content=str(message["content"])), indent=2, ensure_ascii=False)
+                    f.write(("\n" if index == 0 else ",\n") + "  " + entry.replace("\n", "\n  "))
+                f.write("\n]" if self.conversation_history else "]")
 
         print(f"[Agent {self.agent_id}] Saved conversation to {filename}")
 
-    def _clean_xml(self, content):
-        """
-        Remove XML code block markers, headers, and closing tags.
-        Will rebuild a proper XML structure when combining parts.
-        """
-        # Remove code block markers
-        cleaned = content.replace("```xml\n", "").replace("```", "").replace("'''", "")
-
-        # Define key XML elements to identify and remove
-        xml_header = '<?xml version="1.0" encoding="UTF-8"?>'
-        doctype = '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">'
-        score_open = '<score-partwise version="4.0">'
-        score_close = '</score-partwise>'
-
-        # Remove all XML header elements
-        cleaned = cleaned.replace(xml_header, "")
-        cleaned = cleaned.replace(doctype, "")
-        cleaned = cleaned.replace(score_open, "")
-
-        # Remove all closing score tags
-        cleaned = cleaned.replace(score_close, "")
-
-        # Also clean up part-list sections if they appear in the middle
-        part_list_open = '<part-list>'
-        part_list_close = '</part-list>'
-
-        # If there's a part-list section but we're not at the beginning of the file, remove it
-        if part_list_open in cleaned:
-            first_part_tag = cleaned.find('<part id=')
-            if first_part_tag > 0:
-                # Find all part-list sections that appear after the first part tag
-                pos = first_part_tag
-                while True:
-                    start_pos = cleaned.find(part_list_open, pos)
-                    if start_pos == -1:
-                        break
-
-                    end_pos = cleaned.find(part_list_close, start_pos)
-                    if end_pos == -1:
-                        break
-
-                    # Remove this part-list section
-                    section = cleaned[start_pos:end_pos + len(part_list_close)]
-                    cleaned = cleaned.replace(section, "")
-
-                    pos = start_pos + 1
-
-        return cleaned
-
-    def save_incremental_output(self, content):
-        """Save incremental output to file with proper XML structure."""
-        # Clean XML content first
-        cleaned_content = self._clean_xml(content)
-
-        # Add proper XML header at the beginning
-        xml_header = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        doctype = '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n'
-        score_open = '<score-partwise version="4.0">\n'
-
-        # Look for part-list in the content
-        part_list_open = '<part-list>'
-        part_list_close = '</part-list>'
-
-        # If there's no part-list in the content, we need to create a basic one
-        if part_list_open not in cleaned_content:
-            # Extract part IDs from the content
-            import re
-            part_ids = re.findall(r'<part id="(P\d+)">', cleaned_content)
-
-            # Remove duplicates while preserving order
-            unique_part_ids = []
-            for part_id in part_ids:
-                if part_id not in unique_part_ids:
-                    unique_part_ids.append(part_id)
-
-            # Create a basic part-list section
-            part_list = '<part-list>\n'
-            for part_id in unique_part_ids:
-                part_list += f'<score-part id="{part_id}">\n'
-                part_list += f'<part-name>Part {part_id.replace("P", "")}</part-name>\n'
-                part_list += '</score-part>\n'
-            part_list += '</part-list>\n'
-
-            # Add the part-list to the beginning
-            final_content = xml_header + doctype + score_open + part_list + cleaned_content
-        else:
-            # The content already has a part-list section, so just add the header
-            final_content = xml_header + doctype + score_open + cleaned_content
-
-        # Add closing tag if needed
-        score_close = '</score-partwise>'
-        if not final_content.strip().endswith(score_close):
-            final_content += '\n' + score_close
-
-        # Create the filename using the category, prompt ID and trial number
+    def save_incremental_output(self, force: bool = True):
+        """
+        Write the assembled score to file. Unforced saves from streaming are throttled, and skipped while
+        another thread is writing. Forced saves also check that the score is well-formed XML.
+        The check and write run on the CPU pool, or SCORE_WRITER without one, and this returns without waiting
+        for them; saves requested while a write is in flight are merged into one write made when it lands, so
+        the file always ends with the latest score.
+        """
         if self.current_xml_filename is None:
-            self.current_xml_filename = f"{self.final_output_dir}/Category{self.prompt_id.split('_')[0]}_Prompt{self.prompt_id.split('_')[1]}_Trial{self.trial_num}.xml"
+            self.current_xml_filename = self.score_filename()
+        path = self.current_xml_filename
 
-        # Write to file
-        with open(self.current_xml_filename, 'w', encoding='utf-8') as f:
-            f.write(final_content)
-
-        print(f"[Agent {self.agent_id}] Saved XML output to {self.current_xml_filename}")
-
-        return self.current_xml_filename
+        if not self._score_lock.acquire(blocking=force):
+            return path
+        try:
+            if self._score_write is not None:
+                self._score_pending = force or bool(self._score_pending)
+            else:
+                self._write_score(path, force)
+        finally:
+            self._score_lock.release()
+        return path
+
+    def _write_score(self, path, force):
+        """Render the score and start writing it; called with _score_lock held."""
+        content = self.score_assembler.render(force)
+        if content is None:
+            return
+        writer = self.cpu_pool if self.cpu_pool is not None else SCORE_WRITER
+        self._score_idle.clear()
+        self._score_write = writer.submit(write_score_file, path, content, force)
+        self._score_write.add_done_callback(lambda write: self._finish_score_write(path, force, write))
+
+    def _finish_score_write(self, path, force, write):
+        """Report a write, then make the save requested while it was in flight, if any."""
+        self._report_score_write(path, force, write)
+        with self._score_lock:
+            self._score_write = None
+            pending, self._score_pending = self._score_pending, None
+            if pending is not None:
+                self._write_score(path, pending)
+            if self._score_write is None:
+                self._score_idle.set()
+
+    def _report_score_write(self, path, force, write):
+        if write.exception() is not None:
+            print(f"[Agent {self.agent_id}] Could not save XML output to {path}: {write.exception()}")
+        elif write.result():
+            print(f"[Agent {self.agent_id}] Saved XML output to {path}, but it is not well-formed XML: "
+                  f"{write.result()}")
+        elif force:
+            print(f"[Agent {self.agent_id}] Saved XML output to {path}")
+
+    def _wait_for_score_write(self):
+        """Block until every requested score write has landed (before the file is copied or the trial journaled)."""
+        self._score_idle.wait()
+
+    async def _wait_for_score_write_async(self):
+        if not self._score_idle.is_set():
+            await asyncio.to_thread(self._score_idle.wait)
 
     def check_for_stop(self):
         """Check if stop has been requested via Ctrl+C."""
         return self.stop_requested
 
 
+class AsyncLLMConversationAgent(LLMConversationAgent):
+    """
+    LLMConversationAgent for an asyncio batch. Its stage methods are the coroutines themselves, run on the
+    batch's event loop instead of the shared agent loop, with a global limit on in-flight API calls and
+    optional hedging of calls that run into the latency tail.
+    """
+
+    def __init__(self, *args, call_semaphore: asyncio.Semaphore = None, hedge_policy: HedgePolicy = None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Global limit on in-flight API calls, normally shared by every agent in a batch
+        self.call_semaphore = call_semaphore or asyncio.Semaphore(self.max_workers)
+
+        # Optional duplicate requests for calls that run into the latency tail
+        self.hedge_policy = hedge_policy
+
+    run_stage_a1 = LLMConversationAgent.run_stage_a1_async
+    run_stage_b1 = LLMConversationAgent.run_stage_b1_async
+    run_stage_b2 = LLMConversationAgent.run_stage_b2_async
+    run_stage_a2 = LLMConversationAgent.run_stage_a2_async
+    generate_conversation = LLMConversationAgent.generate_conversation_async
+
+
+class SharedPrefixPlanner:
+    """
+    Plans a batch's (category, prompt, trial) tasks as a DAG of stage runs instead of independent chains.
+    With dedupe_prompts, identical prompt texts in different categories are merged, so each trial of the prompt
+    runs once and its outputs are copied to every (category, prompt) that asked for it. Stages before fan_out_stage run once
+    per prompt and feed all of its trials: with fan_out_stage="A2" a single B2 plan is written out by three
+    A2 trials. The default, fan_out_stage="A1", keeps every trial independent from the first call.
+
+    Each node is a dict {"stage", "leaves", "children"}; a leaf is one trial to write to disk,
+    {"prompt_text", "trial", "targets"}, where targets are the (category_id, prompt_id) pairs it is saved as.
+    The first leaf of a node is the trial whose agent runs it.
+    """
+
+    def __init__(self, stages: Tuple = ("A1", "B1", "B2", "A2"), fan_out_stage: str = "A1",
+                 dedupe_prompts: bool = False):
+        if fan_out_stage not in stages:
+            raise ValueError(f"fan_out_stage must be one of {', '.join(stages)}, not {fan_out_stage!r}")
+        self.stages = tuple(stages)
+        self.fan_out_stage = fan_out_stage
+        self.dedupe_prompts = dedupe_prompts
+
+    @property
+    def shared_stages(self) -> Tuple:
+        """Stages run once per prompt rather than once per trial"""
+        return self.stages[:self.stages.index(self.fan_out_stage)]
+
+    @staticmethod
+    def _chain(stages, leaves, children):
+        """Nodes running stages in order for the given leaves, ending in children; returns the first node(s)."""
+        for stage in reversed(stages):
+            children = [{"stage": stage, "leaves": leaves, "children": children}]
+        return children
+
+    def plan(self, tasks: List[Tuple]) -> List[Dict]:
+        """Root nodes for a list of (category_id, prompt_id, prompt_text, trial) tasks."""
+        groups = {}
+        for category_id, prompt_id, prompt_text, trial in tasks:
+            key = prompt_text if self.dedupe_prompts else (category_id, prompt_id)
+            group = groups.setdefault(key, {"prompt_text": prompt_text, "trials": {}})
+            group["trials"].setdefault(trial, []).append((category_id, prompt_id))
+
+        per_trial_stages = self.stages[len(self.shared_stages):]
+        roots = []
+        for group in groups.values():
+            leaves = [{"prompt_text": group["prompt_text"], "trial": trial, "targets": targets}
+                      for trial, targets in sorted(group["trials"].items())]
+            trial_chains = [self._chain(per_trial_stages, [leaf], [])[0] for leaf in leaves]
+            roots.extend(self._chain(self.shared_stages, leaves, trial_chains))
+        return roots
+
+    @staticmethod
+    def walk(nodes: List[Dict]):
+        """Every node reachable from the given ones, parents before children."""
+        for node in nodes:
+            yield node
+            yield from SharedPrefixPlanner.walk(node["children"])
+
+    def format_summary(self, tasks: List[Tuple], roots: List[Dict]) -> str:
+        runs = Counter(node["stage"] for node in self.walk(roots))
+        trials = sum(1 for node in self.walk(roots) if not node["children"])
+        planned = sum(runs.values())
+        stage_counts = ", ".join(f"{stage} {runs[stage]}" for stage in self.stages)
+        return (f"[Batch] Plan: {len(tasks)} tasks as {trials} trials, {planned} of {len(tasks) * len(self.stages)} "
+                f"stage runs ({stage_counts}); trials fan out at {self.fan_out_stage}")
+
+
 class BatchMusicGenerator:
     """Class for running multiple music generation prompts in parallel"""
 
+    # Agent class created for each (category, prompt, trial) task
+    agent_class = LLMConversationAgent
+
     def __init__(
             self,
             api_key: str,
@@ -735,11 +4459,51 @@ class BatchMusicGenerator:
             model_b_name: str = "gpt-4.1",
             model_b2_name: str = "gpt-4.1",
             model_a2_name: str = "ft:gpt-4o-mini-2024-07-18:chia:test-1-500:BH9opiWg",
-            model_settings: Dict = None  # Optional settings override for temperatures, etc.
+            model_settings: Dict = None,  # Optional settings override for temperatures, etc.
+            rate_limits: Dict = None,  # Optional {model_name: {"requests_per_minute": n, "tokens_per_minute": n}}
+            stream_a2: bool = False,  # Stream A2 parts and flush each completed measure to the score file
+            continuation_mode: str = "full",  # "tail" sends only the part plan and last measures on continuations
+            validate_measures: bool = False,  # Re-request A2 measures that do not fit the time signature
+            repair_rounds: int = 1,
+            check_playability: bool = False,  # Also re-request measures outside the instrument's range or polyphony
+            shard_measures: int = 0,  # Write longer parts as parallel ranges of about this many measures (0: off)
+            cache_dir: str = None,  # Enable the on-disk response cache in this directory
+            cache_max_bytes: int = 512 * 1024 * 1024,
+            cache_stages: Tuple = ("A1", "B1", "B2"),  # Stages served from the cache; A2 is sampled fresh by default
+            scheduler: str = "slots",  # "slots": one worker per task; "pipeline": queue and workers per stage
+            fan_out_stage: str = "A1",  # Earlier stages run once per prompt and are shared by its trials
+            dedupe_prompts: bool = False,  # Run identical prompts from different categories once
+            model_concurrency: Dict[str, int] = None,  # Optional {model_name: max in-flight calls}
+            adaptive_concurrency: bool = False,  # Grow and cut each model's in-flight calls with AIMD
+            initial_concurrency: int = 8,  # Starting in-flight limit per model in adaptive mode
+            max_concurrency: int = 64,  # Ceiling per model in adaptive mode unless model_concurrency sets one
+            resume: bool = False,  # Skip trials finished by earlier runs and resume half-done ones from the journal
+            conversation_store: bool = False,  # Stream every message to conversations.sqlite in the output folder
+            conversation_json: bool = True,  # Write one conversation JSON file per trial (always without the store)
+            cpu_workers: int = 0,  # Processes for validation and score writes (0: inline, None: one per core)
+            bounded_memory: bool = False,  # Spill stage outputs and measures to disk; journal keeps offsets only
+            spill_dir: str = None,  # Directory for the agents' spill files (the system temp dir if omitted)
+            max_task_rss_mib: float = None,  # Hold new tasks while the mean RSS per in-flight task is this high
+            base_url: str = None,  # Optional OpenAI-compatible endpoint instead of api.openai.com
+            model_base_urls: Dict[str, str] = None,  # Optional {model_name: endpoint} for models served elsewhere
+            http2: bool = True,  # Use HTTP/2 for API connections when the h2 package is installed
+            token_budget: bool = False  # Size max_tokens per call from measure counts and past runs' statistics
     ):
         self.api_key = api_key
+        self.base_url = base_url
+        self.model_base_urls = dict(model_base_urls or {})
+        self.http2 = http2
+        self.http_clients = HTTP_CLIENTS
         self.output_base_dir = output_base_dir
         self.max_workers = max_workers
+        self.stream_a2 = stream_a2
+        self.continuation_mode = continuation_mode
+        self.validate_measures = validate_measures
+        self.repair_rounds = repair_rounds
+        self.check_playability = check_playability
+        self.shard_measures = shard_measures
+        self.scheduler = scheduler
+        self.planner = SharedPrefixPlanner(self.PIPELINE_STAGES, fan_out_stage, dedupe_prompts)
 
         # Model names
         self.model_a_name = model_a_name
@@ -763,16 +4527,67 @@ class BatchMusicGenerator:
         if model_settings:
             self.model_settings.update(model_settings)
 
+        # Call, token and queue metrics of every agent in the batch
+        self.metrics = MetricsRegistry()
+        self.metrics_path = os.path.join(output_base_dir, "metrics_summary.json")
+
+        # Worker processes shared by every agent for CPU-bound post-processing, sized apart from the API pools
+        self.cpu_pool = CpuWorkerPool(cpu_workers, metrics=self.metrics) if cpu_workers != 0 else None
+
+        # Resident memory per in-flight task, optionally capped by holding back new tasks
+        self.bounded_memory = bounded_memory
+        self.spill_dir = spill_dir
+        self.memory_monitor = MemoryMonitor(lambda: list(self.running_agents),
+                                            max_task_rss_mib * 2 ** 20 if max_task_rss_mib else None,
+                                            metrics=self.metrics)
+
+        # Per-model limits on in-flight calls. Adaptive limits start at initial_concurrency and find the
+        # endpoint's capacity themselves, with model_concurrency as ceilings; fixed limits are model_concurrency
+        # itself, and without either every stage pool is sized by max_workers
+        self.model_concurrency = dict(model_concurrency or {})
+        self.adaptive_concurrency = adaptive_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency_limits = self._create_concurrency_limits()
+
+        # Optional response cache shared by every agent in the batch
+        self.response_cache = ResponseCache(cache_dir, cache_max_bytes) if cache_dir else None
+        self.cache_stages = cache_stages
+
+        # Account limits for the shared per-model rate limiters
+        for model_name, limits in (rate_limits or {}).items():
+            RATE_LIMITERS.configure(model_name, limits["requests_per_minute"], limits["tokens_per_minute"])
+
         # Create output directories
         self.conversation_dir = os.path.join(output_base_dir, "Conversations")
         self.xml_output_dir = os.path.join(output_base_dir, "XML_Output")
         os.makedirs(self.conversation_dir, exist_ok=True)
         os.makedirs(self.xml_output_dir, exist_ok=True)
 
+        # Checkpoint journal of completed stages; without resume the previous journal is set aside
+        journal_path = os.path.join(output_base_dir, "checkpoint_journal.jsonl")
+        if not resume and os.path.exists(journal_path):
+            archived_path = f"{journal_path}.{time.strftime('%Y%m%d-%H%M%S')}"
+            os.replace(journal_path, archived_path)
+            print(f"[Batch] Previous checkpoint journal moved to {archived_path}")
+        self.journal = CheckpointJournal(journal_path, index_only=bounded_memory)
+
+        # Indexed store of every conversation message, queryable by category, stage, model and settings
+        self.conversation_store = (ConversationStore(os.path.join(output_base_dir, "conversations.sqlite"))
+                                   if conversation_store else None)
+        self.conversation_json = conversation_json or self.conversation_store is None
+
         # Store for active agents and their prompts
         self.running_agents = {}
         self.stop_requested = False
 
+        # Start-to-finish seconds of every successfully completed task, for throughput benchmarks
+        self.task_latencies = []
+
+        # Tokens-per-measure statistics are kept with the outputs so later runs budget from them
+        self.token_budgeter = (TokenBudgeter(os.path.join(output_base_dir, "token_budget_stats.json"))
+                               if token_budget else None)
+
     def setup_signal_handler(self):
         """Set up signal handler for clean exit."""
 
@@ -782,38 +4597,168 @@ class BatchMusicGenerator:
             for agent_id, agent in self.running_agents.items():
                 agent.stop_requested = True
                 print(f"Signaled agent {agent_id} to stop")
+            print("Completed stages are saved in the checkpoint journal; rerun the batch with --resume to continue.")
             print("Waiting for agents to complete current work...")
             time.sleep(2)  # Give agents time to save current work
             sys.exit(0)
 
         signal.signal(signal.SIGINT, signal_handler)
 
+    def _create_agent(self, category_id: int, prompt_id: int, trial_num: int):
+        """Create a conversation agent configured with this batch's models and settings"""
+        return self.agent_class(
+            api_key=self.api_key,
+            model_a_name=self.model_a_name,
+            model_a_temperature=self.model_settings["model_a_temperature"],
+            model_a_top_p=self.model_settings["model_a_top_p"],
+            model_b_name=self.model_b_name,
+            model_b_temperature=self.model_settings["model_b_temperature"],
+            model_b_top_p=self.model_settings["model_b_top_p"],
+            model_b2_name=self.model_b2_name,
+            model_b2_temperature=self.model_settings["model_b2_temperature"],
+            model_b2_top_p=self.model_settings["model_b2_top_p"],
+            model_a2_name=self.model_a2_name,
+            model_a2_temperature=self.model_settings["model_a2_temperature"],
+            model_a2_top_p=self.model_settings["model_a2_top_p"],
+            conversation_dir=self.conversation_dir,
+            final_output_dir=self.xml_output_dir,
+            prompt_id=f"{category_id}_{prompt_id}",
+            trial_num=trial_num,
+            **self._extra_agent_kwargs()
+        )
+
+    def _create_concurrency_limits(self) -> Dict:
+        """One AIMD limit per model called by the batch, or a fixed one per model with a configured limit"""
+        if not self.adaptive_concurrency:
+            return {model_name: AdaptiveConcurrencyLimit(model_name, limit, limit, limit, metrics=self.metrics)
+                    for model_name, limit in self.model_concurrency.items()}
+        limits = {}
+        for model_name in set(self._stage_models().values()):
+            ceiling = self.model_concurrency.get(model_name, self.max_concurrency)
+            limits[model_name] = AdaptiveConcurrencyLimit(model_name, min(self.initial_concurrency, ceiling),
+                                                          max_limit=ceiling, metrics=self.metrics)
+        return limits
+
+    def _stage_models(self) -> Dict[str, str]:
+        """Model called by each pipeline stage"""
+        return {
+            "A1": self.model_a_name,
+            "B1": self.model_b_name,
+            "B2": self.model_b2_name,
+            "A2": self.model_a2_name
+        }
+
+    def _stage_worker_counts(self) -> Dict[str, int]:
+        """Size each stage's worker pool by max_workers, or by its model's concurrency ceiling when lower"""
+        # A worker only blocks on its task's calls, which run on the agent event loop, and the model's limit
+        # decides how many of them are in flight, so the pools need not grow to the adaptive ceiling
+        counts = {}
+        for stage, model_name in self._stage_models().items():
+            limit = self.concurrency_limits.get(model_name)
+            counts[stage] = max(1, min(self.max_workers, limit.max_limit) if limit is not None else self.max_workers)
+        return counts
+
+    def _extra_agent_kwargs(self) -> Dict:
+        """Additional keyword arguments passed to every agent created by this batch"""
+        return {
+            "base_url": self.base_url,
+            "model_base_urls": self.model_base_urls,
+            "http_clients": self.http_clients,
+            "metrics": self.metrics,
+            "token_budgeter": self.token_budgeter,
+            "journal": self.journal,
+            "conversation_store": self.conversation_store,
+            "conversation_json": self.conversation_json,
+            "cpu_pool": self.cpu_pool,
+            "bounded_memory": self.bounded_memory,
+            "spill_dir": self.spill_dir,
+            "concurrency_limits": self.concurrency_limits,
+            "stream_a2": self.stream_a2,
+            "continuation_mode": self.continuation_mode,
+            "validate_measures": self.validate_measures,
+            "repair_rounds": self.repair_rounds,
+            "check_playability": self.check_playability,
+            "shard_measures": self.shard_measures,
+            "response_cache": self.response_cache,
+            "cache_stages": self.cache_stages
+        }
+
+    def _start_batch_workers(self) -> None:
+        """Size the API connection pools and start the CPU worker pool and the memory monitor for a batch."""
+        self.http_clients.configure(self._connection_limits(), http2=self.http2, metrics=self.metrics)
+        if self.cpu_pool is not None:
+            self.cpu_pool.start()
+        self.memory_monitor.start()
+
+    def _connection_limits(self) -> Dict[str, int]:
+        """Connections per endpoint: the most calls the batch can have in flight to the models it serves."""
+        stage_counts = Counter(self._stage_models().values())
+        connections = {}
+        for model_name, stages in stage_counts.items():
+            limit = self.concurrency_limits.get(model_name)
+            # Without a limit every stage calling the model has its own pool of max_workers
+            calls = limit.max_limit if limit is not None else self.max_workers * stages
+            base_url = self.model_base_urls.get(model_name, self.base_url)
+            connections[base_url] = connections.get(base_url, 0) + calls
+        return connections
+
+    def _report_agent_result(self, agent_id: str, agent) -> None:
+        """Check if we got a complete score"""
+        final_message = agent.conversation_history[-1]["content"]
+        if "</score-partwise>" in final_message:
+            print(f"[Batch] ✓ {agent_id}: Complete MusicXML score generated successfully")
+        else:
+            print(f"[Batch] ⚠ {agent_id}: Warning - XML may be incomplete (missing closing tag)")
+
+    def _task_finished(self, seconds: float) -> None:
+        """Record the start-to-finish time of a successful task."""
+        self.task_latencies.append(seconds)
+        self.metrics.observe("maestro_task_seconds", seconds)
+
+    def _report_task_outcome(self, task_desc: str, success: bool) -> None:
+        print(f"[Batch] {'Completed' if success else 'Failed'} {task_desc}")
+        self.metrics.inc("maestro_tasks_total", outcome="completed" if success else "failed")
+
+    def _report_batch_complete(self, completed_tasks: int, total_tasks: int) -> None:
+        """Print the end-of-run summary and write the metrics summary JSON next to the outputs."""
+        print(f"[Batch] Batch processing complete. {completed_tasks}/{total_tasks} tasks finished.")
+        if self.response_cache:
+            print(self.response_cache.format_stats())
+        self.journal.flush()
+        if self.conversation_store is not None:
+            print(self.conversation_store.format_stats())
+        if self.cpu_pool is not None:
+            self.cpu_pool.shutdown()
+            print(self.cpu_pool.format_stats())
+        print(self.http_clients.format_stats())
+        self.memory_monitor.stop()
+        print(self.memory_monitor.format_summary())
+
+        if self.token_budgeter is not None:
+            self.token_budgeter.save()
+            print(self.token_budgeter.format_summary())
+        if self.adaptive_concurrency and self.concurrency_limits:
+            final_limits = {model_name: int(limit.limit) for model_name, limit in self.concurrency_limits.items()}
+            print(f"[Batch] Final concurrency limits: {final_limits}")
+
+        summary = self.metrics.summary()
+        print(MetricsRegistry.format_summary(summary))
+        temp_path = f"{self.metrics_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        os.replace(temp_path, self.metrics_path)
+        print(f"[Batch] Metrics summary written to {self.metrics_path}")
+
     def _process_single_prompt(self, category_id: int, prompt_id: int, prompt_text: str, trial_num: int):
         """Process a single prompt with the given trial number"""
+        self.memory_monitor.wait_for_headroom()
+        started = time.monotonic()
+        agent_id = f"Cat{category_id}_Prompt{prompt_id}_Trial{trial_num}"
         try:
             # Create the agent with the appropriate identifiers
-            agent = LLMConversationAgent(
-                api_key=self.api_key,
-                model_a_name=self.model_a_name,
-                model_a_temperature=self.model_settings["model_a_temperature"],
-                model_a_top_p=self.model_settings["model_a_top_p"],
-                model_b_name=self.model_b_name,
-                model_b_temperature=self.model_settings["model_b_temperature"],
-                model_b_top_p=self.model_settings["model_b_top_p"],
-                model_b2_name=self.model_b2_name,
-                model_b2_temperature=self.model_settings["model_b2_temperature"],
-                model_b2_top_p=self.model_settings["model_b2_top_p"],
-                model_a2_name=self.model_a2_name,
-                model_a2_temperature=self.model_settings["model_a2_temperature"],
-                model_a2_top_p=self.model_settings["model_a2_top_p"],
-                conversation_dir=self.conversation_dir,
-                final_output_dir=self.xml_output_dir,
-                prompt_id=f"{category_id}_{prompt_id}",
-                trial_num=trial_num
-            )
+            agent = self._create_agent(category_id, prompt_id, trial_num)
 
             # Register this agent
-            agent_id = f"Cat{category_id}_Prompt{prompt_id}_Trial{trial_num}"
             self.running_agents[agent_id] = agent
 
             # Run the conversation
@@ -821,21 +4766,189 @@ class BatchMusicGenerator:
             agent.generate_conversation(prompt_text, max_iterations=3, skip_initial_model_a=False)
 
             # Check if we got a complete score
-            final_message = agent.conversation_history[-1]["content"]
-            if "</score-partwise>" in final_message:
-                print(f"[Batch] ✓ {agent_id}: Complete MusicXML score generated successfully")
-            else:
-                print(f"[Batch] ⚠ {agent_id}: Warning - XML may be incomplete (missing closing tag)")
-
-            # Clean up
-            self.running_agents.pop(agent_id, None)
+            self._report_agent_result(agent_id, agent)
 
+            self._task_finished(time.monotonic() - started)
             return True
 
         except Exception as e:
             print(f"[Batch] Error processing {category_id}_{prompt_id} trial {trial_num}: {str(e)}")
             return False
 
+        finally:
+            # Failed tasks are unregistered too, so the memory monitor stops counting them as in flight
+            self.running_agents.pop(agent_id, None)
+
+    def _build_task_list(self, test_prompts: Dict[int, Dict[int, str]], num_trials: int) -> List[Tuple]:
+        """Create a flat list of all work to be done"""
+        all_tasks = []
+        for category_id, prompts in test_prompts.items():
+            for prompt_id, prompt_text in prompts.items():
+                for trial in range(1, num_trials + 1):
+                    all_tasks.append((category_id, prompt_id, prompt_text, trial))
+
+        # Trials finished by an earlier run are not repeated
+        pending_tasks = [task for task in all_tasks
+                         if not self.journal.is_done(f"Cat{task[0]}_Prompt{task[1]}_Trial{task[3]}")]
+        if len(pending_tasks) < len(all_tasks):
+            print(f"[Batch] Skipping {len(all_tasks) - len(pending_tasks)} trials already completed in {self.journal.path}")
+        all_tasks = pending_tasks
+
+        print(
+            f"Preparing to process {len(all_tasks)} total tasks ({len(test_prompts)} categories, {sum(len(p) for p in test_prompts.values())} prompts, {num_trials} trials each)")
+
+        return all_tasks
+
+    # Stages every task moves through, in order
+    PIPELINE_STAGES = ("A1", "B1", "B2", "A2")
+
+    def _run_pipeline_stage(self, stage: str, task: Dict) -> None:
+        """Run one stage of one task, keeping the stage output on the task for the next stage"""
+        if stage == "A1":
+            self.memory_monitor.wait_for_headroom()
+            self._start_plan_task(task)
+            task["A1"] = task["agent"].run_stage_a1(task["prompt_text"], skip_initial_model_a=False)
+        elif stage == "B1":
+            task["B1"] = task["agent"].run_stage_b1(task["A1"])
+        elif stage == "B2":
+            task["B2"] = task["agent"].run_stage_b2(task["B1"])
+        elif stage == "A2":
+            task["agent"].run_stage_a2(task["B2"], task["prompt_text"], max_iterations=3)
+            task["agent"].finish_conversation()
+            self._report_agent_result(task["agent_id"], task["agent"])
+
+    @staticmethod
+    def _plan_task(leaf: Dict) -> Dict:
+        """Task state for a plan leaf; it is saved under its first target and copied to the others"""
+        category_id, prompt_id = leaf["targets"][0]
+        return {
+            "category_id": category_id,
+            "prompt_id": prompt_id,
+            "prompt_text": leaf["prompt_text"],
+            "trial": leaf["trial"],
+            "aliases": [f"{c}_{p}" for c, p in leaf["targets"][1:]],
+            "agent_id": f"Cat{category_id}_Prompt{prompt_id}_Trial{leaf['trial']}"
+        }
+
+    def _start_plan_task(self, task: Dict) -> None:
+        """Create and register the agent of a task at the start of its conversation"""
+        task["started"] = time.monotonic()
+        task["agent"] = self._create_agent(task["category_id"], task["prompt_id"], task["trial"])
+        task["agent"].output_aliases = task["aliases"]
+        self.running_agents[task["agent_id"]] = task["agent"]
+        print(f"\n[Batch] Starting {task['agent_id']}: {task['prompt_text'][:100]}...")
+        task["agent"].start_conversation(task["prompt_text"])
+
+    def _fork_plan_task(self, task: Dict, child: Dict) -> Dict:
+        """
+        Task for a child node of a shared stage. The first child continues the parent's task; every other one
+        gets its own agent that starts from the parent's conversation and stage outputs.
+        """
+        leaf = child["leaves"][0]
+        if leaf["trial"] == task["trial"]:
+            return task
+        forked = dict(task, **self._plan_task(leaf))
+        self._start_plan_task(forked)
+        forked["started"] = task["started"]
+        shared = self.PIPELINE_STAGES[:self.PIPELINE_STAGES.index(child["stage"])]
+        forked["agent"].adopt_shared_stages(task["agent"], {stage: task[stage] for stage in shared})
+        return forked
+
+    @staticmethod
+    def _plan_targets(node: Dict) -> List[Tuple]:
+        """(category_id, prompt_id, trial) of every task a node's outcome decides"""
+        return [(category_id, prompt_id, leaf["trial"])
+                for leaf in node["leaves"] for category_id, prompt_id in leaf["targets"]]
+
+    def _run_batch_pipelined(self, all_tasks: List[Tuple]):
+        """
+        Run the plan through a queue and worker pool per stage.
+        A task moves to the next stage's queue as soon as its current stage finishes, so a task waiting on
+        Model B never holds a slot that another task could use for Model A. When a shared stage finishes,
+        each trial it feeds continues as its own task.
+        """
+        total_tasks = len(all_tasks)
+        worker_counts = self._stage_worker_counts()
+        print(f"[Batch] Pipeline workers per stage: {worker_counts}")
+        roots = self.planner.plan(all_tasks)
+        print(self.planner.format_summary(all_tasks, roots))
+
+        executors = {
+            stage: concurrent.futures.ThreadPoolExecutor(max_workers=worker_counts[stage],
+                                                         thread_name_prefix=f"stage-{stage}")
+            for stage in self.PIPELINE_STAGES
+        }
+        finished = queue.Queue()
+
+        def fail(node):
+            for target in self._plan_targets(node):
+                finished.put((target, False))
+
+        def submit(node, task):
+            stage = node["stage"]
+            if self.stop_requested:
+                fail(node)
+                return
+            self.metrics.add("maestro_stage_queued", 1, stage=stage)
+            try:
+                future = executors[stage].submit(run_stage, stage, task)
+            except RuntimeError:
+                # Executors are shut down after a stop request
+                self.metrics.add("maestro_stage_queued", -1, stage=stage)
+                fail(node)
+                return
+            future.add_done_callback(lambda f: on_stage_done(node, task, f))
+
+        def run_stage(stage, task):
+            self.metrics.add("maestro_stage_queued", -1, stage=stage)
+            with self.metrics.track("maestro_stage_active", stage=stage):
+                self._run_pipeline_stage(stage, task)
+
+        def on_stage_done(node, task, future):
+            try:
+                future.result()
+                # Forks copy the parent's conversation, so all of them are made before the parent moves on
+                children = [(child, self._fork_plan_task(task, child)) for child in node["children"]]
+            except Exception as e:
+                print(f"[Batch] Error processing {task['agent_id']} in stage {node['stage']}: {str(e)}")
+                self.running_agents.pop(task["agent_id"], None)
+                fail(node)
+                return
+
+            if not children:
+                self.running_agents.pop(task["agent_id"], None)
+                self._task_finished(time.monotonic() - task["started"])
+                for target in self._plan_targets(node):
+                    finished.put((target, True))
+            for child, child_task in children:
+                submit(child, child_task)
+
+        # Every plan root enters the A1 queue; the stage pools decide how many run at once
+        for root in roots:
+            submit(root, self._plan_task(root["leaves"][0]))
+
+        completed_tasks = 0
+        while completed_tasks < total_tasks and not self.stop_requested:
+            try:
+                (category_id, prompt_id, trial), success = finished.get(timeout=30)  # Check periodically
+            except queue.Empty:
+                continue
+
+            self._report_task_outcome(f"Category {category_id}, Prompt {prompt_id}, Trial {trial}", success)
+
+            completed_tasks += 1
+            print(
+                f"[Batch] Progress: {completed_tasks}/{total_tasks} tasks completed ({completed_tasks / total_tasks * 100:.1f}%)")
+
+        if self.stop_requested:
+            print("[Batch] Stop requested, cancelling remaining tasks...")
+
+        for executor in executors.values():
+            executor.shutdown(wait=not self.stop_requested, cancel_futures=self.stop_requested)
+
+        self._report_batch_complete(completed_tasks, total_tasks)
+        return completed_tasks
+
     def run_batch(self, test_prompts: Dict[int, Dict[int, str]], num_trials: int = 3):
         """
         Run a batch of prompts with multiple trials each
@@ -846,15 +4959,18 @@ class BatchMusicGenerator:
             num_trials: Number of times to run each prompt
         """
         # Create a flat list of all work to be done
-        all_tasks = []
-        for category_id, prompts in test_prompts.items():
-            for prompt_id, prompt_text in prompts.items():
-                for trial in range(1, num_trials + 1):
-                    all_tasks.append((category_id, prompt_id, prompt_text, trial))
-
+        all_tasks = self._build_task_list(test_prompts, num_trials)
         total_tasks = len(all_tasks)
-        print(
-            f"Preparing to process {total_tasks} total tasks ({len(test_prompts)} categories, {sum(len(p) for p in test_prompts.values())} prompts, {num_trials} trials each)")
+        if not all_tasks:
+            print("[Batch] Nothing to do.")
+            return 0
+        self._start_batch_workers()
+
+        if self.scheduler == "pipeline":
+            return self._run_batch_pipelined(all_tasks)
+        if self.planner.shared_stages or len(self.planner.plan(all_tasks)) < len(all_tasks):
+            print("[Batch] The slots scheduler runs every task on its own; use the pipeline scheduler "
+                  "to share stages between trials or merge duplicate prompts")
 
         # Process tasks in parallel
         completed_tasks = 0
@@ -896,11 +5012,7 @@ class BatchMusicGenerator:
 
                     try:
                         success = future.result()
-                        task_desc = f"Category {cat_id}, Prompt {p_id}, Trial {t_num}"
-                        if success:
-                            print(f"[Batch] Completed {task_desc}")
-                        else:
-                            print(f"[Batch] Failed {task_desc}")
+                        self._report_task_outcome(f"Category {cat_id}, Prompt {p_id}, Trial {t_num}", success)
                     except Exception as e:
                         print(f"[Batch] Error in task (Cat{cat_id}_P{p_id}_T{t_num}): {str(e)}")
 
@@ -930,12 +5042,1774 @@ class BatchMusicGenerator:
                         future.cancel()
                     break
 
-        print(f"[Batch] Batch processing complete. {completed_tasks}/{total_tasks} tasks finished.")
+        self._report_batch_complete(completed_tasks, total_tasks)
+        return completed_tasks
+
+
+class AsyncBatchMusicGenerator(BatchMusicGenerator):
+    """
+    Batch runner that drives every task on a single asyncio event loop.
+    Instead of a thread per prompt blocking on the shared agent event loop, all tasks are coroutines on the
+    batch's own loop and a single global semaphore bounds the number of in-flight API calls across the batch.
+    Each coroutine moves to its next stage as soon as the previous one returns, so the async engine is
+    naturally pipelined; the per-model concurrency limits apply on top of the global one. Shared stages of the
+    plan fan out into one coroutine per trial.
+    With hedge_percentile set, A2 calls slower than that percentile of the batch's A2 latencies are hedged
+    with a duplicate request (at most hedge_max_ratio of the calls); coroutines make the loser easy to cancel.
+    """
+
+    agent_class = AsyncLLMConversationAgent
+
+    def __init__(self, *args, max_concurrent_calls: int = 1000, hedge_percentile: float = None,
+                 hedge_max_ratio: float = 0.1, hedge_min_samples: int = 20, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Global limit on in-flight API calls for the whole batch
+        self.max_concurrent_calls = max_concurrent_calls
+        self.call_semaphore = None
+
+        # Latency statistics and spend cap for hedged A2 calls, shared by every agent
+        self.hedge_policy = (HedgePolicy(hedge_percentile, hedge_min_samples, hedge_max_ratio)
+                             if hedge_percentile else None)
+
+    def _extra_agent_kwargs(self) -> Dict:
+        kwargs = super()._extra_agent_kwargs()
+        kwargs["call_semaphore"] = self.call_semaphore
+        kwargs["hedge_policy"] = self.hedge_policy
+        return kwargs
+
+    def _connection_limits(self) -> Dict[str, int]:
+        # Every call also holds the batch-wide semaphore
+        return {base_url: min(calls, self.max_concurrent_calls)
+                for base_url, calls in super()._connection_limits().items()}
+
+    def _report_batch_complete(self, completed_tasks: int, total_tasks: int) -> None:
+        if self.hedge_policy is not None:
+            print(self.hedge_policy.format_summary())
+        super()._report_batch_complete(completed_tasks, total_tasks)
+
+    async def _run_pipeline_stage_async(self, stage: str, task: Dict) -> None:
+        """Run one stage of one task, keeping the stage output on the task for the next stage"""
+        if stage == "A1":
+            await self.memory_monitor.wait_for_headroom_async()
+            self._start_plan_task(task)
+            task["A1"] = await task["agent"].run_stage_a1(task["prompt_text"], skip_initial_model_a=False)
+        elif stage == "B1":
+            task["B1"] = await task["agent"].run_stage_b1(task["A1"])
+        elif stage == "B2":
+            task["B2"] = await task["agent"].run_stage_b2(task["B1"])
+        elif stage == "A2":
+            await task["agent"].run_stage_a2(task["B2"], task["prompt_text"], max_iterations=3)
+            await asyncio.to_thread(task["agent"].finish_conversation)
+            self._report_agent_result(task["agent_id"], task["agent"])
+
+    async def _run_plan_node_async(self, node: Dict, task: Dict) -> List[Tuple]:
+        """
+        Run one plan node, then its children concurrently.
+        Returns ((category_id, prompt_id, trial), success) for every task below the node.
+        """
+        try:
+            await self._run_pipeline_stage_async(node["stage"], task)
+            children = [(child, self._fork_plan_task(task, child)) for child in node["children"]]
+        except Exception as e:
+            print(f"[Batch] Error processing {task['agent_id']} in stage {node['stage']}: {str(e)}")
+            self.running_agents.pop(task["agent_id"], None)
+            return [(target, False) for target in self._plan_targets(node)]
+
+        if not children:
+            self.running_agents.pop(task["agent_id"], None)
+            self._task_finished(time.monotonic() - task["started"])
+            return [(target, True) for target in self._plan_targets(node)]
+        results = await asyncio.gather(*[self._run_plan_node_async(child, child_task)
+                                         for child, child_task in children])
+        return [outcome for child_results in results for outcome in child_results]
+
+    async def run_batch_async(self, test_prompts: Dict[int, Dict[int, str]], num_trials: int = 3):
+        """
+        Run a batch of prompts with multiple trials each on the current event loop
+
+        Args:
+            test_prompts: Dictionary of categories with prompts
+                          {category_id: {prompt_id: prompt_text}}
+            num_trials: Number of times to run each prompt
+        """
+        all_tasks = self._build_task_list(test_prompts, num_trials)
+        total_tasks = len(all_tasks)
+        if not all_tasks:
+            print("[Batch] Nothing to do.")
+            return 0
+        self._start_batch_workers()
+
+        # The semaphore must be created on the loop that runs the batch; concurrency limits work on any loop
+        self.call_semaphore = asyncio.Semaphore(self.max_concurrent_calls)
+
+        roots = self.planner.plan(all_tasks)
+        print(self.planner.format_summary(all_tasks, roots))
+
+        # Every plan root is scheduled immediately; the call semaphore decides what is actually in flight
+        pending = {asyncio.create_task(self._run_plan_node_async(root, self._plan_task(root["leaves"][0])))
+                   for root in roots}
+
+        completed_tasks = 0
+        while pending and not self.stop_requested:
+            # Wait for the next prompt (or trial) to complete
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED, timeout=30)
+
+            for task in done:
+                for (cat_id, p_id, t_num), success in task.result():
+                    self._report_task_outcome(f"Category {cat_id}, Prompt {p_id}, Trial {t_num}", success)
+
+                    completed_tasks += 1
+                    print(
+                        f"[Batch] Progress: {completed_tasks}/{total_tasks} tasks completed ({completed_tasks / total_tasks * 100:.1f}%)")
+
+        # Check if stop requested
+        if pending:
+            print("[Batch] Stop requested, cancelling remaining tasks...")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        self._report_batch_complete(completed_tasks, total_tasks)
+        await self.http_clients.aclose()
         return completed_tasks
 
+    def run_batch(self, test_prompts: Dict[int, Dict[int, str]], num_trials: int = 3):
+        """Run a batch of prompts with multiple trials each on a new event loop"""
+        return asyncio.run(self.run_batch_async(test_prompts, num_trials))
+
+
+def _stand_in_responder(body: Dict) -> Tuple[str, str]:
+    """Default LocalBatchServer reply: a short placeholder naming the model and the prompt size."""
+    prompt_chars = sum(len(message.get("content") or "") for message in body.get("messages", []))
+    return f"[stand-in response from {body.get('model')} to {prompt_chars} prompt chars]", "stop"
+
+
+class LocalBatchServer:
+    """
+    Local stand-in for the OpenAI files and batches endpoints, for exercising Batch API mode offline.
+    Uploaded request files are answered by responder(request_body) -> (content, finish_reason); a batch
+    reports in_progress when created and completed on the next status check.
+    """
+
+    class _HTTPServer(http.server.ThreadingHTTPServer):
+        request_queue_size = 256  # Benchmarks open many connections at once
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            # Clients hang up on purpose (cancelled hedges, timeouts); only report real errors
+            if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+                super().handle_error(request, client_address)
+
+    def __init__(self, responder=None, host: str = "127.0.0.1", port: int = 0):
+        self.responder = responder or _stand_in_responder
+        self.files = {}  # file id -> {"bytes": ..., "filename": ..., "purpose": ...}
+        self.batches = {}  # batch id -> batch object
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._server = self._HTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="local-batch-server")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_id(self, prefix):
+        with self._lock:
+            self._counter += 1
+            return f"{prefix}-local{self._counter}"
+
+    def connection_opened(self) -> None:
+        """Called by the handler for every new client connection."""
+
+    def _file_object(self, file_id):
+        stored = self.files[file_id]
+        return {"id": file_id, "object": "file", "bytes": len(stored["bytes"]), "created_at": stored["created_at"],
+                "filename": stored["filename"], "purpose": stored["purpose"], "status": "processed"}
+
+    def _store_file(self, data, filename, purpose):
+        file_id = self._next_id("file")
+        self.files[file_id] = {"bytes": data, "filename": filename, "purpose": purpose, "created_at": int(time.time())}
+        return self._file_object(file_id)
+
+    def _upload_file(self, content_type, body):
+        # Multipart form upload, as sent by client.files.create
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        data, filename, purpose = b"", "upload.jsonl", "batch"
+        for form_part in message.iter_parts():
+            name = form_part.get_param("name", header="content-disposition")
+            if name == "file":
+                data = form_part.get_payload(decode=True)
+                filename = form_part.get_filename() or filename
+            elif name == "purpose":
+                purpose = form_part.get_payload(decode=True).decode()
+        return self._store_file(data, filename, purpose)
+
+    def _completion_object(self, model, content, finish_reason, prompt_tokens=0):
+        completion_tokens = len(content) // 4
+        return {
+            "id": self._next_id("chatcmpl"), "object": "chat.completion", "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}
+        }
+
+    def _answer(self, request_line):
+        """Batch output line for one input line."""
+        request = json.loads(request_line)
+        content, finish_reason = self.responder(request["body"])
+        completion = self._completion_object(request["body"].get("model"), content, finish_reason)
+        return {"id": self._next_id("batch_req"), "custom_id": request["custom_id"], "error": None,
+                "response": {"status_code": 200, "request_id": completion["id"], "body": completion}}
+
+    def _create_batch(self, params):
+        batch_id = self._next_id("batch")
+        lines = self.files[params["input_file_id"]]["bytes"].decode("utf-8").splitlines()
+        output = "".join(json.dumps(self._answer(line)) + "\n" for line in lines if line.strip())
+        output_file = self._store_file(output.encode("utf-8"), f"{batch_id}_output.jsonl", "batch_output")
+        total = sum(1 for line in lines if line.strip())
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": params["endpoint"],
+            "input_file_id": params["input_file_id"], "completion_window": params["completion_window"],
+            "status": "in_progress", "created_at": int(time.time()), "metadata": params.get("metadata"),
+            "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "_output_file_id": output_file["id"]
+        }
+        return self._batch_object(batch_id)
+
+    def _batch_object(self, batch_id):
+        return {key: value for key, value in self.batches[batch_id].items() if not key.startswith("_")}
+
+    def _retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        if batch["status"] == "in_progress":
+            batch["status"] = "completed"
+            batch["output_file_id"] = batch["_output_file_id"]
+            batch["request_counts"]["completed"] = batch["request_counts"]["total"]
+        return self._batch_object(batch_id)
+
+    def handle_post(self, handler, route: List[str], body: bytes) -> None:
+        """Answer a POST to /v1/<route>; subclasses add routes and defer to this for the rest."""
+        try:
+            if route == ["files"]:
+                return handler._send(200, self._upload_file(handler.headers["Content-Type"], body))
+            if route == ["batches"]:
+                return handler._send(200, self._create_batch(json.loads(body)))
+            if len(route) == 3 and route[0] == "batches" and route[2] == "cancel":
+                self.batches[route[1]]["status"] = "cancelled"
+                return handler._send(200, self._batch_object(route[1]))
+        except KeyError as e:
+            return handler._send(404, {"error": {"message": f"Unknown id {e}", "type": "invalid_request_error"}})
+        handler._send(404, {"error": {"message": f"Unknown route {handler.path}", "type": "invalid_request_error"}})
+
+    def handle_get(self, handler, route: List[str]) -> None:
+        """Answer a GET of /v1/<route>."""
+        try:
+            if len(route) == 3 and route[0] == "files" and route[2] == "content":
+                return handler._send(200, raw=self.files[route[1]]["bytes"])
+            if len(route) == 2 and route[0] == "files":
+                return handler._send(200, self._file_object(route[1]))
+            if len(route) == 2 and route[0] == "batches":
+                return handler._send(200, self._retrieve_batch(route[1]))
+        except KeyError as e:
+            return handler._send(404, {"error": {"message": f"Unknown id {e}", "type": "invalid_request_error"}})
+        handler._send(404, {"error": {"message": f"Unknown route {handler.path}", "type": "invalid_request_error"}})
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, so clients can reuse their connections
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                server.connection_opened()
+
+            def _send(self, status, payload=None, raw=None, headers=None):
+                data = raw if raw is not None else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/octet-stream" if raw is not None else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _route(self):
+                return self.path.split("?")[0].rstrip("/").split("/")[2:]  # strip the leading "/v1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                if len(body) < length:
+                    self.close_connection = True
+                    return  # The client hung up while sending the request
+                server.handle_post(self, self._route(), body)
+
+            def do_GET(self):
+                server.handle_get(self, self._route())
+
+        return Handler
+
+
+class BatchApiMusicGenerator(BatchMusicGenerator):
+    """
+    Batch runner that sends the whole sweep through the OpenAI Batch API instead of interactive calls.
+    Each stage's requests for every task are written to one JSONL file and submitted as a batch job; once the
+    job completes its results are handed to the agents and the next stage's job is built from them. A2 parts
+    cut off by the token limit are continued in further batch rounds, up to max_iterations calls per part.
+    Batch jobs are billed at the batch discount and do not count against the interactive rate limits.
+    """
+
+    BATCH_ENDPOINT = "/v1/chat/completions"
+    FINAL_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, *args, poll_interval: float = 60.0, completion_window: str = "24h",
+                 max_iterations: int = 3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_iterations = max_iterations
+        # Files and batches calls do not go through _request_model, so they keep the SDK's own retries
+        self.client = self.http_clients.client(self.api_key, self.base_url, max_retries=2)
+
+        # Request files, downloaded results and the index of submitted jobs
+        self.batch_dir = os.path.join(self.output_base_dir, "Batch_Jobs")
+        os.makedirs(self.batch_dir, exist_ok=True)
+        self.job_index_path = os.path.join(self.batch_dir, "jobs.json")
+
+    def _extra_agent_kwargs(self) -> Dict:
+        kwargs = super()._extra_agent_kwargs()
+        kwargs["stream_a2"] = False  # Batch results arrive whole
+        return kwargs
+
+    def _load_job_index(self) -> Dict:
+        if not os.path.exists(self.job_index_path):
+            return {}
+        with open(self.job_index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_job_index(self, job_index: Dict) -> None:
+        temp_path = f"{self.job_index_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(job_index, f, indent=2)
+        os.replace(temp_path, self.job_index_path)
+
+    def _batch_request(self, custom_id: str, agent, stage: str, messages: List[Dict]) -> Dict:
+        """One line of a batch input file, using the same request body the agent would send interactively."""
+        model_name, system_prompt, temperature, top_p, max_tokens = agent._stage_settings(stage)
+        body = agent._build_request_kwargs(model_name, agent._format_messages(system_prompt, messages), temperature,
+                                           top_p, max_tokens, None)
+        return {"custom_id": custom_id, "method": "POST", "url": self.BATCH_ENDPOINT, "body": body}
+
+    def _submit_batch(self, label: str, requests: List[Dict]) -> Dict[str, Tuple[str, str]]:
+        """
+        Submit one batch job and wait for it to finish.
+        Returns {custom_id: (content, finish_reason)} for every request that succeeded.
+        A job already submitted with identical requests (e.g. before an interruption) is reused, not resubmitted.
+        """
+        if not requests:
+            return {}
+        payload = "".join(json.dumps(request) + "\n" for request in requests).encode("utf-8")
+        payload_hash = hashlib.sha256(payload).hexdigest()
+
+        job_index = self._load_job_index()
+        batch = None
+        known_job = job_index.get(payload_hash)
+        if known_job:
+            batch = self.client.batches.retrieve(known_job["batch_id"])
+            if batch.status in ("failed", "expired", "cancelled"):
+                batch = None
+            else:
+                print(f"[Batch API] {label}: reattached to {batch.id} ({batch.status})")
+
+        if batch is None:
+            input_path = os.path.join(self.batch_dir, f"{label}_{payload_hash[:12]}.jsonl")
+            with open(input_path, 'wb') as f:
+                f.write(payload)
+            with open(input_path, 'rb') as f:
+                input_file = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(input_file_id=input_file.id, endpoint=self.BATCH_ENDPOINT,
+                                               completion_window=self.completion_window,
+                                               metadata={"stage": label})
+            job_index[payload_hash] = {"batch_id": batch.id, "label": label, "requests": len(requests)}
+            self._save_job_index(job_index)
+            print(f"[Batch API] {label}: submitted {len(requests)} requests as {batch.id}")
+
+        while batch.status not in self.FINAL_BATCH_STATUSES:
+            if self.stop_requested:
+                print(f"[Batch API] {label}: stop requested; {batch.id} keeps running and is reused on the next run")
+                return {}
+            time.sleep(self.poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            progress = f"{counts.completed}/{counts.total} done, {counts.failed} failed" if counts else ""
+            print(f"[Batch API] {label}: {batch.status} {progress}")
+
+        if batch.status != "completed":
+            print(f"[Batch API] {label}: batch {batch.id} ended with status {batch.status}")
+        if batch.error_file_id:
+            errors = self.client.files.content(batch.error_file_id).text
+            print(f"[Batch API] {label}: {len(errors.splitlines())} requests failed, see error file {batch.error_file_id}")
+        if not batch.output_file_id:
+            return {}
+
+        output = self.client.files.content(batch.output_file_id).text
+        with open(os.path.join(self.batch_dir, f"{label}_{payload_hash[:12]}_output.jsonl"), 'w',
+                  encoding='utf-8') as f:
+            f.write(output)
+
+        results = {}
+        stage = re.sub(r'(?<=[a-z])\d+$', '', label)  # "A2-cont2" -> "A2-cont", "A1" stays "A1"
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                print(f"[Batch API] {label}: request {record.get('custom_id')} failed: {record.get('error')}")
+                model_name = (response.get("body") or {}).get("model") or "other"
+                self.metrics.inc("maestro_call_failures_total", stage=stage, model=model_name)
+                continue
+            choice = response["body"]["choices"][0]
+            results[record["custom_id"]] = (choice["message"]["content"], choice.get("finish_reason"))
+            self._record_batch_result_metrics(stage, response["body"], choice.get("finish_reason"))
+        return results
+
+    def _record_batch_result_metrics(self, stage: str, body: Dict, finish_reason: str) -> None:
+        """Count the tokens and finish reason of one batch result (batch jobs have no per-call latency)."""
+        labels = {"stage": stage, "model": body.get("model") or "other"}
+        usage = body.get("usage") or {}
+        self.metrics.inc("maestro_finish_reasons_total", finish_reason=finish_reason or "none", **labels)
+        self.metrics.inc("maestro_prompt_tokens_total", usage.get("prompt_tokens") or 0, **labels)
+        self.metrics.inc("maestro_completion_tokens_total", usage.get("completion_tokens") or 0, **labels)
+
+    def _fail_task(self, task: Dict, stage: str) -> None:
+        print(f"[Batch] Error processing {task['agent_id']} in stage {stage}: no batch result")
+        task["failed"] = True
+        self.running_agents.pop(task["agent_id"], None)
+
+    def _run_text_stage(self, stage: str, tasks: List[Dict]) -> None:
+        """Run A1, B1 or B2 for every active task as one batch, feeding each task's previous output."""
+        previous = {"A1": "prompt_text", "B1": "A1", "B2": "B1"}[stage]
+        requests = []
+        for task in tasks:
+            if task.get("failed"):
+                continue
+            resumed = task["agent"]._resume_stage(stage)
+            if resumed is not None:
+                task[stage] = resumed
+                continue
+            requests.append(self._batch_request(f"{task['agent_id']}|{stage}", task["agent"], stage,
+                                                [{"role": "user", "content": task[previous]}]))
+
+        results = self._submit_batch(stage, requests)
+        for task in tasks:
+            if task.get("failed") or stage in task:
+                continue
+            result = results.get(f"{task['agent_id']}|{stage}")
+            if result is None:
+                self._fail_task(task, stage)
+                continue
+            task[stage] = result[0]
+            task["agent"]._record_stage(stage, result[0])
+
+    def _run_a2_stage(self, tasks: List[Dict]) -> None:
+        """Write every part of every task in one batch, then continue truncated parts in further rounds."""
+        requests = []
+        pending = {}
+        for task in tasks:
+            if task.get("failed"):
+                continue
+            agent = task["agent"]
+            task["a2_results"] = []
+            parts = agent._parse_parts_from_b2_output(task["B2"])
+            print(f"[Agent {agent.agent_id}] Parsed {len(parts)} parts from Model B2 output")
+            for part_name, part_content, part_number in parts:
+                resumed = agent._resume_part(part_number)
+                if resumed is not None:
+                    task["a2_results"].append((resumed, resumed["a2_response"], []))
+                    continue
+                custom_id = f"{task['agent_id']}|A2|{part_number}"
+                messages = [{"role": "user", "content": agent._build_part_prompt(part_name, part_content, part_number)}]
+                requests.append(self._batch_request(custom_id, agent, "A2", messages))
+                pending[custom_id] = (task, part_name, part_content, part_number)
+
+            task["part_count"] = len(parts)
+
+        results = self._submit_batch("A2", requests)
+        for custom_id, (task, part_name, part_content, part_number) in pending.items():
+            result = results.get(custom_id)
+            if result is None:
+                # The parts that did arrive are journaled, so a resumed run only requests the missing ones
+                print(f"[Batch] Part {part_name} (Part {part_number}) of {task['agent_id']} has no batch result")
+                if not task.get("failed"):
+                    self._fail_task(task, "A2")
+                continue
+            part_result = task["agent"]._accept_part_response(part_name, part_content, part_number, *result)
+            task["a2_results"].append((part_result, result[0], []))
+            if not task["agent"].abort_reason:
+                try:
+                    task["agent"]._check_part_structure(part_result, task["part_count"])
+                except TrialAbortedError:
+                    pass
+
+        # Hopeless trials get no continuation or repair requests
+        for task in tasks:
+            if not task.get("failed") and task["agent"].abort_reason:
+                try:
+                    task["agent"]._finish_aborted_trial(task["a2_results"])
+                except TrialAbortedError as e:
+                    print(f"[Batch] Error processing {task['agent_id']} in stage A2: {e}")
+                task["failed"] = True
+                self.running_agents.pop(task["agent_id"], None)
+
+        # Each round continues every part whose last response was cut off by the token limit
+        for call in range(2, self.max_iterations + 1):
+            requests = []
+            pending = {}
+            for task in tasks:
+                if task.get("failed"):
+                    continue
+                agent = task["agent"]
+                for part_result, _, continuations in task["a2_results"]:
+                    if not agent._part_needs_continuation(part_result):
+                        continue
+                    custom_id = f"{task['agent_id']}|A2-cont|{part_result['part_number']}|{call}"
+                    segment = agent._continuation_segment()
+                    messages = [{"role": "user", "content": agent._build_continuation_prompt(part_result)}]
+                    requests.append(self._batch_request(custom_id, agent, "A2-cont", messages))
+                    pending[custom_id] = (agent, part_result, continuations, segment)
+            if not requests:
+                break
+
+            results = self._submit_batch(f"A2-cont{call}", requests)
+            for custom_id, (agent, part_result, continuations, segment) in pending.items():
+                result = results.get(custom_id)
+                if result is None:
+                    continue
+                agent.score_assembler.feed(part_result["part_number"], "\n\n" + result[0], segment=segment)
+                continuations.append(agent._apply_continuation(part_result, *result, segment))
+
+        if self.validate_measures:
+            self._run_repair_rounds(tasks)
+
+    def _run_repair_rounds(self, tasks: List[Dict]) -> None:
+        """Re-request, as batches, only the measure ranges that fail validation."""
+        for repair_round in range(1, self.repair_rounds + 1):
+            requests = []
+            pending = {}
+            for task in tasks:
+                if task.get("failed"):
+                    continue
+                agent = task["agent"]
+                for part_result, _, continuations in task["a2_results"]:
+                    issues = agent._validate_part(part_result)
+                    for first, last, range_issues in MeasureValidator.issue_ranges(issues)[:agent.max_repair_ranges]:
+                        custom_id = f"{task['agent_id']}|A2-fix|{part_result['part_number']}|{first}-{last}|{repair_round}"
+                        messages = [{"role": "user",
+                                     "content": agent._build_repair_prompt(part_result, first, last, range_issues)}]
+                        requests.append(self._batch_request(custom_id, agent, "A2-fix", messages))
+                        pending[custom_id] = (agent, part_result, continuations)
+            if not requests:
+                break
+
+            results = self._submit_batch(f"A2-fix{repair_round}", requests)
+            for custom_id, (agent, part_result, continuations) in pending.items():
+                result = results.get(custom_id)
+                if result is None:
+                    continue
+                segment = agent._repair_segment()
+                agent.score_assembler.feed(part_result["part_number"], result[0], segment=segment)
+                continuations.append(agent._apply_repair(part_result, result[0], segment))
+
+        for task in tasks:
+            if not task.get("failed"):
+                for part_result, _, _ in task["a2_results"]:
+                    task["agent"]._report_validation(part_result, task["agent"]._validate_part(part_result))
+
+    def run_batch(self, test_prompts: Dict[int, Dict[int, str]], num_trials: int = 3):
+        """
+        Run a batch of prompts with multiple trials each as one Batch API job per stage
+
+        Args:
+            test_prompts: Dictionary of categories with prompts
+                          {category_id: {prompt_id: prompt_text}}
+            num_trials: Number of times to run each prompt
+        """
+        all_tasks = self._build_task_list(test_prompts, num_trials)
+        total_tasks = len(all_tasks)
+        if not all_tasks:
+            print("[Batch] Nothing to do.")
+            return 0
+        self._start_batch_workers()
+
+        started = time.monotonic()
+        tasks = []
+        for category_id, prompt_id, prompt_text, trial in all_tasks:
+            task = {
+                "category_id": category_id,
+                "prompt_id": prompt_id,
+                "prompt_text": prompt_text,
+                "trial": trial,
+                "agent_id": f"Cat{category_id}_Prompt{prompt_id}_Trial{trial}",
+                "agent": self._create_agent(category_id, prompt_id, trial)
+            }
+            self.running_agents[task["agent_id"]] = task["agent"]
+            task["agent"].start_conversation(prompt_text)
+            tasks.append(task)
+
+        for stage in ("A1", "B1", "B2"):
+            if self.stop_requested:
+                break
+            self._run_text_stage(stage, tasks)
+        if not self.stop_requested:
+            self._run_a2_stage(tasks)
+
+        completed_tasks = 0
+        for task in tasks:
+            task_desc = f"Category {task['category_id']}, Prompt {task['prompt_id']}, Trial {task['trial']}"
+            if task.get("failed") or "a2_results" not in task:
+                self._report_task_outcome(task_desc, False)
+                continue
+            agent = task["agent"]
+            agent._record_a2_history(task["a2_results"])
+            agent._report_note_variety()
+            agent.save_incremental_output()
+            agent.finish_conversation()
+            self._report_agent_result(task["agent_id"], agent)
+            self.running_agents.pop(task["agent_id"], None)
+            self._task_finished(time.monotonic() - started)
+            completed_tasks += 1
+            self._report_task_outcome(task_desc, True)
+
+        self._report_batch_complete(completed_tasks, total_tasks)
+        return completed_tasks
+
+
+# Semitone offset of each note step from C, for MIDI pitch numbers
+_STEP_SEMITONES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+SCORE_EXTENSIONS = (".xml", ".musicxml", ".mxl")
+# Sequences shorter than this have too few frequency bins for a meaningful spectral slope
+MIN_SPECTRAL_NOTES = 16
+# Bump when the extraction or fit changes so cached results are recomputed
+SPECTRAL_ANALYSIS_VERSION = 1
+
+
+def _read_score_bytes(path: str) -> bytes:
+    """Raw MusicXML of a score file, unpacking compressed .mxl archives."""
+    if path.lower().endswith(".mxl"):
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist()
+                     if name.lower().endswith((".xml", ".musicxml")) and not name.startswith("META-INF/")]
+            return archive.read(names[0])
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _midi_pitch(pitch):
+    """
+    MIDI number of a <pitch> element (fractional for microtonal alters), or None when there is no pitch or
+    its step, octave or alter cannot be read.
+    """
+    if pitch is None:
+        return None
+    try:
+        return ((int(pitch.findtext("octave")) + 1) * 12 + _STEP_SEMITONES[pitch.findtext("step").strip().upper()]
+                + float(pitch.findtext("alter") or 0))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def extract_note_sequences(xml_content: bytes) -> List[Dict]:
+    """
+    Pitch (MIDI number) and duration (quarter notes) sequences of every part of a partwise MusicXML score.
+    Each part is read as a single line: chord tones after the first and grace notes are skipped, and
+    rests count towards the duration sequence but not the pitch sequence.
+    """
+    root = ET.fromstring(xml_content)
+    sequences = []
+    for part in root.iter("part"):
+        divisions = 1.0
+        pitches = []
+        durations = []
+        for measure in part.iter("measure"):
+            for element in measure:
+                if element.tag == "attributes" and element.findtext("divisions"):
+                    divisions = float(element.findtext("divisions"))
+                if element.tag != "note" or element.find("chord") is not None or element.find("grace") is not None:
+                    continue
+                duration = element.findtext("duration")
+                if duration:
+                    durations.append(float(duration) / divisions)
+                midi = _midi_pitch(element.find("pitch"))
+                if midi is not None:
+                    pitches.append(midi)
+        sequences.append({"part_id": part.get("id"), "pitches": pitches, "durations": durations})
+    return sequences
+
+
+def _extract_score_file(path: str):
+    """Process pool worker: note sequences of one score file, or the reason it could not be read."""
+    try:
+        return extract_note_sequences(_read_score_bytes(path)), None
+    except (OSError, zipfile.BadZipFile, IndexError, ET.ParseError, ValueError, KeyError, TypeError,
+            AttributeError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def spectral_exponents(sequences: List[List[float]]):
+    """
+    1/f exponents (beta in P(f) ~ 1/f^beta) of many sequences at once.
+    Sequences of equal length are stacked into one 2-D array, so each length costs a single rfft and a single
+    vectorized least-squares fit of log power against log frequency. Sequences that are too short or constant
+    get NaN.
+    """
+    exponents = np.full(len(sequences), np.nan)
+    by_length = {}
+    for index, sequence in enumerate(sequences):
+        if len(sequence) >= MIN_SPECTRAL_NOTES:
+            by_length.setdefault(len(sequence), []).append(index)
+
+    for length, indices in by_length.items():
+        batch = np.asarray([sequences[index] for index in indices], dtype=float)
+        batch -= batch.mean(axis=1, keepdims=True)
+        power = np.abs(np.fft.rfft(batch, axis=1)[:, 1:]) ** 2  # Drop the DC bin
+
+        with np.errstate(divide="ignore"):
+            log_power = np.log10(power)
+        valid = np.isfinite(log_power).all(axis=1)
+        log_power[~valid] = 0.0
+
+        log_freq = np.log10(np.arange(1, power.shape[1] + 1) / length)
+        centered_freq = log_freq - log_freq.mean()
+        slopes = ((log_power - log_power.mean(axis=1, keepdims=True)) * centered_freq).sum(axis=1) / (
+            centered_freq ** 2).sum()
+        exponents[np.asarray(indices)[valid]] = -slopes[valid]
+    return exponents
+
+
+class SpectralAnalyzer:
+    """
+    1/f pitch and duration analysis of MusicXML scores.
+    Scores are parsed on a process pool, every part's sequences go through spectral_exponents in one batch,
+    and each file's result is cached by content hash so rerunning over a growing output folder or the
+    training corpus only analyzes new files. A file's exponent is the note-weighted mean over its parts; when
+    every part is too short to measure, the parts are joined in score order and measured as one sequence.
+    """
+
+    def __init__(self, cache_path: str = "spectral_analysis_cache.json", max_workers: int = None):
+        if np is None:
+            raise RuntimeError("The 1/f analysis needs NumPy (pip install numpy)")
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+        self.cache = self._load_cache()
+
+    def _load_cache(self) -> Dict:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        with open(self.cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        return cache.get("results", {}) if cache.get("version") == SPECTRAL_ANALYSIS_VERSION else {}
+
+    def _save_cache(self) -> None:
+        if not self.cache_path:
+            return
+        temp_path = f"{self.cache_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": SPECTRAL_ANALYSIS_VERSION, "results": self.cache}, f)
+        os.replace(temp_path, self.cache_path)
+
+    @staticmethod
+    def find_scores(paths: List[str]) -> List[str]:
+        """Score files in the given files and directories (searched recursively)."""
+        score_paths = []
+        for path in paths:
+            if os.path.isdir(path):
+                for directory, _, filenames in os.walk(path):
+                    score_paths.extend(os.path.join(directory, filename) for filename in sorted(filenames)
+                                       if filename.lower().endswith(SCORE_EXTENSIONS))
+            else:
+                score_paths.append(path)
+        return score_paths
+
+    def _combine_parts(self, parts, part_exponents, joined_exponents):
+        """Note-weighted mean of the part exponents that could be measured, else the joined-parts exponent."""
+        result = {"parts": len(parts), "notes": sum(len(part["pitches"]) for part in parts)}
+        for key, field in (("pitch_exponent", "pitches"), ("duration_exponent", "durations")):
+            exponents = part_exponents[field]
+            weights = np.asarray([len(part[field]) for part in parts], dtype=float)
+            measured = ~np.isnan(exponents)
+            if measured.any():
+                result[key] = float(np.average(exponents[measured], weights=weights[measured]))
+            elif not np.isnan(joined_exponents[field]):
+                result[key] = float(joined_exponents[field])
+            else:
+                result[key] = None
+        return result
+
+    def analyze(self, paths: List[str]) -> Dict[str, Dict]:
+        """Analyze every score under the given paths; returns {file path: result}."""
+        score_paths = self.find_scores(paths)
+        results = {}
+        digests = {}
+        for path in score_paths:
+            with open(path, 'rb') as f:
+                digests[path] = hashlib.sha256(f.read()).hexdigest()
+            if digests[path] in self.cache:
+                results[path] = self.cache[digests[path]]
+        new_paths = [path for path in score_paths if path not in results]
+        print(f"[Analysis] {len(score_paths)} scores, {len(score_paths) - len(new_paths)} cached, "
+              f"{len(new_paths)} to analyze")
+
+        # Parsing is the expensive part; the FFTs for all files then run together
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            extracted = list(executor.map(_extract_score_file, new_paths, chunksize=16))
+
+        parsed = []
+        for path, (parts, error) in zip(new_paths, extracted):
+            if error is not None:
+                print(f"[Analysis] Skipping {path}: {error}")
+                results[path] = {"error": error}
+            else:
+                parsed.append((path, parts))
+
+        # One batch per sequence type: every part of every file, and every file's parts joined in order
+        all_parts = [part for _, parts in parsed for part in parts]
+        part_exponents = {}
+        joined_exponents = {}
+        for field in ("pitches", "durations"):
+            part_exponents[field] = spectral_exponents([part[field] for part in all_parts])
+            joined_exponents[field] = spectral_exponents(
+                [[value for part in parts for value in part[field]] for _, parts in parsed])
+
+        offset = 0
+        for file_index, (path, parts) in enumerate(parsed):
+            count = len(parts)
+            results[path] = self._combine_parts(
+                parts,
+                {field: exponents[offset:offset + count] for field, exponents in part_exponents.items()},
+                {field: exponents[file_index] for field, exponents in joined_exponents.items()})
+            self.cache[digests[path]] = results[path]
+            offset += count
+
+        self._save_cache()
+        return results
+
+    @staticmethod
+    def format_summary(results: Dict[str, Dict], group_by=os.path.dirname) -> str:
+        """Mean and spread of the exponents per group of files (by default per directory)."""
+        groups = {}
+        for path, result in results.items():
+            groups.setdefault(group_by(path), []).append(result)
+
+        lines = [f"{'Group':<40} {'Files':>6} {'1/f pitch':>16} {'1/f duration':>16}"]
+        for group, group_results in sorted(groups.items()):
+            cells = []
+            for key in ("pitch_exponent", "duration_exponent"):
+                values = np.asarray([r[key] for r in group_results if r.get(key) is not None], dtype=float)
+                cells.append(f"{values.mean():.3f} ± {values.std():.3f}" if len(values) else "n/a")
+            lines.append(f"{group or '.':<40} {len(group_results):>6} {cells[0]:>16} {cells[1]:>16}")
+        return "\n".join(lines)
+
+
+# Key signature (position on the circle of fifths) of every major and minor key a prompt can name
+_KEY_FIFTHS = {
+    "major": {"C": 0, "G": 1, "D": 2, "A": 3, "E": 4, "B": 5, "F#": 6, "C#": 7,
+              "F": -1, "Bb": -2, "Eb": -3, "Ab": -4, "Db": -5, "Gb": -6, "Cb": -7},
+    "minor": {"A": 0, "E": 1, "B": 2, "F#": 3, "C#": 4, "G#": 5, "D#": 6, "A#": 7,
+              "D": -1, "G": -2, "C": -3, "F": -4, "Bb": -5, "Eb": -6, "Ab": -7},
+}
+# Note lengths given their own column in the corpus note-type table; the rest are counted as "other"
+CORPUS_NOTE_TYPES = ("whole", "half", "quarter", "eighth", "16th", "32nd")
+# Bump when the per-score statistics change so cached results are recomputed
+CORPUS_STATS_VERSION = 1
+_TRIAL_FILENAME_PATTERN = re.compile(r"Category(\d+)_Prompt(\d+)_Trial(\d+)\.", re.IGNORECASE)
+
+
+def score_statistics(xml_content: bytes) -> Dict:
+    """
+    Corpus statistics of one partwise MusicXML score: note lengths used (as "quarter", "eighth." for dotted
+    or "eighth/3" for triplets), notes, rests, measure count and pitch range (MIDI numbers) of every part,
+    the key and time signatures it declares in order, and how many measures fail MeasureValidator.
+    Chord tones after the first and grace notes are not counted as separate events.
+    """
+    root = ET.fromstring(xml_content)
+    names = {score_part.get("id"): (score_part.findtext("part-name") or "").strip()
+             for score_part in root.iter("score-part")}
+    validator = MeasureValidator()
+    note_types = Counter()
+    keys, times = [], []
+    parts = []
+    misfit_measures = 0
+    for part in root.iter("part"):
+        measures = {}
+        notes = rests = 0
+        pitches = []
+        for measure in part.iter("measure"):
+            measures[measure.get("number")] = ET.tostring(measure, encoding="unicode")
+            for attributes in measure.iter("attributes"):
+                key = attributes.find("key")
+                if key is not None and key.findtext("fifths"):
+                    signature = [int(key.findtext("fifths")), (key.findtext("mode") or "").strip() or None]
+                    if signature not in keys:
+                        keys.append(signature)
+                time_element = attributes.find("time")
+                if time_element is not None and time_element.findtext("beats"):
+                    signature = f"{time_element.findtext('beats').strip()}/{time_element.findtext('beat-type').strip()}"
+                    if signature not in times:
+                        times.append(signature)
+            for note in measure.iter("note"):
+                midi = _midi_pitch(note.find("pitch"))
+                if midi is not None:
+                    pitches.append(midi)
+                if note.find("chord") is not None or note.find("grace") is not None:
+                    continue
+                if note.find("rest") is not None:
+                    rests += 1
+                else:
+                    notes += 1
+                note_type = (note.findtext("type") or "").strip()
+                if note_type:
+                    modification = note.find("time-modification")
+                    note_types[note_type + "." * len(note.findall("dot"))
+                               + (f"/{modification.findtext('actual-notes')}" if modification is not None else "")] += 1
+        misfit_measures += len({issue["measure"] for issue in validator.validate_part(measures)})
+        parts.append({
+            "id": part.get("id"),
+            "name": names.get(part.get("id"), ""),
+            "measures": len({number for number in measures if number and number.isdigit()}),
+            "notes": notes,
+            "rests": rests,
+            "lowest": min(pitches) if pitches else None,
+            "highest": max(pitches) if pitches else None
+        })
+    return {
+        "parts": parts,
+        "measures": max((part["measures"] for part in parts), default=0),
+        "notes": sum(part["notes"] for part in parts),
+        "rests": sum(part["rests"] for part in parts),
+        "note_types": dict(note_types),
+        "note_lengths": len(note_types),
+        "keys": keys,
+        "times": times,
+        "misfit_measures": misfit_measures
+    }
+
+
+def _score_statistics_file(path: str):
+    """Process pool worker: corpus statistics of one score file, or the reason it could not be read."""
+    try:
+        return score_statistics(_read_score_bytes(path)), None
+    except (OSError, zipfile.BadZipFile, IndexError, ET.ParseError, ValueError, KeyError, TypeError,
+            AttributeError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+class CorpusAnalyzer:
+    """
+    Corpus statistics of the generated scores in XML_Output: note-length variety, pitch range per part,
+    rest ratio, measure count against the requested length, and key and time signature against the prompt.
+    Scores are parsed on a process pool. A file's result is reused while its size and modification time are
+    unchanged, or, if they changed, while its content hash is, so a rerun after each new batch only stats and
+    hashes the new files. Results are kept by content hash, so copies of a score are parsed once.
+    """
+
+    def __init__(self, cache_path: str = "corpus_stats_cache.json", max_workers: int = None):
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+        self.files, self.results = self._load_cache()
+
+    def _load_cache(self) -> Tuple[Dict, Dict]:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}, {}
+        with open(self.cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache.get("version") != CORPUS_STATS_VERSION:
+            return {}, {}
+        return cache.get("files", {}), cache.get("results", {})
+
+    def _save_cache(self) -> None:
+        if not self.cache_path:
+            return
+        temp_path = f"{self.cache_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": CORPUS_STATS_VERSION, "files": self.files, "results": self.results}, f)
+        os.replace(temp_path, self.cache_path)
+
+    def _cached_digest(self, path: str):
+        """Content hash of a file, read from the cache while the file's size and mtime are unchanged."""
+        stat = os.stat(path)
+        entry = self.files.get(os.path.abspath(path))
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha256"]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.files[os.path.abspath(path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+        return digest
+
+    def analyze(self, paths: List[str]) -> Dict[str, Dict]:
+        """Statistics of every score under the given paths; returns {file path: result}."""
+        score_paths = SpectralAnalyzer.find_scores(paths)
+        results = {}
+        new_paths = {}
+        for path in score_paths:
+            digest = self._cached_digest(path)
+            if digest in self.results:
+                results[path] = self.results[digest]
+            else:
+                new_paths[path] = digest
+        print(f"[Corpus] {len(score_paths)} scores, {len(score_paths) - len(new_paths)} cached, "
+              f"{len(new_paths)} to analyze")
+
+        if new_paths:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                extracted = list(executor.map(_score_statistics_file, list(new_paths), chunksize=16))
+            for (path, digest), (statistics, error) in zip(new_paths.items(), extracted):
+                if error is not None:
+                    print(f"[Corpus] Skipping {path}: {error}")
+                results[path] = self.results[digest] = {"error": error} if error is not None else statistics
+
+        self._save_cache()
+        return results
+
+    @staticmethod
+    def requested(prompt_text: str) -> Dict:
+        """Measure count, key signature and time signature a prompt asks for (None where it names none)."""
+        key = None
+        match = re.search(r"\b([A-G])(?:-?(flat|sharp)|([b#\u266d\u266f]))?\s+(major|minor)\b", prompt_text,
+                          re.IGNORECASE)
+        if match:
+            accidental = match.group(2) or match.group(3) or ""
+            name = match.group(1).upper() + ("b" if accidental.lower() in ("flat", "b", "\u266d") else
+                                             "#" if accidental.lower() in ("sharp", "#", "\u266f") else "")
+            fifths = _KEY_FIFTHS[match.group(4).lower()].get(name)
+            key = [fifths, match.group(4).lower()] if fifths is not None else None
+        time_match = re.search(r"\b(\d+)/(\d+)\b", prompt_text)
+        return {"measures": requested_measure_count(prompt_text), "key": key,
+                "time": f"{time_match.group(1)}/{time_match.group(2)}" if time_match else None}
+
+    @staticmethod
+    def adherence(result: Dict, prompt_text: str) -> Dict:
+        """How a score's length, first key and first time signature compare with what its prompt asked for."""
+        requested = CorpusAnalyzer.requested(prompt_text or "")
+        adherence = {"measure_ratio": None, "key_ok": None, "time_ok": None}
+        if requested["measures"]:
+            adherence["measure_ratio"] = result["measures"] / requested["measures"]
+        if requested["key"]:
+            first_key = result["keys"][0] if result["keys"] else None
+            adherence["key_ok"] = bool(first_key and first_key[0] == requested["key"][0]
+                                       and first_key[1] in (None, requested["key"][1]))
+        if requested["time"]:
+            adherence["time_ok"] = bool(result["times"]) and result["times"][0] == requested["time"]
+        return adherence
+
+    @staticmethod
+    def trial_of(path: str):
+        """(category, prompt, trial) numbers of an XML_Output file name, or None for other files."""
+        match = _TRIAL_FILENAME_PATTERN.search(os.path.basename(path))
+        return tuple(int(group) for group in match.groups()) if match else None
+
+    @staticmethod
+    def format_summary(results: Dict[str, Dict], prompts: Dict[int, Dict[int, str]] = None) -> str:
+        """
+        Per-category aggregate tables: one of length, variety, range and adherence, one of the share of
+        each note length. prompts ({category_id: {prompt_id: text}}) supply the requested values.
+        """
+        groups = {}
+        for path, result in results.items():
+            trial = CorpusAnalyzer.trial_of(path)
+            groups.setdefault(f"Category {trial[0]}" if trial else "Other", []).append((path, trial, result))
+
+        def mean(values, scale=1.0, digits=2, suffix=""):
+            values = [value for value in values if value is not None]
+            return f"{sum(values) / len(values) * scale:.{digits}f}{suffix}" if values else "n/a"
+
+        lines = [f"{'Group':<12} {'Files':>5} {'Errors':>6} {'Bars/req':>8} {'6+ lens':>7} {'Lengths':>7} "
+                 f"{'Rests':>6} {'Span':>5} {'Key ok':>6} {'Time ok':>7} {'Misfit':>6}"]
+        type_lines = [f"{'Group':<12} " + " ".join(f"{note_type:>7}" for note_type in CORPUS_NOTE_TYPES)
+                      + f" {'other':>7} {'dotted':>7} {'tuplet':>7}"]
+        for group, entries in sorted(groups.items()):
+            scored = [(trial, result) for _, trial, result in entries if "error" not in result]
+            adherence = [CorpusAnalyzer.adherence(result, (prompts or {}).get(trial[0], {}).get(trial[1]) if trial
+                                                  else None) for trial, result in scored]
+            spans = [part["highest"] - part["lowest"] for _, result in scored for part in result["parts"]
+                     if part["lowest"] is not None]
+            rest_ratios = [result["rests"] / (result["notes"] + result["rests"]) for _, result in scored
+                           if result["notes"] + result["rests"]]
+            lines.append(
+                f"{group:<12} {len(entries):>5} {len(entries) - len(scored):>6} "
+                f"{mean([a['measure_ratio'] for a in adherence], 100, 0, '%'):>8} "
+                f"{mean([r['note_lengths'] >= MIN_NOTE_LENGTHS for _, r in scored], 100, 0, '%'):>7} "
+                f"{mean([r['note_lengths'] for _, r in scored], digits=1):>7} "
+                f"{mean(rest_ratios, 100, 0, '%'):>6} "
+                f"{mean(spans, digits=0):>5} "
+                f"{mean([a['key_ok'] for a in adherence], 100, 0, '%'):>6} "
+                f"{mean([a['time_ok'] for a in adherence], 100, 0, '%'):>7} "
+                f"{mean([r['misfit_measures'] for _, r in scored], digits=1):>6}")
+
+            counts = Counter()
+            for _, result in scored:
+                counts.update(result["note_types"])
+            total = sum(counts.values()) or 1
+            by_type = Counter()
+            for label, count in counts.items():
+                base = label.split("/")[0].rstrip(".")
+                by_type[base if base in CORPUS_NOTE_TYPES else "other"] += count
+            dotted = sum(count for label, count in counts.items() if "." in label)
+            tuplets = sum(count for label, count in counts.items() if "/" in label)
+            type_lines.append(f"{group:<12} " + " ".join(f"{by_type[note_type] / total:>7.1%}"
+                                                         for note_type in CORPUS_NOTE_TYPES + ("other",))
+                              + f" {dotted / total:>7.1%} {tuplets / total:>7.1%}")
+
+        legend = ("Bars/req: measures written / requested; 6+ lens: scores using at least "
+                  f"{MIN_NOTE_LENGTHS} note lengths; Rests: share of note events; Span: semitones per part; "
+                  "Misfit: measures per score that do not fill the time signature")
+        return "\n".join(lines + ["", legend, "", "Note lengths by share of note events"] + type_lines)
+
+
+class LatencyModel:
+    """
+    Response timing of MockOpenAIServer: a time to first token drawn from a distribution, plus generation time
+    per output token. scale multiplies every delay so a sweep can run faster than real time.
+    """
+
+    DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+    def __init__(self, distribution: str = "lognormal", median: float = 2.0, sigma: float = 0.6,
+                 tokens_per_second: float = 0.0, scale: float = 1.0, seed: int = None):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {distribution!r}; choose from {self.DISTRIBUTIONS}")
+        self.distribution = distribution
+        self.median = median
+        self.sigma = sigma
+        self.tokens_per_second = tokens_per_second
+        self.scale = scale
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def first_token_delay(self) -> float:
+        """Seconds before the first token of a response."""
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            if self.distribution == "fixed":
+                delay = self.median
+            elif self.distribution == "uniform":
+                delay = self._random.uniform(0, 2 * self.median)
+            elif self.distribution == "exponential":
+                delay = self._random.expovariate(math.log(2) / self.median)
+            else:
+                delay = self._random.lognormvariate(math.log(self.median), self.sigma)
+        return delay * self.scale
+
+    def generation_delay(self, completion_tokens: int) -> float:
+        """Seconds spent generating completion_tokens after the first one."""
+        if not self.tokens_per_second:
+            return 0.0
+        return completion_tokens / self.tokens_per_second * self.scale
+
+
+class ReplayResponder:
+    """
+    Answers chat requests for the benchmark mock server from recorded Conversations/*.json files, or from
+    the conversations in a conversations.sqlite store.
+    A1 is matched by the user prompt, B1 and B2 by the previous stage's recorded output, and A2 parts by the
+    part outline inside a recorded B2 output. Continuations replay the recorded continuation of that part,
+    shard requests get the requested measure range of it and repair requests echo the measures they were given.
+    Requests that match no recording get a small synthetic but well-formed reply as long as the plan asks for,
+    so a benchmark also runs without any recordings.
+    """
+
+    SYNTHETIC_PARTS = ("Piano Right Hand", "Piano Left Hand")
+    SYNTHETIC_MEASURES = 8
+
+    def __init__(self, recordings_dir: str = None):
+        self.by_input = {}  # stage input text -> recorded output of the next stage
+        self.b2_outputs = []  # (recorded B2 output, {part number: A2 text}, {part number: [continuations]})
+        self._part_matches = {}  # part outline -> index into b2_outputs, or None
+        self._lock = threading.Lock()
+        self.recordings = self._load(recordings_dir) if recordings_dir and os.path.exists(recordings_dir) else 0
+
+    @staticmethod
+    def _recorded_histories(recordings: str):
+        """Conversation histories of a folder of JSON files or of a conversation store."""
+        if os.path.isfile(recordings):
+            store = ConversationStore(recordings)
+            trial_key, history = None, []
+            for message in store.query():
+                key = (message["category_id"], message["prompt_id"], message["trial"])
+                if key != trial_key and history:
+                    yield history
+                    history = []
+                trial_key = key
+                history.append({"role": message["role"], "content": message["content"]})
+            store.close()
+            if history:
+                yield history
+            return
+        for filename in sorted(os.listdir(recordings)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(recordings, filename), 'r', encoding='utf-8') as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def _load(self, recordings_dir: str) -> int:
+        count = 0
+        for history in self._recorded_histories(recordings_dir):
+            try:
+                messages = {entry["role"]: entry["content"] for entry in history}
+            except (KeyError, TypeError):
+                continue
+
+            chain = [messages.get(role) for role in ("User", "Model A1", "Model B1", "Model B2")]
+            for stage_input, stage_output in zip(chain, chain[1:]):
+                if stage_input and stage_output:
+                    self.by_input.setdefault(stage_input, stage_output)
+            if messages.get("Model B2") and messages.get("Model A2"):
+                continuations = {}
+                for entry in history:
+                    match = re.match(r'Model A2 \(Cont\. - .* P(\d+)\)$', entry["role"])
+                    if match:
+                        continuations.setdefault(int(match.group(1)), []).append(entry["content"])
+                self.b2_outputs.append((messages["Model B2"], self._split_parts(messages["Model A2"]),
+                                        continuations))
+            count += 1
+        return count
+
+    @staticmethod
+    def _split_parts(a2_text: str) -> Dict[int, str]:
+        """Split a combined A2 response into each part's text; the first part keeps the XML header."""
+        starts = [(match.start(), int(match.group(1))) for match in re.finditer(r'<part\s+id="P(\d+)"', a2_text)]
+        parts = {}
+        for index, (start, number) in enumerate(starts):
+            begin = 0 if index == 0 else start
+            end = starts[index + 1][0] if index + 1 < len(starts) else len(a2_text)
+            parts[number] = a2_text[begin:end].strip()
+        return parts
+
+    def _recording_for_part(self, part_content: str):
+        with self._lock:
+            if part_content not in self._part_matches:
+                self._part_matches[part_content] = next(
+                    (index for index, (b2_output, _, _) in enumerate(self.b2_outputs) if part_content in b2_output),
+                    None)
+            index = self._part_matches[part_content]
+        return self.b2_outputs[index] if index is not None else None
+
+    def __call__(self, body: Dict) -> Tuple[str, str]:
+        messages = body.get("messages", [])
+        system_prompt = messages[0].get("content", "") if messages else ""
+        user = messages[-1].get("content", "") if messages else ""
+
+        part = re.match(r'Part: (.*?) \(ID: P(\d+)\) ---\n\n(.*?)\n\n(?:Please implement|--- )', user, re.DOTALL)
+        if part:
+            return self._answer_part(part.group(1), int(part.group(2)), part.group(3), user), "stop"
+        if user in self.by_input:
+            return self.by_input[user], "stop"
+        return self._synthetic_outline(system_prompt, user), "stop"
+
+    def _answer_part(self, part_name: str, part_number: int, part_content: str, user: str) -> str:
+        recording = self._recording_for_part(part_content)
+        if "--- Measures To Fix ---" in user:
+            fix = re.search(r'--- Measures To Fix ---\n\n(.*?)\n\nThese measures', user, re.DOTALL)
+            return fix.group(1) if fix else ""
+        if "--- Previous Implementation ---" in user or "--- Last Completed Measures ---" in user:
+            if recording and recording[2].get(part_number):
+                return recording[2][part_number][0]
+            return self._synthetic_continuation(part_name, user)
+        shard = re.search(r'Write (?:only )?measures (\d+) to (\d+)', user)
+        if shard:
+            first, last = int(shard.group(1)), int(shard.group(2))
+            if recording and part_number in recording[1]:
+                return self._measure_range(recording[1][part_number], first, last)
+            if first > 1:
+                return "\n".join(self._synthetic_measure(number) for number in range(first, last + 1))
+            return self._synthetic_part(part_name, part_number, last)
+        if recording and part_number in recording[1]:
+            return recording[1][part_number]
+        return self._synthetic_part(part_name, part_number, self._synthetic_length(part_content))
+
+    @staticmethod
+    def _measure_range(part_text: str, first: int, last: int) -> str:
+        """Measures first..last of a recorded part; the first shard keeps the header and <part> opening."""
+        measures = []
+        for match in re.finditer(r'<measure\b[^>]*>.*?</measure>', part_text, re.S):
+            number = re.search(r'number="(\d+)"', match.group(0))
+            if number and first <= int(number.group(1)) <= last:
+                measures.append(match.group(0))
+        if first > 1:
+            return "\n".join(measures)
+        opening = part_text.find("<measure")
+        return (part_text[:opening] if opening >= 0 else "") + "\n".join(measures) + "\n</part>"
+
+    def _synthetic_length(self, text: str) -> int:
+        """Measures planned in an outline or asked for in a prompt, else SYNTHETIC_MEASURES."""
+        match = (re.search(r'Measures 1-(\d+)', text) or
+                 re.search(r'(\d+)\s*(?:measures|bars)\b', text, re.IGNORECASE))
+        return int(match.group(1)) if match else self.SYNTHETIC_MEASURES
+
+    def _synthetic_outline(self, system_prompt: str, user: str = "") -> str:
+        lines = [f"Measures 1-{self._synthetic_length(user)}: C major, 4/4, quarter-note melody over half-note bass"]
+        if "final reviewer" in system_prompt:
+            tags = ["*First Part", "*Last Part"]
+            return "\n\n".join(f"{tag}\n{name}\n" + "\n".join(lines)
+                               for tag, name in zip(tags, self.SYNTHETIC_PARTS))
+        return "Instrumentation: Piano\n" + "\n".join(lines)
+
+    @staticmethod
+    def _synthetic_measure(number: int) -> str:
+        attributes = ("<attributes><divisions>1</divisions><key><fifths>0</fifths></key>"
+                      "<time><beats>4</beats><beat-type>4</beat-type></time></attributes>") if number == 1 else ""
+        notes = "".join(f"<note><pitch><step>{step}</step><octave>4</octave></pitch><duration>1</duration>"
+                        f"<voice>1</voice><type>quarter</type></note>" for step in "CEGE")
+        return f'<measure number="{number}">{attributes}{notes}</measure>'
+
+    def _synthetic_part(self, part_name: str, part_number: int, measure_count: int) -> str:
+        text = ""
+        if part_number == 1:
+            names = ["Complete Composition"] if "Complete Composition" in part_name else self.SYNTHETIC_PARTS
+            score_parts = "".join(f'<score-part id="P{number}"><part-name>{name}</part-name></score-part>'
+                                  for number, name in enumerate(names, start=1))
+            text = MUSICXML_HEADER + f"<part-list>{score_parts}</part-list>\n"
+        measures = "\n".join(self._synthetic_measure(number) for number in range(1, measure_count + 1))
+        text += f'<part id="P{part_number}">\n{measures}\n</part>'
+        if "Last Part" in part_name or "Complete Composition" in part_name:
+            text += "\n</score-partwise>"
+        return text
+
+    def _synthetic_continuation(self, part_name: str, user: str) -> str:
+        closing = "</part>"
+        if "Last Part" in part_name or "Complete Composition" in part_name:
+            closing += "\n</score-partwise>"
+        start = re.search(r'starting at measure (\d+)', user)
+        if not start:
+            return closing
+        measures = [self._synthetic_measure(number)
+                    for number in range(int(start.group(1)), self._synthetic_length(user) + 1)]
+        return "\n".join(measures + [closing])
+
+
+class MockOpenAIServer(LocalBatchServer):
+    """
+    Local OpenAI-compatible chat completions endpoint for offline benchmarks, alongside the batch endpoints.
+    Replies come from the responder after delays drawn from the latency model, streamed as server-sent events
+    when requested. A configurable share of requests fail with 429 (with retry-after headers), stall and drop
+    the connection (a timeout), or are cut short with finish_reason "length". GET /v1/mock/stats reports how
+    many of each the server has produced, and how many connections clients opened.
+    """
+
+    STREAM_CHUNK_CHARS = 64
+
+    def __init__(self, responder=None, latency: LatencyModel = None, rate_429: float = 0.0,
+                 rate_timeout: float = 0.0, rate_truncate: float = 0.0, timeout_stall: float = 5.0,
+                 retry_after: float = 0.5, requests_per_minute: int = 1000000, tokens_per_minute: int = 1000000000,
+                 seed: int = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__(responder, host, port)
+        self.latency = latency or LatencyModel(distribution="fixed", median=0.0)
+        self.rate_429 = rate_429
+        self.rate_timeout = rate_timeout
+        self.rate_truncate = rate_truncate
+        self.timeout_stall = timeout_stall
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._random = random.Random(seed)
+        self.stats = {"requests": 0, "connections": 0, "rate_limited": 0, "timed_out": 0, "truncated": 0}
+
+    def serve_forever(self) -> None:
+        """Serve on the calling thread (used when the server runs in its own process)."""
+        self._server.serve_forever()
+
+    def connection_opened(self) -> None:
+        with self._lock:
+            self.stats["connections"] += 1
+
+    def _draw_fault(self):
+        with self._lock:
+            self.stats["requests"] += 1
+            roll = self._random.random()
+            for fault, rate in (("rate_limited", self.rate_429), ("timed_out", self.rate_timeout),
+                                ("truncated", self.rate_truncate)):
+                if roll < rate:
+                    self.stats[fault] += 1
+                    return fault
+                roll -= rate
+            return None
+
+    def _rate_limit_headers(self) -> Dict[str, str]:
+        return {"x-ratelimit-limit-requests": str(self.requests_per_minute),
+                "x-ratelimit-remaining-requests": str(self.requests_per_minute - 1),
+                "x-ratelimit-reset-requests": "1ms",
+                "x-ratelimit-limit-tokens": str(self.tokens_per_minute),
+                "x-ratelimit-remaining-tokens": str(self.tokens_per_minute - 1),
+                "x-ratelimit-reset-tokens": "1ms"}
+
+    def handle_get(self, handler, route: List[str]) -> None:
+        if route == ["mock", "stats"]:
+            with self._lock:
+                return handler._send(200, dict(self.stats))
+        super().handle_get(handler, route)
+
+    def handle_post(self, handler, route: List[str], body: bytes) -> None:
+        if route != ["chat", "completions"]:
+            return super().handle_post(handler, route, body)
+
+        request = json.loads(body)
+        fault = self._draw_fault()
+        if fault == "rate_limited":
+            return handler._send(
+                429, {"error": {"message": "Rate limit reached (mock server)", "type": "requests",
+                                "code": "rate_limit_exceeded"}},
+                headers={"retry-after-ms": str(int(self.retry_after * 1000)), **self._rate_limit_headers()})
+        if fault == "timed_out":
+            time.sleep(self.timeout_stall)
+            handler.close_connection = True
+            return
+
+        content, finish_reason = self.responder(request)
+        if fault == "truncated" and len(content) > 1:
+            with self._lock:
+                content = content[:max(1, int(len(content) * self._random.uniform(0.3, 0.9)))]
+            finish_reason = "length"
+        max_tokens = request.get("max_tokens")
+        if max_tokens and len(content) > max_tokens * 4:
+            content, finish_reason = content[:max_tokens * 4], "length"
+        prompt_tokens = sum(len(message.get("content") or "") for message in request.get("messages", [])) // 4
+
+        time.sleep(self.latency.first_token_delay())
+        if request.get("stream"):
+            return self._stream_completion(handler, request, content, finish_reason, prompt_tokens)
+        time.sleep(self.latency.generation_delay(len(content) // 4))
+        handler._send(200, self._completion_object(request.get("model"), content, finish_reason, prompt_tokens),
+                      headers=self._rate_limit_headers())
+
+    def _stream_completion(self, handler, request, content, finish_reason, prompt_tokens) -> None:
+        completion_id = self._next_id("chatcmpl")
+
+        def event(delta, chunk_finish_reason=None, usage=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.get("model"),
+                     "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": chunk_finish_reason}]}
+            if usage:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        def send(data):
+            # Chunked transfer encoding ends the response without closing the connection
+            handler.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        for name, value in self._rate_limit_headers().items():
+            handler.send_header(name, value)
+        handler.end_headers()
+
+        send(event({"role": "assistant", "content": ""}))
+        for start in range(0, len(content), self.STREAM_CHUNK_CHARS):
+            piece = content[start:start + self.STREAM_CHUNK_CHARS]
+            time.sleep(self.latency.generation_delay(len(piece) // 4))
+            send(event({"content": piece}))
+        send(event({}, finish_reason))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            completion_tokens = len(content) // 4
+            send(event(None, usage={"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                    "total_tokens": prompt_tokens + completion_tokens}))
+        send(b"data: [DONE]\n\n")
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+
+def _serve_mock_server(recordings_dir: str, latency_options: Dict, server_options: Dict, ready) -> None:
+    """Child process of BatchBenchmark: run the mock server until terminated, after reporting its URL."""
+    server = MockOpenAIServer(ReplayResponder(recordings_dir), latency=LatencyModel(**latency_options),
+                              **server_options)
+    ready.put(server.base_url)
+    server.serve_forever()
+
+
+def _percentile(values: List[float], percent: float):
+    """Nearest-rank percentile of a list of numbers, or None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class BatchBenchmark:
+    """
+    Offline throughput benchmark of a batch generator against MockOpenAIServer.
+    The mock server runs in its own process so serving requests does not compete with the generator for the
+    GIL. Each max_workers value runs the same prompts into a fresh output directory and reports tasks/min,
+    task latency percentiles, the peak Python memory traced during the run and the faults the server injected.
+    """
+
+    def __init__(self, generator_class=BatchMusicGenerator, generator_kwargs: Dict = None,
+                 recordings_dir: str = None, latency_options: Dict = None, server_options: Dict = None,
+                 trace_memory: bool = True, quiet: bool = True):
+        self.generator_class = generator_class
+        self.generator_kwargs = dict(generator_kwargs or {})
+        self.recordings_dir = recordings_dir
+        self.latency_options = dict(latency_options or {})
+        self.server_options = dict(server_options or {})
+        self.trace_memory = trace_memory
+        self.quiet = quiet
+        self.base_url = None
+        self._process = None
+
+    def start(self) -> None:
+        ready = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve_mock_server, args=(self.recordings_dir, self.latency_options, self.server_options, ready),
+            daemon=True)
+        self._process.start()
+        self.base_url = ready.get(timeout=60)
+        print(f"[Benchmark] Mock API listening on {self.base_url}")
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def server_stats(self) -> Dict:
+        with urllib.request.urlopen(f"{self.base_url}/mock/stats", timeout=10) as response:
+            return json.load(response)
+
+    def run_point(self, max_workers: int, test_prompts: Dict[int, Dict[int, str]], num_trials: int) -> Dict:
+        """Run the whole batch once with max_workers and measure it."""
+        output_dir = tempfile.mkdtemp(prefix=f"benchmark_w{max_workers}_")
+        kwargs = dict(self.generator_kwargs)
+        if issubclass(self.generator_class, AsyncBatchMusicGenerator):
+            kwargs["max_concurrent_calls"] = max_workers
+        stats_before = self.server_stats()
+
+        output = open(os.devnull, 'w') if self.quiet else sys.stdout
+        try:
+            with contextlib.redirect_stdout(output):
+                generator = self.generator_class(api_key="benchmark", output_base_dir=output_dir,
+                                                 max_workers=max_workers, base_url=self.base_url, resume=False,
+                                                 **kwargs)
+                # Fresh limiters at the mock server's limits, so client-side throttling does not carry over
+                for model_name in set(generator._stage_models().values()):
+                    RATE_LIMITERS.configure(model_name, self.server_options.get("requests_per_minute", 1000000),
+                                            self.server_options.get("tokens_per_minute", 1000000000))
+                if self.trace_memory:
+                    tracemalloc.start()
+                started = time.perf_counter()
+                finished = generator.run_batch(test_prompts, num_trials)
+                elapsed = time.perf_counter() - started
+                peak_memory = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+            if self.quiet:
+                output.close()
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        stats_after = self.server_stats()
+        latencies = generator.task_latencies
+        result = {
+            "max_workers": max_workers,
+            "tasks": finished,
+            "succeeded": len(latencies),
+            "seconds": elapsed,
+            "tasks_per_min": len(latencies) / elapsed * 60 if elapsed else 0.0,
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "peak_memory_mib": peak_memory / 2 ** 20 if peak_memory is not None else None
+        }
+        result.update({key: stats_after[key] - stats_before.get(key, 0) for key in stats_after})
+        result["metrics"] = generator.metrics.summary()
+        return result
+
+    def sweep(self, worker_counts: List[int], test_prompts: Dict[int, Dict[int, str]], num_trials: int = 1):
+        """Run every max_workers value in turn; returns one result per value."""
+        results = []
+        for max_workers in worker_counts:
+            print(f"[Benchmark] Running max_workers={max_workers}...")
+            results.append(self.run_point(max_workers, test_prompts, num_trials))
+            print(self.format_results(results[-1:]).splitlines()[-1])
+        return results
+
+    @staticmethod
+    def format_results(results: List[Dict]) -> str:
+        def seconds(value):
+            return f"{value:.2f}s" if value is not None else "n/a"
+
+        lines = [f"{'workers':>7} {'tasks':>7} {'tasks/min':>10} {'p50':>8} {'p95':>8} {'p99':>8} "
+                 f"{'peak MiB':>9} {'requests':>9} {'conns':>6} {'429s':>6} {'timeouts':>9} {'truncated':>10}"]
+        for r in results:
+            peak = f"{r['peak_memory_mib']:.1f}" if r["peak_memory_mib"] is not None else "n/a"
+            lines.append(f"{r['max_workers']:>7} {r['succeeded']:>3}/{r['tasks']:<3} {r['tasks_per_min']:>10.1f} "
+                         f"{seconds(r['p50']):>8} {seconds(r['p95']):>8} {seconds(r['p99']):>8} {peak:>9} "
+                         f"{r['requests']:>9} {r['connections']:>6} {r['rate_limited']:>6} {r['timed_out']:>9} "
+                         f"{r['truncated']:>10}")
+        return "\n".join(lines)
+
 
 # This is a minimal example that will run directly without command line arguments
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Maestro mass test over all test categories")
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads",
+                        help="threads: one thread per task, its calls made on a shared event loop; "
+                             "async: single event loop for all tasks")
+    parser.add_argument("--max-concurrent-calls", type=int, default=1000,
+                        help="Global limit on in-flight API calls when using the async engine")
+    parser.add_argument("--model-base-url", action="append", default=[], metavar="MODEL=URL",
+                        help="Send a model's calls to another OpenAI-compatible endpoint (repeatable)")
+    parser.add_argument("--no-http2", action="store_true",
+                        help="Keep API connections on HTTP/1.1 even when the h2 package is installed")
+    parser.add_argument("--hedge-percentile", type=float, default=None,
+                        help="Async engine: duplicate A2 calls running past this percentile of observed latency")
+    parser.add_argument("--hedge-max-ratio", type=float, default=0.1,
+                        help="Most A2 calls that may be hedged, as a fraction of all A2 calls (caps the extra spend)")
+    parser.add_argument("--hedge-min-samples", type=int, default=20,
+                        help="A2 latencies observed before any call is hedged")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                        help="Adapt the in-flight calls per model to 429s, timeouts and latency (AIMD)")
+    parser.add_argument("--initial-concurrency", type=int, default=8,
+                        help="In-flight calls per model at the start of an adaptive run")
+    parser.add_argument("--max-concurrency", type=int, default=64,
+                        help="Ceiling on the adaptive in-flight calls per model")
+    parser.add_argument("--stream-a2", action="store_true",
+                        help="Stream A2 responses and write each completed measure to the score as it arrives")
+    parser.add_argument("--continuation-mode", choices=["full", "tail"], default="full",
+                        help="full: resend the whole part on each continuation; tail: send the plan and last measures only")
+    parser.add_argument("--validate-measures", action="store_true",
+                        help="Check A2 measure durations against the time signature and re-request the failing ones")
+    parser.add_argument("--repair-rounds", type=int, default=1,
+                        help="Validate-and-re-request rounds for A2 measures that do not fit the time signature")
+    parser.add_argument("--validate-playability", action="store_true",
+                        help="With --validate-measures, also re-request notes outside the instrument's range and "
+                             "polyphony")
+    parser.add_argument("--cpu-workers", type=int, default=0,
+                        help="Worker processes for measure validation and score writes (default 0: run them on the "
+                             "API threads; -1: one per core)")
+    parser.add_argument("--bounded-memory", action="store_true",
+                        help="Spill stage outputs and assembled measures to disk so RAM holds only their indexes")
+    parser.add_argument("--spill-dir", default=None,
+                        help="Directory for the bounded-memory spill files (default: the system temp directory)")
+    parser.add_argument("--max-task-rss-mib", type=float, default=None,
+                        help="Hold new tasks while the mean RSS per in-flight task (resident memory over the "
+                             "baseline divided by the tasks in flight) is at this many MiB")
+    parser.add_argument("--shard-measures", type=int, default=0,
+                        help="Split A2 parts longer than this many measures into ranges written in parallel (0: off)")
+    parser.add_argument("--token-budget", action="store_true",
+                        help="Size each call's max_tokens from the measures to write instead of the stage's flat value")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Cache model responses in this directory so reruns replay them instead of calling the API")
+    parser.add_argument("--cache-stages", default="A1,B1,B2",
+                        help="Comma-separated stages served from the cache (A1, B1, B2, A2, A2-cont)")
+    parser.add_argument("--scheduler", choices=["slots", "pipeline"], default="slots",
+                        help="slots: each worker runs one task start to finish; pipeline: queue and worker pool of up "
+                             "to max_workers threads per stage")
+    parser.add_argument("--fan-out-stage", choices=["A1", "B1", "B2", "A2"], default="A1",
+                        help="Run the stages before this one once per prompt and share them between its trials")
+    parser.add_argument("--dedupe-prompts", action="store_true",
+                        help="Run identical prompts from different categories once and copy the outputs (pipeline "
+                             "scheduler)")
+    parser.add_argument("--conversation-store", action="store_true",
+                        help="Stream every conversation message to an indexed conversations.sqlite in the output folder")
+    parser.add_argument("--no-conversation-json", action="store_true",
+                        help="With --conversation-store, keep conversations only in conversations.sqlite instead of "
+                             "also writing a JSON file per trial")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip trials finished by earlier runs and resume interrupted ones from the checkpoint "
+                             "journal (by default the journal is set aside and every trial reruns)")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="Submit each stage for all tasks as an OpenAI Batch API job instead of calling interactively")
+    parser.add_argument("--batch-base-url", default=None,
+                        help="Base URL of the files/batches API used by --batch-api (defaults to the OpenAI API)")
+    parser.add_argument("--batch-poll-interval", type=float, default=60.0,
+                        help="Seconds between status checks of a submitted batch job")
+    parser.add_argument("--local-batch-server", action="store_true",
+                        help="Run --batch-api against a local stand-in for the batch endpoints (no API calls)")
+    parser.add_argument("--analyze", nargs="+", metavar="PATH",
+                        help="Score 1/f pitch and duration exponents of the MusicXML files in these files or folders, then exit")
+    parser.add_argument("--analysis-workers", type=int, default=None,
+                        help="Processes used to parse scores for --analyze and --corpus-stats (default: one per CPU)")
+    parser.add_argument("--analysis-cache", default="spectral_analysis_cache.json",
+                        help="File caching --analyze results by score content hash")
+    parser.add_argument("--analysis-output", default=None,
+                        help="Write the per-file --analyze results to this JSON file")
+    parser.add_argument("--corpus-stats", nargs="+", metavar="PATH",
+                        help="Per-category note-length, range, rest and prompt adherence statistics of the scores "
+                             "in these files or folders (e.g. XML_Output), then exit")
+    parser.add_argument("--corpus-stats-cache", default="corpus_stats_cache.json",
+                        help="File caching --corpus-stats results by file size, mtime and content hash")
+    parser.add_argument("--corpus-stats-output", default=None,
+                        help="Write the per-file --corpus-stats results to this JSON file")
+    parser.add_argument("--check-playability", nargs="+", metavar="PATH",
+                        help="Count notes outside each instrument's range and chords it cannot play in the scores "
+                             "in these files or folders, then exit")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve live call metrics at http://127.0.0.1:PORT/metrics in the Prometheus text format")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Measure batch throughput against a local mock API (no API calls), then exit")
+    parser.add_argument("--bench-workers", default="1,2,4,8",
+                        help="Comma-separated max_workers values swept by --benchmark")
+    parser.add_argument("--bench-prompts", type=int, default=5,
+                        help="Test prompts run at each --benchmark sweep point")
+    parser.add_argument("--bench-trials", type=int, default=2,
+                        help="Trials per prompt at each --benchmark sweep point")
+    parser.add_argument("--bench-recordings", default=None,
+                        help="Conversations folder or conversations.sqlite replayed by the mock API (default: Conversations in the output folder)")
+    parser.add_argument("--bench-latency", choices=LatencyModel.DISTRIBUTIONS, default="lognormal",
+                        help="Distribution of the mock API's time to first token")
+    parser.add_argument("--bench-latency-median", type=float, default=2.0,
+                        help="Median time to first token in seconds")
+    parser.add_argument("--bench-latency-sigma", type=float, default=0.6,
+                        help="Spread (log-space sigma) of the lognormal latency distribution")
+    parser.add_argument("--bench-tokens-per-second", type=float, default=80.0,
+                        help="Mock generation speed per response; 0 sends the whole response at once")
+    parser.add_argument("--bench-time-scale", type=float, default=1.0,
+                        help="Multiply every mock delay by this factor (e.g. 0.1 runs ten times faster)")
+    parser.add_argument("--bench-429-rate", type=float, default=0.0,
+                        help="Share of mock requests answered with 429 Too Many Requests")
+    parser.add_argument("--bench-timeout-rate", type=float, default=0.0,
+                        help="Share of mock requests that stall and drop the connection")
+    parser.add_argument("--bench-timeout-stall", type=float, default=5.0,
+                        help="Seconds a timed-out mock request stalls before dropping the connection")
+    parser.add_argument("--bench-truncate-rate", type=float, default=0.0,
+                        help="Share of mock responses cut short with finish_reason=length")
+    parser.add_argument("--bench-output", default=None,
+                        help="Write the --benchmark results to this JSON file")
+    args = parser.parse_args()
+    if any("=" not in value for value in args.model_base_url):
+        parser.error("--model-base-url takes MODEL=URL")
+    model_base_urls = dict(value.split("=", 1) for value in args.model_base_url)
+
+    if args.analyze:
+        analyzer = SpectralAnalyzer(cache_path=args.analysis_cache, max_workers=args.analysis_workers)
+        analysis_results = analyzer.analyze(args.analyze)
+        print(SpectralAnalyzer.format_summary(analysis_results))
+        if args.analysis_output:
+            with open(args.analysis_output, 'w', encoding='utf-8') as f:
+                json.dump(analysis_results, f, indent=2)
+        sys.exit(0)
+
     # Define test prompts for each category - this is minimal example with just category 1
     test_categories = {
         1: {  # Orchestration Tests
@@ -975,19 +6849,135 @@ if __name__ == "__main__":
         }
     }
 
-    # Prompt for API key
-    api_key = input("Enter your OpenAI API key: ")
-    if not api_key:
-        print("No API key provided. Exiting.")
-        sys.exit(1)
+    if args.corpus_stats:
+        corpus_analyzer = CorpusAnalyzer(cache_path=args.corpus_stats_cache, max_workers=args.analysis_workers)
+        corpus_results = corpus_analyzer.analyze(args.corpus_stats)
+        print(CorpusAnalyzer.format_summary(corpus_results, test_categories))
+        if args.corpus_stats_output:
+            with open(args.corpus_stats_output, 'w', encoding='utf-8') as f:
+                json.dump(corpus_results, f, indent=2)
+        sys.exit(0)
+
+    if args.check_playability:
+        print(PlayabilityChecker.format_summary(
+            PlayabilityChecker().check_scores(args.check_playability, max_workers=args.analysis_workers)))
+        sys.exit(0)
 
     # Create a smaller output directory for testing
     output_dir = r"C:\Users\Vincent\Downloads\Music\Testing"
+    # -1 asks for one worker process per core
+    cpu_workers = args.cpu_workers if args.cpu_workers >= 0 else None
+
+    if args.benchmark:
+        bench_kwargs = {
+            "scheduler": args.scheduler,
+            "fan_out_stage": args.fan_out_stage,
+            "dedupe_prompts": args.dedupe_prompts,
+            "stream_a2": args.stream_a2,
+            "continuation_mode": args.continuation_mode,
+            "validate_measures": args.validate_measures,
+            "repair_rounds": args.repair_rounds,
+            "check_playability": args.validate_playability,
+            "cpu_workers": cpu_workers,
+            "bounded_memory": args.bounded_memory,
+            "spill_dir": args.spill_dir,
+            "max_task_rss_mib": args.max_task_rss_mib,
+            "http2": not args.no_http2,
+            "shard_measures": args.shard_measures,
+            "token_budget": args.token_budget,
+            "adaptive_concurrency": args.adaptive_concurrency,
+            "initial_concurrency": args.initial_concurrency,
+            "max_concurrency": args.max_concurrency
+        }
+        if args.engine == "async":
+            bench_kwargs.update({"hedge_percentile": args.hedge_percentile, "hedge_max_ratio": args.hedge_max_ratio,
+                                 "hedge_min_samples": args.hedge_min_samples})
+        bench_prompts = {}
+        for category_id, prompts in test_categories.items():
+            for prompt_id, prompt_text in prompts.items():
+                if sum(len(p) for p in bench_prompts.values()) < args.bench_prompts:
+                    bench_prompts.setdefault(category_id, {})[prompt_id] = prompt_text
+
+        benchmark = BatchBenchmark(
+            generator_class=AsyncBatchMusicGenerator if args.engine == "async" else BatchMusicGenerator,
+            generator_kwargs=bench_kwargs,
+            recordings_dir=args.bench_recordings or os.path.join(output_dir, "Conversations"),
+            latency_options={"distribution": args.bench_latency, "median": args.bench_latency_median,
+                             "sigma": args.bench_latency_sigma, "tokens_per_second": args.bench_tokens_per_second,
+                             "scale": args.bench_time_scale, "seed": 0},
+            server_options={"rate_429": args.bench_429_rate, "rate_timeout": args.bench_timeout_rate,
+                            "rate_truncate": args.bench_truncate_rate, "timeout_stall": args.bench_timeout_stall,
+                            "seed": 0}
+        )
+        benchmark.start()
+        try:
+            bench_results = benchmark.sweep([int(n) for n in args.bench_workers.split(",") if n.strip()],
+                                            bench_prompts, num_trials=args.bench_trials)
+        finally:
+            benchmark.stop()
+        print(BatchBenchmark.format_results(bench_results))
+        if args.bench_output:
+            with open(args.bench_output, 'w', encoding='utf-8') as f:
+                json.dump(bench_results, f, indent=2)
+        sys.exit(0)
+
+    # The local stand-in needs no key; otherwise prompt for the API key
+    local_batch_server = None
+    if args.local_batch_server:
+        args.batch_api = True
+        local_batch_server = LocalBatchServer()
+        local_batch_server.start()
+        args.batch_base_url = local_batch_server.base_url
+        print(f"Local batch stand-in listening on {local_batch_server.base_url}")
+        api_key = "local-stand-in"
+    else:
+        api_key = input("Enter your OpenAI API key: ")
+    if not api_key:
+        print("No API key provided. Exiting.")
+        sys.exit(1)
 
     print(f"Output will be saved to: {output_dir}")
 
     # Create batch generator with minimal configuration
-    batch_generator = BatchMusicGenerator(
+    generator_kwargs = {
+        "resume": args.resume,
+        "conversation_store": args.conversation_store,
+        "conversation_json": not args.no_conversation_json,
+        "scheduler": args.scheduler,
+        "fan_out_stage": args.fan_out_stage,
+        "dedupe_prompts": args.dedupe_prompts,
+        "stream_a2": args.stream_a2,
+        "continuation_mode": args.continuation_mode,
+        "validate_measures": args.validate_measures,
+        "repair_rounds": args.repair_rounds,
+        "check_playability": args.validate_playability,
+        "cpu_workers": cpu_workers,
+        "bounded_memory": args.bounded_memory,
+        "spill_dir": args.spill_dir,
+        "max_task_rss_mib": args.max_task_rss_mib,
+        "model_base_urls": model_base_urls,
+        "http2": not args.no_http2,
+        "shard_measures": args.shard_measures,
+        "token_budget": args.token_budget,
+        "adaptive_concurrency": args.adaptive_concurrency,
+        "initial_concurrency": args.initial_concurrency,
+        "max_concurrency": args.max_concurrency,
+        "cache_dir": args.cache_dir,
+        "cache_stages": tuple(stage.strip() for stage in args.cache_stages.split(",") if stage.strip())
+    }
+    generator_class = BatchMusicGenerator
+    if args.batch_api:
+        generator_class = BatchApiMusicGenerator
+        generator_kwargs["base_url"] = args.batch_base_url
+        generator_kwargs["poll_interval"] = args.batch_poll_interval
+    elif args.engine == "async":
+        generator_class = AsyncBatchMusicGenerator
+        generator_kwargs["max_concurrent_calls"] = args.max_concurrent_calls
+        generator_kwargs["hedge_percentile"] = args.hedge_percentile
+        generator_kwargs["hedge_max_ratio"] = args.hedge_max_ratio
+        generator_kwargs["hedge_min_samples"] = args.hedge_min_samples
+
+    batch_generator = generator_class(
         api_key=api_key,
         output_base_dir=output_dir,
         max_workers=13,  # Just use 1 worker for testing
@@ -1000,13 +6990,25 @@ if __name__ == "__main__":
             "model_b2_top_p": 0.7,
             "model_a2_temperature": 0.85,
             "model_a2_top_p": 0.4,
-        }
+        },
+        **generator_kwargs
     )
 
     # Set up signal handler for clean exit
     batch_generator.setup_signal_handler()
 
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(batch_generator.metrics, port=args.metrics_port)
+        metrics_server.start()
+        print(f"Serving metrics at {metrics_server.url}")
+
     print("\nStarting batch processing with test categories...")
     batch_generator.run_batch(test_categories, num_trials=3)  # Just run 1 trial for testing
 
+    if local_batch_server is not None:
+        local_batch_server.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+
     print("\nTest complete. Check output directory for results.")
\ No newline at end of file
@@ -0,0 +1,31 @@
+"""
+Shared fixtures. The script's file name is not importable, so it is loaded as the module ``maestro``.
+The script imports openai at module level; without it the tests error instead of being skipped.
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Agent 1.1 Mass-Tester.py")
+
+
+@pytest.fixture(scope="session")
+def maestro():
+    if "maestro" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("maestro", SCRIPT_PATH)
+        module = importlib.util.module_from_spec(spec)
+        # Registered before it runs so pickled objects (CPU pool tasks, benchmark processes) resolve by name
+        sys.modules["maestro"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["maestro"]
+
+
+@pytest.fixture
+def batch_server(maestro):
+    """Local files and batches endpoints answering with ReplayResponder's synthetic replies."""
+    server = maestro.LocalBatchServer(maestro.ReplayResponder())
+    server.start()
+    yield server
+    server.stop()
@@ -0,0 +1,61 @@
+import json
+import os
+import xml.etree.ElementTree as ET
+
+PROMPTS = {1: {1: "A short piano piece in 8 measures", 2: "A calm piano study in 8 measures"}}
+
+
+def _generator(maestro, output_dir, base_url):
+    return maestro.BatchApiMusicGenerator(api_key="test", output_base_dir=str(output_dir), base_url=base_url,
+                                          poll_interval=0.01, cpu_workers=0, resume=True)
+
+
+def test_batch_api_writes_every_score(maestro, batch_server, tmp_path):
+    finished = _generator(maestro, tmp_path, batch_server.base_url).run_batch(PROMPTS, num_trials=1)
+
+    assert finished == 2
+    # One batch per stage: A1, B1, B2 and A2, as the synthetic replies need no continuations
+    assert len(batch_server.batches) == 4
+    for prompt_id in PROMPTS[1]:
+        score = ET.parse(tmp_path / "XML_Output" / f"Category1_Prompt{prompt_id}_Trial1.xml").getroot()
+        parts = {part.get("id"): len(part.findall("measure")) for part in score.iter("part")}
+        assert parts == {"P1": 8, "P2": 8}
+        conversation = json.loads(
+            (tmp_path / "Conversations" / f"conversation_Cat1_Prompt{prompt_id}_Trial1.json").read_text("utf-8"))
+        assert [message["role"] for message in conversation][:5] == ["User", "Model A1", "Model B1", "Model B2",
+                                                                      "Model A2"]
+    assert os.listdir(tmp_path / "Batch_Jobs")
+
+
+def test_batch_api_rerun_skips_finished_trials(maestro, batch_server, tmp_path):
+    _generator(maestro, tmp_path, batch_server.base_url).run_batch(PROMPTS, num_trials=1)
+    submitted = len(batch_server.batches)
+
+    assert _generator(maestro, tmp_path, batch_server.base_url).run_batch(PROMPTS, num_trials=1) == 0
+    assert len(batch_server.batches) == submitted
+
+
+def test_trial_missing_an_a2_part_fails_and_a_rerun_requests_only_that_part(maestro, batch_server, tmp_path):
+    generator = _generator(maestro, tmp_path, batch_server.base_url)
+    submit_batch = generator._submit_batch
+
+    def drop_a_part(stage, requests):
+        results = submit_batch(stage, requests)
+        if stage == "A2":
+            del results["Cat1_Prompt1_Trial1|A2|2"]
+        return results
+
+    generator._submit_batch = drop_a_part
+    assert generator.run_batch(PROMPTS, num_trials=1) == 1
+
+    rerun = _generator(maestro, tmp_path, batch_server.base_url)
+    submitted = []
+    submit_rerun_batch = rerun._submit_batch
+
+    def record_requests(stage, requests):
+        submitted.append((stage, [request["custom_id"] for request in requests]))
+        return submit_rerun_batch(stage, requests)
+
+    rerun._submit_batch = record_requests
+    assert rerun.run_batch(PROMPTS, num_trials=1) == 1
+    assert [(stage, ids) for stage, ids in submitted if ids] == [("A2", ["Cat1_Prompt1_Trial1|A2|2"])]
@@ -0,0 +1,17 @@
+def test_run_point_against_mock_server(maestro):
+    benchmark = maestro.BatchBenchmark(maestro.BatchMusicGenerator, {"cpu_workers": 0},
+                                       latency_options={"distribution": "fixed", "median": 0.0})
+    benchmark.start()
+    try:
+        result = benchmark.run_point(2, {1: {1: "A piece in 8 measures", 2: "Another piece in 8 measures"}}, 1)
+    finally:
+        benchmark.stop()
+
+    assert result["max_workers"] == 2
+    assert result["tasks"] == result["succeeded"] == 2
+    assert result["p50"] is not None and result["p50"] <= result["p99"]
+    # A1, B1 and B2 once per task, and one A2 call for each of the two synthetic parts
+    assert result["requests"] == 10
+    assert result["rate_limited"] == result["timed_out"] == result["truncated"] == 0
+    assert set(result["metrics"]["stages"]) == {"A1", "B1", "B2", "A2"}
+    assert "conns" in benchmark.format_results([result]).splitlines()[0]
@@ -0,0 +1,34 @@
+def _measure(number, step="C"):
+    return (f'<measure number="{number}"><note><pitch><step>{step}</step><octave>4</octave></pitch>'
+            f'<duration>4</duration><type>whole</type></note></measure>')
+
+
+# A first response cut off by the token limit in the middle of measure 2, and its tail continuation
+TRUNCATED = '<part id="P1">' + _measure(1) + '<measure number="2"><note><pi'
+TAIL = _measure(2, "D") + _measure(3, "E") + "</part>"
+
+
+def _agent(maestro, tmp_path, journal):
+    agent = maestro.LLMConversationAgent(api_key="test", prompt_id="1_1", continuation_mode="tail", journal=journal,
+                                         conversation_dir=str(tmp_path), final_output_dir=str(tmp_path))
+    agent.start_conversation("A piano piece")
+    return agent
+
+
+def test_resume_replays_each_segment_as_the_live_run_fed_it(maestro, tmp_path):
+    journal = maestro.CheckpointJournal(str(tmp_path / "checkpoint_journal.jsonl"))
+    live = _agent(maestro, tmp_path, journal)
+    part_result = live._accept_part_response("First Part", "Piano: melody", 1, TRUNCATED, "length")
+    segment = live._continuation_segment()
+    live.score_assembler.feed(1, "\n\n" + TAIL, segment=segment)
+    live._apply_continuation(part_result, TAIL, "stop", segment)
+    journal.close()
+
+    resumed = _agent(maestro, tmp_path, maestro.CheckpointJournal(str(tmp_path / "checkpoint_journal.jsonl")))
+    resumed_result = resumed._resume_part(1)
+
+    assert resumed.score_assembler.measures(1) == live.score_assembler.measures(1)
+    assert resumed_result["a2_response"] == TRUNCATED + "\n\n" + TAIL
+    assert resumed_result["finish_reason"] == "stop"
+    # Segments written after the resume do not reuse a replayed segment's name
+    assert resumed._continuation_segment() == "continuation-2"
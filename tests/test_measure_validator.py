@@ -0,0 +1,101 @@
+from fractions import Fraction
+
+import pytest
+
+ATTRIBUTES = "<attributes><divisions>{divisions}</divisions><time><beats>{beats}</beats>" \
+             "<beat-type>{beat_type}</beat-type></time></attributes>"
+
+
+def _note(note_type, duration=1, extra=""):
+    return (f"<note><pitch><step>C</step><octave>4</octave></pitch><duration>{duration}</duration>"
+            f"<type>{note_type}</type>{extra}</note>")
+
+
+def _measure(number, *notes, divisions="1", beats="4", beat_type="4"):
+    attributes = ATTRIBUTES.format(divisions=divisions, beats=beats, beat_type=beat_type) if number == 1 else ""
+    return f'<measure number="{number}">{attributes}{"".join(notes)}</measure>'
+
+
+@pytest.fixture
+def validator(maestro):
+    return maestro.MeasureValidator()
+
+
+def test_full_measures_pass(validator):
+    measures = {"1": _measure(1, *[_note("quarter")] * 4),
+                "2": _measure(2, _note("half", 2), _note("quarter", 1, "<dot/>"), _note("eighth")),
+                "3": _measure(3, *[_note("eighth", extra="<time-modification><actual-notes>3</actual-notes>"
+                                                         "<normal-notes>2</normal-notes></time-modification>")] * 6,
+                              _note("half", 2))}
+
+    assert validator.validate_part(measures) == []
+
+
+def test_short_measure_is_reported(validator):
+    measures = {"1": _measure(1, *[_note("quarter")] * 4), "2": _measure(2, *[_note("quarter")] * 3)}
+
+    assert validator.validate_part(measures) == [
+        {"measure": "2", "voice": "1", "expected": Fraction(4), "actual": Fraction(3)}]
+
+
+def test_time_signature_carries_over_and_pickups_pass(validator):
+    measures = {"1": _measure(1, _note("half", 2, "<dot/>"), beats="6", beat_type="8"),
+                "2": '<measure number="2" implicit="yes">' + _note("quarter") + "</measure>",
+                "3": _measure(3, _note("quarter"))}
+
+    issues = validator.validate_part(measures)
+
+    assert [(issue["measure"], issue["expected"]) for issue in issues] == [("3", Fraction(3))]
+
+
+# Notes without a <type> are measured by <duration>: 2 + 1 quarter notes, one short of 4/4 when readable
+UNTYPED = "<note><pitch><step>C</step><octave>4</octave></pitch><duration>{duration}</duration></note>" \
+          "<forward><duration>{forward}</duration></forward>"
+
+
+def test_untyped_notes_are_measured_by_duration(validator):
+    measure = f'<measure number="1">{ATTRIBUTES.format(divisions="1", beats="4", beat_type="4")}' \
+              f'{UNTYPED.format(duration="2", forward="1")}</measure>'
+
+    assert [issue["actual"] for issue in validator.validate_part({"1": measure})] == [Fraction(3)]
+
+
+@pytest.mark.parametrize("divisions, beats, beat_type, duration, forward", [
+    ("x", "4", "4", "2", "1"),
+    ("0", "4", "4", "2", "1"),
+    ("1", "four", "4", "2", "1"),
+    ("1", "4", "0", "2", "1"),
+    ("1", "4", "4", "two", "1"),
+    ("1", "4", "4", "2", "1/0"),
+])
+def test_malformed_numbers_are_unknown(validator, divisions, beats, beat_type, duration, forward):
+    measure = f'<measure number="1">{ATTRIBUTES.format(divisions=divisions, beats=beats, beat_type=beat_type)}' \
+              f'{UNTYPED.format(duration=duration, forward=forward)}</measure>'
+
+    assert validator.validate_part({"1": measure}) == []
+
+
+def test_malformed_tuplet_is_skipped(validator):
+    note = _note("eighth", extra="<time-modification><actual-notes>0</actual-notes>"
+                                 "<normal-notes>2</normal-notes></time-modification>")
+
+    assert validator.validate_part({"1": _measure(1, note)}) == []
+
+
+def test_issue_ranges_group_contiguous_measures(maestro):
+    issues = [{"measure": number} for number in ("7", "2", "3", "5", "pickup")]
+
+    ranges = maestro.MeasureValidator.issue_ranges(issues)
+
+    assert [(first, last, len(range_issues)) for first, last, range_issues in ranges] == [(2, 3, 2), (5, 5, 1),
+                                                                                            (7, 7, 1)]
+
+
+def test_rest_without_type_fills_the_measure_only_when_alone(validator):
+    rest = "<note><rest/><duration>{duration}</duration></note>"
+    measures = {"1": _measure(1, rest.format(duration="1")),
+                "2": _measure(2, _note("half", 2), rest.format(duration="1")),
+                "3": _measure(3, _note("half", 2), '<note><rest measure="yes"/><duration>2</duration></note>')}
+
+    assert validator.validate_part(measures) == [
+        {"measure": "2", "voice": "1", "expected": Fraction(4), "actual": Fraction(3)}]
@@ -0,0 +1,71 @@
+import xml.etree.ElementTree as ET
+
+
+def _measure(number, step="C"):
+    return (f'<measure number="{number}"><note><pitch><step>{step}</step><octave>4</octave></pitch>'
+            f'<duration>4</duration><type>whole</type></note></measure>')
+
+
+PART = '<part id="P1">' + _measure(1) + _measure(2, "D") + _measure(3, "E") + "</part>"
+# A first response cut off by the token limit in the middle of measure 2, and its tail continuation
+TRUNCATED = '<part id="P1">' + _measure(1) + '<measure number="2"><note><pi'
+TAIL = _measure(2, "D") + _measure(3, "E") + "</part>"
+
+
+def test_chunked_text_parses_like_whole_text(maestro):
+    whole = maestro.PartStream(1)
+    whole.feed(PART, final=True)
+    chunked = maestro.PartStream(1)
+    for start in range(0, len(PART), 7):
+        chunked.feed(PART[start:start + 7])
+    chunked.feed("", final=True)
+
+    assert chunked.part_id == whole.part_id == "P1"
+    assert chunked.measures == whole.measures
+    assert list(whole.measures) == ["1", "2", "3"]
+
+
+def test_full_continuation_restarting_a_cut_measure_keeps_the_complete_copy(maestro):
+    stream = maestro.PartStream(1)
+    stream.feed('<part id="P1">' + _measure(1) + '<measure number="2"><note>')
+    stream.feed("\n\n" + TAIL, final=True)
+
+    assert list(stream.measures) == ["1", "2", "3"]
+    assert "<step>D</step>" in stream.measures["2"]
+
+
+def test_measure_open_when_the_parser_fails_is_kept(maestro):
+    stream = maestro.PartStream(1)
+    stream.feed('<part id="P1">' + _measure(1) + '<measure number="2"><note><pitch><step>D</step>')
+    # The bare ampersand breaks the XML parser in the middle of measure 2
+    stream.feed('<octave>4</octave></pitch><duration>4</duration><type>whole</type><lyric><text>A & B</text>'
+                '</lyric></note></measure>' + _measure(3, "E") + "</part>", final=True)
+
+    assert list(stream.measures) == ["1", "2", "3"]
+    assert stream.measures["2"].startswith('<measure number="2"><note><pitch><step>D</step>')
+
+
+def test_truncated_measure_followed_by_a_continuation_after_a_parse_error(maestro):
+    stream = maestro.PartStream(1)
+    # The cut-off tag before the continuation breaks the XML parser
+    stream.feed('<part id="P1">' + _measure(1) + '<measure number="2"><note><pi')
+    stream.feed("\n\n" + _measure(2, "D") + '<measure number="3"><note><pi')
+    stream.feed("\n\n" + _measure(3, "E") + "</part>", final=True)
+
+    assert list(stream.measures) == ["1", "2", "3"]
+    assert stream.measures["3"] == _measure(3, "E")
+    for measure_xml in stream.measures.values():
+        ET.fromstring(measure_xml)
+
+
+def test_segments_are_spliced_by_measure_number(maestro):
+    assembler = maestro.ScoreAssembler()
+    assembler.feed(1, TRUNCATED)
+    assembler.feed(1, "\n\n" + TAIL, segment="continuation-1")
+    assembler.feed(1, _measure(3, "G"), segment="repair-2")
+
+    measures = assembler.measures(1)
+
+    assert sorted(measures) == ["1", "2", "3"]
+    assert "<step>D</step>" in measures["2"] and "<step>G</step>" in measures["3"]
+    assert assembler.next_measure_number(1) == 4
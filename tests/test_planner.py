@@ -0,0 +1,55 @@
+import pytest
+
+# The same prompt text in two categories, two trials each
+TASKS = [(1, 1, "A waltz", 1), (1, 1, "A waltz", 2), (2, 4, "A waltz", 1), (2, 4, "A waltz", 2),
+         (1, 2, "A march", 1)]
+
+
+def _stages(node):
+    stages = [node["stage"]]
+    while len(node["children"]) == 1:
+        node = node["children"][0]
+        stages.append(node["stage"])
+    return stages
+
+
+def test_default_plan_runs_every_task_on_its_own(maestro):
+    planner = maestro.SharedPrefixPlanner()
+
+    roots = planner.plan(TASKS)
+
+    assert len(roots) == len(TASKS)
+    assert [leaf["targets"] for root in roots for leaf in root["leaves"]] == [[(1, 1)], [(1, 1)], [(2, 4)], [(2, 4)],
+                                                                               [(1, 2)]]
+
+
+def test_dedupe_keeps_trials_independent_and_merges_duplicate_prompts(maestro):
+    planner = maestro.SharedPrefixPlanner(dedupe_prompts=True)
+
+    roots = planner.plan(TASKS)
+
+    assert len(roots) == 3
+    assert all(_stages(root) == ["A1", "B1", "B2", "A2"] for root in roots)
+    assert [(leaf["prompt_text"], leaf["trial"], leaf["targets"]) for root in roots for leaf in root["leaves"]] == [
+        ("A waltz", 1, [(1, 1), (2, 4)]), ("A waltz", 2, [(1, 1), (2, 4)]), ("A march", 1, [(1, 2)])]
+    assert planner.format_summary(TASKS, roots) == (
+        "[Batch] Plan: 5 tasks as 3 trials, 12 of 20 stage runs (A1 3, B1 3, B2 3, A2 3); trials fan out at A1")
+
+
+def test_late_fan_out_shares_earlier_stages(maestro):
+    planner = maestro.SharedPrefixPlanner(fan_out_stage="A2")
+
+    roots = planner.plan(TASKS)
+
+    assert planner.shared_stages == ("A1", "B1", "B2")
+    assert len(roots) == 3
+    waltz_b2 = roots[0]["children"][0]["children"][0]
+    assert waltz_b2["stage"] == "B2"
+    assert [(child["stage"], child["leaves"][0]["trial"]) for child in waltz_b2["children"]] == [("A2", 1),
+                                                                                                  ("A2", 2)]
+    assert sum(1 for node in planner.walk(roots) if not node["children"]) == 5
+
+
+def test_unknown_fan_out_stage_is_rejected(maestro):
+    with pytest.raises(ValueError):
+        maestro.SharedPrefixPlanner(fan_out_stage="C1")
@@ -0,0 +1,17 @@
+def test_calls_reserve_the_recent_completion_size_instead_of_max_tokens(maestro):
+    limiter = maestro.ModelRateLimiter("gpt-4.1", 500, 30000)
+
+    assert limiter.completion_estimate(16384) == maestro.INITIAL_COMPLETION_ESTIMATE
+    assert limiter.completion_estimate(100) == 100
+    limiter.settle(limiter.completion_estimate(16384), 3000)
+    assert limiter.completion_estimate(16384) == 3000
+
+
+def test_settling_charges_the_difference_to_the_budget(maestro):
+    limiter = maestro.ModelRateLimiter("gpt-4.1", 500, 6000)
+
+    assert limiter.reserve(1000 + 2048) == 0
+    limiter.settle(2048, 5048)
+
+    # The call used 1000 + 5048 of 6000 tokens, so a 952-token call waits for 1000 to refill at 100 per second
+    assert 9.9 < limiter.reserve(952) <= 10